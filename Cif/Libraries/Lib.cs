@@ -38,7 +38,7 @@ namespace Cif.Libraries
 
 		public static void WriteErrorAndExit(String s, params object[] args){
 			WriteError (s, args);
-			Environment.Exit (-1);
+			throw new SecStrAnnotator2.Utils.ExitException (-1);
 		}
 
 		public static void WriteWarning(String s, params object[] args){
@@ -14,7 +14,18 @@ namespace SecStrAnnotator2
     {
         static int Main(string[] args)
         {
-            return protein.MainClass.Main_SecStrAnnot1(args);
+            if (args.Length == 1 && args[0] == protein.WorkerMode.WORKER_OPTION)
+            {
+                return protein.WorkerMode.Main_Worker();
+            }
+            try
+            {
+                return protein.MainClass.Main_SecStrAnnot1(args);
+            }
+            catch (ExitException e)
+            {
+                return e.ExitCode;
+            }
         }
 
         static int TestingMain(string[] args)
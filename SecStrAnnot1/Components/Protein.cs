@@ -12,7 +12,7 @@ namespace protein.Components
     public class Protein
     {
 		public const bool IGNORE_ALTERNATIVE_LOCATIONS = true;
-		private static bool alternativeLocationWarningPrinted = false;
+		internal static bool alternativeLocationWarningPrinted = false;
 
         private Dictionary<string,Chain> chains;
 
@@ -165,7 +165,7 @@ namespace protein.Libraries {
 
         public static void WriteErrorAndExit(String s, params object[] args) {
             WriteError(s, args);
-            Environment.Exit(-1);
+            throw new SecStrAnnotator2.Utils.ExitException(-1);
         }
 
         public static void WriteWarning(String s, params object[] args) {
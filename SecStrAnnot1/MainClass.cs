@@ -234,7 +234,7 @@ namespace protein {
             List<String> otherArgs;
             bool optionsOK = options.TryParse(args, out otherArgs);
             if (!optionsOK) {
-                Environment.Exit(1);
+                return 1;
             }
 
             string templateDomainString;
@@ -243,7 +243,7 @@ namespace protein {
                 // Execution with --onlyssa: SecStrAnnotator.exe DIR QUERY
                 if (otherArgs.Count != 2) {
                     Options.PrintError("Exactly 2 arguments required when run with --onlyssa ({0} given: {1})", otherArgs.Count, otherArgs.EnumerateWithSeparators(" "));
-                    Environment.Exit(1);
+                    return 1;
                 }
                 Setting.Directory = otherArgs[0];
                 queryDomainString = otherArgs[1];
@@ -252,7 +252,7 @@ namespace protein {
                 // Normal execution: SecStrAnnotator.exe DIR TEMPLATE TEMPLATE QUERY
                 if (otherArgs.Count != 3) {
                     Options.PrintError("Exactly 3 arguments required ({0} given: {1})", otherArgs.Count, otherArgs.EnumerateWithSeparators(" "));
-                    Environment.Exit(1);
+                    return 1;
                 }
                 Setting.Directory = otherArgs[0];
                 templateDomainString = otherArgs[1];
@@ -271,7 +271,7 @@ namespace protein {
                 } catch (FormatException e) {
                     Options.PrintError("Invalid value of the TEMPLATE argument \"" + templateDomainString + "\"\n"
                         + e.Message);
-                    Environment.Exit(1);
+                    return 1;
                 }
             }
             try {
@@ -279,7 +279,7 @@ namespace protein {
             } catch (FormatException e) {
                 Options.PrintError("Invalid value of the QUERY argument \"" + queryDomainString + "\"\n"
                     + e.Message);
-                Environment.Exit(1);
+                return 1;
             }
             #endregion
 
@@ -626,7 +626,7 @@ namespace protein {
                                 }
                             }
                             AnnotationHelper.PrintCrossMatrix(context, metricMatrix, "metric_matrix.tsv");
-                            Environment.Exit(0);
+                            return 0;
                         }
 
                         Func<AnnotationContext, IAnnotator> createAnnotator;
@@ -0,0 +1,78 @@
+using System;
+using System.IO;
+using System.Linq;
+
+using SecStrAnnotator2.Utils;
+using protein.Components;
+using protein.Libraries;
+
+namespace protein {
+    /// <summary> Long-lived worker mode, which allows running many annotations within one process
+    /// (avoids repeated .NET runtime startup and JIT compilation when processing many domains).
+    ///
+    /// Protocol (one line per message, fields separated by TAB):
+    ///     worker -> client:  READY  VERSION         (after startup)
+    ///     client -> worker:  STDOUT_FILE  STDERR_FILE  ARG1  ARG2 ...
+    ///     worker -> client:  EXIT  EXIT_CODE       (after finishing the request)
+    /// Output of each request is appended to STDOUT_FILE and STDERR_FILE.
+    /// The worker finishes when its standard input is closed.
+    /// Errors which would terminate a normal run (ExitException) are reported as the exit code of the request.
+    /// If the worker process dies during a request (e.g. fatal runtime error), the client is expected to restart it.
+    /// </summary>
+    static class WorkerMode {
+        public const string WORKER_OPTION = "--worker";
+        public const string READY_MESSAGE = "READY";
+        public const string EXIT_MESSAGE = "EXIT";
+        public const char SEPARATOR = '\t';
+
+        public static int Main_Worker() {
+            TextWriter protocolOut = Console.Out;
+            TextWriter originalErr = Console.Error;
+            protocolOut.WriteLine($"{READY_MESSAGE}{SEPARATOR}{Setting.VERSION}");
+            protocolOut.Flush();
+            string line;
+            while ((line = Console.In.ReadLine()) != null) {
+                if (line.Trim() == "") {
+                    continue;
+                }
+                string[] fields = line.Split(SEPARATOR);
+                if (fields.Length < 2) {
+                    protocolOut.WriteLine($"{EXIT_MESSAGE}{SEPARATOR}-1");
+                    protocolOut.Flush();
+                    continue;
+                }
+                string[] args = fields.Skip(2).ToArray();
+                int exitCode;
+                using (StreamWriter stdout = new StreamWriter(fields[0], append: true) { AutoFlush = true })
+                using (StreamWriter stderr = new StreamWriter(fields[1], append: true) { AutoFlush = true }) {
+                    Console.SetOut(stdout);
+                    Console.SetError(stderr);
+                    ResetStaticState();
+                    try {
+                        exitCode = MainClass.Main_SecStrAnnot1(args);
+                    } catch (ExitException e) {
+                        exitCode = e.ExitCode;
+                    } catch (Exception e) {
+                        Console.Error.WriteLine(e);
+                        exitCode = -1;
+                    } finally {
+                        Console.SetOut(protocolOut);
+                        Console.SetError(originalErr);
+                    }
+                }
+                protocolOut.WriteLine($"{EXIT_MESSAGE}{SEPARATOR}{exitCode}");
+                protocolOut.Flush();
+            }
+            return 0;
+        }
+
+        /// <summary> Reset static settings and one-time warning flags, so that each request behaves like a separate run. </summary>
+        private static void ResetStaticState() {
+            Lib.DoWriteDebug = false;
+            Setting.IgnoreInsertions = false;
+            Setting.IgnoreInsertionsWarningThrown = false;
+            Protein.alternativeLocationWarningPrinted = false;
+            LibAnnotation.alternativeLocationWarningPrinted = false;
+        }
+    }
+}
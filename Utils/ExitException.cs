@@ -0,0 +1,15 @@
+using System;
+
+namespace SecStrAnnotator2.Utils
+{
+    /// <summary> Thrown instead of calling Environment.Exit, so that the program can finish with the given exit code
+    /// (in worker mode, the exit code is reported for the current request and the worker continues). </summary>
+    public class ExitException : Exception
+    {
+        public int ExitCode { get; private set; }
+        public ExitException(int exitCode) : base($"Exit with code {exitCode}")
+        {
+            ExitCode = exitCode;
+        }
+    }
+}
@@ -53,7 +53,7 @@ namespace SecStrAnnotator2.Utils
         public static void WriteErrorAndExit(String s, params object[] args)
         {
             WriteError(s, args);
-            Environment.Exit(-1);
+            throw new ExitException(-1);
         }
 
         public static void WriteWarning(String s, params object[] args)
@@ -122,7 +122,7 @@ namespace SecStrAnnotator2.Utils
                     Console.WriteLine(OPTION_HELP_INDENT + help);
                 }
             }
-            Environment.Exit(0);
+            throw new ExitException(0);
         }
 
         public static void PrintError(String message, params object[] args)
@@ -13,7 +13,7 @@ Example usage:
 '''
 
 import argparse
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import os
 from os import path
 import shutil
@@ -22,6 +22,7 @@ from collections import namedtuple
 import glob
 
 import lib
+import rest_client
 from lib import RedirectIO
 import SecStrAnnotator_batch
 from secstrapi_data_preparation import domains_from_pdbeapi
@@ -59,6 +60,13 @@ Settings = namedtuple('Settings', [
     ])
 
 CHECKPOINT_FILE = 'checkpoints.txt'
+PROFILE_FILE = 'pipeline_profile.json'
+CPROFILE_DIR = 'pipeline_cprofile'
+REST_CACHE_DIR = 'rest_cache'
+DEFAULT_REST_CACHE_TTL = 24  # hours
+STRUCTURE_FILE_PATTERNS = ['[0-9]???.cif', '[0-9]???.cif.gz']  # structures downloaded from PDBe (PDB ID + extension)
+LABEL2AUTH_FILE_PATTERN = '*.label2auth.tsv'
+ANNOTATION_FILE_PATTERNS = ['*-annotated.sses.json', '*-alignment.json', LABEL2AUTH_FILE_PATTERN]  # results of SecStrAnnotator used by the following tasks
 
 #  MAIN  #####################################################################################
 
@@ -66,12 +74,22 @@ def parse_args() -> Dict[str, Any]:
     '''Parse command line arguments.'''
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('settings_file', help='JSON file with settings', type=str)
-    parser.add_argument('--resume', help=f'Read checkpoints from {CHECKPOINT_FILE} and continue the pipeline from the last completed task', action='store_true')
+    parser.add_argument('--resume', help=f'Read checkpoints from {CHECKPOINT_FILE} and continue the pipeline, repeat only tasks which have not been completed or whose inputs changed', action='store_true')
+    parser.add_argument('--cache', help='Directory for caching task outputs (tasks with unchanged inputs are restored from the cache instead of running again)', type=str, default=None)
+    parser.add_argument('--profile', help=f'Measure resources used by each task (time, memory, I/O, HTTP requests), write them into {PROFILE_FILE} and print a summary', action='store_true')
+    parser.add_argument('--cprofile', help=f'Dump cProfile statistics of each task into {CPROFILE_DIR}/', action='store_true')
+    parser.add_argument('--rest_cache_ttl', help=f'Reuse responses from REST APIs cached in {REST_CACHE_DIR}/ if they are not older than this (in hours, default: {DEFAULT_REST_CACHE_TTL}, 0 = do not cache)', type=float, default=DEFAULT_REST_CACHE_TTL)
+    parser.add_argument('--rest_batch_size', help=f'Maximum number of IDs requested from PDBe API in one batch request (default: {rest_client.DEFAULT_BATCH_SIZE}, 1 = no batching)', type=int, default=rest_client.DEFAULT_BATCH_SIZE)
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument('--record', help='Record all HTTP and FTP responses into this archive file (for offline replay)', type=str, default=None)
+    archive_group.add_argument('--replay', help='Take all HTTP and FTP responses from this archive file (recorded by --record), do not access network', type=str, default=None)
+    parser.add_argument('--processes', help='Number of processes for running independent tasks in parallel (default: 1, i.e. run tasks one by one)', type=int, default=1)
     args = parser.parse_args()
     return vars(args)
 
 
-def main(settings_file: str, resume: bool = False) -> None:
+def main(settings_file: str, resume: bool = False, processes: int = 1, cache: Optional[str] = None, profile: bool = False, cprofile: bool = False, 
+        rest_cache_ttl: float = DEFAULT_REST_CACHE_TTL, rest_batch_size: int = rest_client.DEFAULT_BATCH_SIZE, record: Optional[str] = None, replay: Optional[str] = None) -> None:
     '''Run the full pipeline for secondary structure annotation of a protein family'''
     
     with open(settings_file, 'r', encoding=lib.DEFAULT_ENCODING) as f:
@@ -83,95 +101,120 @@ def main(settings_file: str, resume: bool = False) -> None:
     else:
         secstrannotator_dll = path.join(path.dirname(path.abspath(__file__)), '..', 'SecStrAnnotator.dll')
 
+    if cache is not None:
+        cache = path.abspath(cache)
+    archive = path.abspath(record or replay) if record or replay else None
+    archive_mode = rest_client.RECORD if record else rest_client.REPLAY if replay else None
     print(f'Results will be in {settings.data_dir}')
     os.makedirs(settings.data_dir, exist_ok=True)
     os.chdir(settings.data_dir)
+    rest_client.configure(cache_dir=REST_CACHE_DIR if rest_cache_ttl > 0 else None, cache_ttl=rest_cache_ttl * 3600, batch_size=rest_batch_size, 
+        archive=archive, archive_mode=archive_mode)
     os.makedirs('structures', exist_ok=True)
     template_id = settings.template_domain.split(',')[0]
-    shutil.copy(settings.template_annotation_file, path.join('structures', f'template_{template_id}-template.sses.json'))
-    shutil.copy(settings.template_structure_file, path.join('structures', f'template_{template_id}.cif'))
+    template_files = [path.join('structures', f'template_{template_id}-template.sses.json'), path.join('structures', f'template_{template_id}.cif')]
+    shutil.copy(settings.template_annotation_file, template_files[0])
+    shutil.copy(settings.template_structure_file, template_files[1])
     
-    pipeline = lib.Pipeline(checkpoint_file=CHECKPOINT_FILE)
+    pipeline = lib.Pipeline(checkpoint_file=CHECKPOINT_FILE, n_processes=processes, cache_dir=cache, 
+        profile_file=PROFILE_FILE if profile else None, cprofile_dir=CPROFILE_DIR if cprofile else None)
 
     # Get domains from CATH and Pfam
-    pipeline.add_task(None, print, '\n=== Get domains from CATH and Pfam ===')
-    pipeline.add_task('get domains - CATH', domains_from_pdbeapi.main, settings.cath_family_id, join_domains_in_chain=True, stdout='set_cath.simple.json')
-    pipeline.add_task('get domains - Pfam', domains_from_pdbeapi.main, settings.pfam_family_id, join_domains_in_chain=True, stdout='set_pfam.simple.json')
+    pipeline.add_task('get domains - CATH', domains_from_pdbeapi.main, settings.cath_family_id, join_domains_in_chain=True, stdout='set_cath.simple.json', inputs=[], external=True,
+        pre_message='\n=== Get domains from CATH and Pfam ===')
+    pipeline.add_task('get domains - Pfam', domains_from_pdbeapi.main, settings.pfam_family_id, join_domains_in_chain=True, stdout='set_pfam.simple.json', inputs=[], external=True)
 
     # Merge domain lists and format them in SecStrAPI format (also adds UniProt refs)
-    pipeline.add_task(None, print, '\n=== Merge domain lists and format them in SecStrAPI format (also adds UniProt refs) ===')
     pipeline.add_task('merge domain lists', domain_lists_to_SecStrAPI_format.main,
         ['CATH', settings.cath_family_id, 'set_cath.simple.json', 'Pfam', settings.pfam_family_id, 'set_pfam.simple.json'],
         api_version=settings.api_version,
-        stdout='set_ALL.json')
+        stdout='set_ALL.json', inputs=['set_cath.simple.json', 'set_pfam.simple.json'], external=True,
+        pre_message='\n=== Merge domain lists and format them in SecStrAPI format (also adds UniProt refs) ===')
 
     # Get NCBI taxons and groups (Euka/Bact/Arch/Viru)
-    pipeline.add_task(None, print, '\n=== Get NCBI taxons and groups (Euka/Bact/Arch/Viru) ===')
-    pipeline.add_task('download NCBI taxonomy', lib.get_from_ftp, 'ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz', 'taxdump.tar.gz')
-    pipeline.add_task('unzip NCBI taxonomy', lib.extract_from_tar, 'taxdump.tar.gz', 'nodes.dmp', 'ncbi_taxonomy_nodes.dmp')
-    pipeline.add_task('get taxids for Set-ALL', get_taxids.main, 'set_ALL.json', stdout='domains_taxons.tsv')
-    pipeline.add_task('classify domains by superkingdom', classify_taxids.main, 'ncbi_taxonomy_nodes.dmp', 'domains_taxons.tsv', stdout='domains_taxons_groups.tsv')
+    pipeline.add_task('download NCBI taxonomy', lib.get_from_ftp, 'ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz', 'taxdump.tar.gz', inputs=[], outputs=['taxdump.tar.gz'], external=True,
+        pre_message='\n=== Get NCBI taxons and groups (Euka/Bact/Arch/Viru) ===')
+    pipeline.add_task('unzip NCBI taxonomy', lib.extract_from_tar, 'taxdump.tar.gz', 'nodes.dmp', 'ncbi_taxonomy_nodes.dmp', inputs=['taxdump.tar.gz'], outputs=['ncbi_taxonomy_nodes.dmp'])
+    pipeline.add_task('get taxids for Set-ALL', get_taxids.main, 'set_ALL.json', stdout='domains_taxons.tsv', inputs=['set_ALL.json'], external=True)
+    pipeline.add_task('classify domains by superkingdom', classify_taxids.main, 'ncbi_taxonomy_nodes.dmp', 'domains_taxons.tsv', stdout='domains_taxons_groups.tsv', inputs=['ncbi_taxonomy_nodes.dmp', 'domains_taxons.tsv'])
 
     # Select nonredundant set (with best quality)
-    pipeline.add_task(None, print, '\n=== Select nonredundant set (with best quality) ===')
-    pipeline.add_task('select Set-NR', select_best_domain_per_uniprot.main, 'set_ALL.json', stdout='set_NR.json')
-    pipeline.add_task('select Set-NR-Bact', select_by_taxon_group.main, 'set_NR.json', 'domains_taxons_groups.tsv', 'Bact', stdout='set_NR_Bact.json')
-    pipeline.add_task('select Set-NR-Euka', select_by_taxon_group.main, 'set_NR.json', 'domains_taxons_groups.tsv', 'Euka', stdout='set_NR_Euka.json')
+    pipeline.add_task('select Set-NR', select_best_domain_per_uniprot.main, 'set_ALL.json', stdout='set_NR.json', inputs=['set_ALL.json'], external=True,
+        pre_message='\n=== Select nonredundant set (with best quality) ===')
+    pipeline.add_task('select Set-NR-Bact', select_by_taxon_group.main, 'set_NR.json', 'domains_taxons_groups.tsv', 'Bact', stdout='set_NR_Bact.json', inputs=['set_NR.json', 'domains_taxons_groups.tsv'])
+    pipeline.add_task('select Set-NR-Euka', select_by_taxon_group.main, 'set_NR.json', 'domains_taxons_groups.tsv', 'Euka', stdout='set_NR_Euka.json', inputs=['set_NR.json', 'domains_taxons_groups.tsv'])
 
     # Simplify domain lists (for SecStrAnnotator)
-    pipeline.add_task(None, print, '\n=== Simplify domain lists (for SecStrAnnotator) ===')
-    pipeline.add_task('simplify domain list - Set-ALL', simplify_domain_list.main, 'set_ALL.json', stdout='set_ALL.simple.json')
-    pipeline.add_task('simplify domain list Set-NR', simplify_domain_list.main, 'set_NR.json', stdout='set_NR.simple.json')
-    pipeline.add_task('create domain list for SecStrAPI', extract_pdb_domain_list.main, 'set_ALL.json', stdout='AnnotationList.json')
+    pipeline.add_task('simplify domain list - Set-ALL', simplify_domain_list.main, 'set_ALL.json', stdout='set_ALL.simple.json', inputs=['set_ALL.json'],
+        pre_message='\n=== Simplify domain lists (for SecStrAnnotator) ===')
+    pipeline.add_task('simplify domain list Set-NR', simplify_domain_list.main, 'set_NR.json', stdout='set_NR.simple.json', inputs=['set_NR.json'])
+    pipeline.add_task('create domain list for SecStrAPI', extract_pdb_domain_list.main, 'set_ALL.json', stdout='AnnotationList.json', inputs=['set_ALL.json'])
 
     # Download CIF files
-    pipeline.add_task(None, print, '\n=== Download CIF files ===')
-    pipeline.add_task('download CIF files', download_from_pdbe.main, 'set_ALL.simple.json', 'structures', structure_format='cif', no_gzip=True, cache=settings.structure_cache_dir)
+    pipeline.add_task('download CIF files', download_from_pdbe.main, 'set_ALL.simple.json', 'structures', structure_format='cif', no_gzip=True, keep_gzip=True, cache=settings.structure_cache_dir, 
+        inputs=['set_ALL.simple.json'], outputs=['structures'] + ([settings.structure_cache_dir] if settings.structure_cache_dir is not None else []), external=True,
+        pre_message='\n=== Download CIF files ===')
 
     # Annotate
-    pipeline.add_task(None, print, '\n=== Annotate ===')
     pipeline.add_task('run SecStrAnnotator', SecStrAnnotator_batch.main, 'structures', f'template_{settings.template_domain}', 'set_ALL.simple.json', 
-        threads=int(settings.n_threads), dll=secstrannotator_dll, options=settings.secstrannotator_options)
+        threads=int(settings.n_threads), dll=secstrannotator_dll, options=settings.secstrannotator_options, 
+        inputs=['set_ALL.simple.json', secstrannotator_dll, *template_files, *( path.join('structures', pattern) for pattern in STRUCTURE_FILE_PATTERNS )], 
+        outputs=[ path.join('structures', pattern) for pattern in ANNOTATION_FILE_PATTERNS ],
+        pre_message='\n=== Annotate ===')
     pipeline.add_task('remove accidentally downloaded files', lambda: [os.remove(filename) for filename in glob.glob('*.cif')])  # Remove files accidentally downloaded by PyMOL
 
     # Collect annotations and put them to SecStrAPI format
-    pipeline.add_task(None, print, '\n=== Collect annotations and put them to SecStrAPI format ===')
-    pipeline.add_task('collect annotations into annotations_ALL.json', collect_annotations.main, 'set_ALL.json', 'structures', stdout='annotations_ALL.json')
-    pipeline.add_task('collect annotations into annotations_NR.json', collect_annotations.main, 'set_NR.json', 'structures', stdout='annotations_NR.json')
-    pipeline.add_task('collect annotations into annotations_NR_Bact.json', collect_annotations.main, 'set_NR_Bact.json', 'structures', stdout='annotations_NR_Bact.json')
-    pipeline.add_task('collect annotations into annotations_NR_Euka.json', collect_annotations.main, 'set_NR_Euka.json', 'structures', stdout='annotations_NR_Euka.json')
-    pipeline.add_task('extract sequences - Set-ALL', extract_sequences.main, 'annotations_ALL.json', 'sequences_ALL')
-    pipeline.add_task('extract sequences - Set-NR', extract_sequences.main, 'annotations_NR.json', 'sequences_NR')
-    pipeline.add_task('extract sequences - Set-NR-Bact', extract_sequences.main, 'annotations_NR_Bact.json', 'sequences_NR_Bact')
-    pipeline.add_task('extract sequences - Set-NR-Euka', extract_sequences.main, 'annotations_NR_Euka.json', 'sequences_NR_Euka')
+    annotation_files = [ path.join('structures', pattern) for pattern in ANNOTATION_FILE_PATTERNS ]  # not the whole directory, hashing all structures would be slow
+    pipeline.add_task('collect annotations into annotations_ALL.json', collect_annotations.main, 'set_ALL.json', 'structures', stdout='annotations_ALL.json', inputs=['set_ALL.json', *annotation_files],
+        pre_message='\n=== Collect annotations and put them to SecStrAPI format ===')
+    pipeline.add_task('collect annotations into annotations_NR.json', collect_annotations.main, 'set_NR.json', 'structures', stdout='annotations_NR.json', inputs=['set_NR.json', *annotation_files])
+    pipeline.add_task('collect annotations into annotations_NR_Bact.json', collect_annotations.main, 'set_NR_Bact.json', 'structures', stdout='annotations_NR_Bact.json', inputs=['set_NR_Bact.json', *annotation_files])
+    pipeline.add_task('collect annotations into annotations_NR_Euka.json', collect_annotations.main, 'set_NR_Euka.json', 'structures', stdout='annotations_NR_Euka.json', inputs=['set_NR_Euka.json', *annotation_files])
+    pipeline.add_task('extract sequences - Set-ALL', extract_sequences.main, 'annotations_ALL.json', 'sequences_ALL', inputs=['annotations_ALL.json'], outputs=['sequences_ALL'])
+    pipeline.add_task('extract sequences - Set-NR', extract_sequences.main, 'annotations_NR.json', 'sequences_NR', inputs=['annotations_NR.json'], outputs=['sequences_NR'])
+    pipeline.add_task('extract sequences - Set-NR-Bact', extract_sequences.main, 'annotations_NR_Bact.json', 'sequences_NR_Bact', inputs=['annotations_NR_Bact.json'], outputs=['sequences_NR_Bact'])
+    pipeline.add_task('extract sequences - Set-NR-Euka', extract_sequences.main, 'annotations_NR_Euka.json', 'sequences_NR_Euka', inputs=['annotations_NR_Euka.json'], outputs=['sequences_NR_Euka'])
 
     # Perform no-gap sequence alignment and create sequence logos (from Set-NR)
-    pipeline.add_task(None, print, '\n=== Perform no-gap sequence alignment and create sequence logos (from Set-NR) ===')
-    pipeline.add_task('align sequences - Set-NR', align_sequences.main, 'annotations_NR.json', alignments_dir='aligments_NR', trees_dir='trees_NR', logos_dir='logos_NR', matrices_dir='alignment_matrices_NR', labels_for_matrices=settings.sses_for_generic_numbering, stdout='logo_statistics_NR.tsv')
-    pipeline.add_task('copy matrix file', shutil.copy, path.join('alignment_matrices_NR', 'ALL.json'), 'alignment_matrices_NR.json')
-    pipeline.add_task('align sequences - Set-NR-Bact', align_sequences.main, 'annotations_NR_Bact.json', alignments_dir='aligments_NR_Bact', trees_dir='trees_NR_Bact', logos_dir='logos_NR_Bact', stdout='logo_statistics_NR_Bact.tsv')
-    pipeline.add_task('align sequences - Set-NR-Euka', align_sequences.main, 'annotations_NR_Euka.json', alignments_dir='aligments_NR_Euka', trees_dir='trees_NR_Euka', logos_dir='logos_NR_Euka', stdout='logo_statistics_NR_Euka.tsv')
+    n_alignment_tasks = 3  # independent tasks, they may run concurrently and then share n_threads
+    alignment_processes = max(1, int(settings.n_threads) // min(n_alignment_tasks, max(processes, 1)))
+    pipeline.add_task('align sequences - Set-NR', align_sequences.main, 'annotations_NR.json', alignments_dir='aligments_NR', trees_dir='trees_NR', logos_dir='logos_NR', matrices_dir='alignment_matrices_NR', labels_for_matrices=settings.sses_for_generic_numbering, processes=alignment_processes, stdout='logo_statistics_NR.tsv', 
+        inputs=['annotations_NR.json'], outputs=['aligments_NR', 'trees_NR', 'logos_NR', 'alignment_matrices_NR'],
+        pre_message='\n=== Perform no-gap sequence alignment and create sequence logos (from Set-NR) ===')
+    pipeline.add_task('copy matrix file', shutil.copy, path.join('alignment_matrices_NR', 'ALL.json'), 'alignment_matrices_NR.json', inputs=[path.join('alignment_matrices_NR', 'ALL.json')], outputs=['alignment_matrices_NR.json'])
+    pipeline.add_task('align sequences - Set-NR-Bact', align_sequences.main, 'annotations_NR_Bact.json', alignments_dir='aligments_NR_Bact', trees_dir='trees_NR_Bact', logos_dir='logos_NR_Bact', processes=alignment_processes, stdout='logo_statistics_NR_Bact.tsv', 
+        inputs=['annotations_NR_Bact.json'], outputs=['aligments_NR_Bact', 'trees_NR_Bact', 'logos_NR_Bact'])
+    pipeline.add_task('align sequences - Set-NR-Euka', align_sequences.main, 'annotations_NR_Euka.json', alignments_dir='aligments_NR_Euka', trees_dir='trees_NR_Euka', logos_dir='logos_NR_Euka', processes=alignment_processes, stdout='logo_statistics_NR_Euka.tsv', 
+        inputs=['annotations_NR_Euka.json'], outputs=['aligments_NR_Euka', 'trees_NR_Euka', 'logos_NR_Euka'])
 
     # Realign sequences from Set-ALL to the alignment from Set-NR and add reference residue information
-    pipeline.add_task(None, print, '\n=== Realign sequences from Set-ALL to the alignment from Set-NR and add reference residue information ===')
-    pipeline.add_task('add reference residues - Set-NR', add_reference_residues.main, 'annotations_NR.json', 'aligments_NR', labels=settings.sses_for_generic_numbering, label2auth_dir='structures', stdout='annotations_with_reference_residues_NR.json')
-    pipeline.add_task('add reference residues - Set-ALL', add_reference_residues.main, 'annotations_ALL.json', 'aligments_NR', labels=settings.sses_for_generic_numbering, label2auth_dir='structures', stdout='annotations_with_reference_residues_ALL.json')
+    pipeline.add_task('add reference residues - Set-NR', add_reference_residues.main, 'annotations_NR.json', 'aligments_NR', labels=settings.sses_for_generic_numbering, label2auth_dir='structures', stdout='annotations_with_reference_residues_NR.json', 
+        inputs=['annotations_NR.json', 'aligments_NR', path.join('structures', LABEL2AUTH_FILE_PATTERN)],
+        pre_message='\n=== Realign sequences from Set-ALL to the alignment from Set-NR and add reference residue information ===')
+    pipeline.add_task('add reference residues - Set-ALL', add_reference_residues.main, 'annotations_ALL.json', 'aligments_NR', labels=settings.sses_for_generic_numbering, label2auth_dir='structures', stdout='annotations_with_reference_residues_ALL.json', 
+        inputs=['annotations_ALL.json', 'aligments_NR', path.join('structures', LABEL2AUTH_FILE_PATTERN)])
 
     # Divide annotations into per-PDB files
-    pipeline.add_task(None, print, '\n=== Divide annotations into per-PDB files ===')
-    pipeline.add_task('remove unnecessary fields from annotations', select_sse_fields.main, 'annotations_with_reference_residues_ALL.json', stdout='annotations_with_reference_residues_ALL-selected_fields.json')
-    pipeline.add_task('divide annotations 1-PDB-per-file', divide_annotations_by_pdb.main, 'annotations_with_reference_residues_ALL-selected_fields.json', 'annotations_ALL', min_dir='annotations_ALL_min')
+    pipeline.add_task('remove unnecessary fields from annotations', select_sse_fields.main, 'annotations_with_reference_residues_ALL.json', stdout='annotations_with_reference_residues_ALL-selected_fields.json', 
+        inputs=['annotations_with_reference_residues_ALL.json'],
+        pre_message='\n=== Divide annotations into per-PDB files ===')
+    pipeline.add_task('divide annotations 1-PDB-per-file', divide_annotations_by_pdb.main, 'annotations_with_reference_residues_ALL-selected_fields.json', 'annotations_ALL', min_dir='annotations_ALL_min', 
+        inputs=['annotations_with_reference_residues_ALL-selected_fields.json'], outputs=['annotations_ALL', 'annotations_ALL_min'])
 
     # Prepare TSV tables for analyses
-    pipeline.add_task(None, print, '\n=== Prepare TSV tables for analyses ===')
-    pipeline.add_task('create TSV table with annotations - Set-NR', annotation_json_to_tsv.main, 'annotations_with_reference_residues_NR.json', add_missing_sses=True, stdout='annotations_with_reference_residues_NR.tsv')
-    pipeline.add_task('create TSV table with annotations - Set-ALL', annotation_json_to_tsv.main, 'annotations_with_reference_residues_ALL.json', add_missing_sses=True, stdout='annotations_with_reference_residues_ALL.tsv')
-    pipeline.add_task('create TSV table with beta-bulges - Set-NR', annotation_json_to_bulges_tsv.main, 'annotations_with_reference_residues_NR.json', stdout='beta_bulges_NR.tsv')
-    pipeline.add_task('create TSV table with beta-bulges - Set-ALL', annotation_json_to_bulges_tsv.main, 'annotations_with_reference_residues_ALL.json', stdout='beta_bulges_ALL.tsv')
+    pipeline.add_task('create TSV table with annotations - Set-NR', annotation_json_to_tsv.main, 'annotations_with_reference_residues_NR.json', add_missing_sses=True, stdout='annotations_with_reference_residues_NR.tsv', 
+        inputs=['annotations_with_reference_residues_NR.json'],
+        pre_message='\n=== Prepare TSV tables for analyses ===')
+    pipeline.add_task('create TSV table with annotations - Set-ALL', annotation_json_to_tsv.main, 'annotations_with_reference_residues_ALL.json', add_missing_sses=True, stdout='annotations_with_reference_residues_ALL.tsv', 
+        inputs=['annotations_with_reference_residues_ALL.json'])
+    pipeline.add_task('create TSV table with beta-bulges - Set-NR', annotation_json_to_bulges_tsv.main, 'annotations_with_reference_residues_NR.json', stdout='beta_bulges_NR.tsv', 
+        inputs=['annotations_with_reference_residues_NR.json'])
+    pipeline.add_task('create TSV table with beta-bulges - Set-ALL', annotation_json_to_bulges_tsv.main, 'annotations_with_reference_residues_ALL.json', stdout='beta_bulges_ALL.tsv', 
+        inputs=['annotations_with_reference_residues_ALL.json'])
 
     # Get full sequences
-    pipeline.add_task(None, print, '\n=== Get full sequences ===')
-    pipeline.add_task('get full FASTA sequences', get_full_sequences.main, 'set_NR.json', stdout='set_NR.fasta')
+    pipeline.add_task('get full FASTA sequences', get_full_sequences.main, 'set_NR.json', stdout='set_NR.fasta', inputs=['set_NR.json'], external=True,
+        pre_message='\n=== Get full sequences ===')
 
     if resume:
         print('\nResuming pipeline')
@@ -7,20 +7,68 @@ Example usage:
 '''
 
 import argparse
-from typing import Dict, Any, Optional, Union, List
+from typing import Dict, Any, Optional, Union, List, Tuple
 import json
+import re
+import hashlib
+import heapq
+import glob
 import os
 from os import path
 import shutil
+import gzip
 import sys
-from collections import OrderedDict
+import signal
+from collections import OrderedDict, namedtuple
+import copy
 import queue
 import threading
 import subprocess
+import tempfile
+import traceback
+import time
+import socket
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows, memory limit cannot be used
 
 #  CONSTANTS  ################################################################################
 
 DEFAULT_SECSTRANNOTATOR_DLL = path.join(path.dirname(__file__), 'SecStrAnnotator.dll')
+WORKER_OPTION = '--worker'
+WORKER_READY_MESSAGE = 'READY'
+WORKER_EXIT_MESSAGE = 'EXIT'
+WORKER_SEPARATOR = '\t'
+WORKER_STOP_TIMEOUT = 10  # seconds
+JOB_COST_OVERHEAD = 1_000_000  # estimated fixed cost of running SecStrAnnotator on one domain, in bytes of input CIF file
+GZIP_EXT = '.gz'
+SCRATCH_DIR_CANDIDATES = ('/dev/shm',)  # tmpfs for decompressed inputs and worker output, if available (otherwise the system temporary directory)
+GZIP_SIZE_FACTOR = 6  # approximate compression ratio of gzipped CIF files (for job cost estimation)
+MANIFEST_FILE = 'batch_manifest.jsonl'
+MANIFEST_KEYS = ('query', 'input_hash', 'template_hash', 'options', 'dll_hash')  # a domain must be re-annotated if any of these changes
+HASH_CHUNK_SIZE = 1 << 20
+METRICS_FILE = 'batch_metrics.tsv'
+ALL_ANNOTATIONS_FILE = 'all_annotations.sses.json'
+JOB_TIMINGS_FILE = 'job_timings.tsv'
+STDOUT_FILE = 'stdout.txt'
+STDERR_FILE = 'stderr.txt'
+SPOOL_FILE_PATTERN = 'all_annotations_thread_{}.jsonl'
+SHARD_DONE_FILE = 'done'
+SHARD_MERGE_LOCK_FILE = 'shard_merge.lock'
+SHARD_MERGE_LOCK_POLL_INTERVAL = 1.0  # seconds
+SHARD_MERGE_LOCK_STALE_TIME = 3600  # seconds, a lock held by a process on another host is considered left from a killed merge after this time
+METRICS_COLUMNS = ('domain', 'pdb', 'attempt', 'status', 'exit_code', 'wall_time', 'cpu_time', 'peak_rss_kb', 'input_size', 'n_residues')
+METRICS_PERCENTILES = (50, 90, 99, 100)
+METRICS_N_SLOWEST = 10
+OUT_OF_MEMORY_MARKERS = (b'OutOfMemoryException', b'0x8007000E', b'Out of memory')  # 0x8007000E = E_OUTOFMEMORY (e.g. CoreCLR cannot start)
+DEFAULT_RETRY_OPTIONS = '--soft'
+CIF_TOKEN_REGEX = re.compile(r"""'[^']*'|"[^"]*"|\S+""")
+POLY_SEQ_SCHEME = '_pdbx_poly_seq_scheme'
+AUTH_FIELDS = (('start', 'auth_start', 'auth_start_ins_code'), ('end', 'auth_end', 'auth_end_ins_code'))
+CHAIN_SPECIFIC_FIELDS = ('rotation_matrix', 'total_metric_value')  # annotation fields which are not valid for a projected annotation
+CHAIN_SPECIFIC_SSE_FIELDS = ('start_vector', 'end_vector', 'minor_axis', 'metric_value')  # geometry of the source chain
+METRIC_COMMENT_SEPARATOR = ' Total value of used metric:'
 
 #  FUNCTIONS  ################################################################################
 
@@ -35,10 +83,23 @@ def try_rename_file(source, dest):
         pass
 
 def copy_file(source, dest, append=False):
-    with open(source, 'r') as r:
-        with open(dest, 'a' if append else 'w') as w:
-            for line in iter(r.readline, ''):
-                w.write(line)
+    with open(source, 'rb') as r:
+        with open(dest, 'ab' if append else 'wb') as w:
+            shutil.copyfileobj(r, w)
+
+def read_and_clear_file(filename) -> bytes:
+    with open(filename, 'rb') as r:
+        content = r.read()
+    clear_file(filename)
+    return content
+
+def decompress_file(gz_file: str, output_file: str) -> None:
+    '''Decompress gzipped file into output_file by streaming (the file is written atomically).'''
+    tmp_file = f'{output_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with gzip.open(gz_file, 'rb') as r:
+        with open(tmp_file, 'wb') as w:
+            shutil.copyfileobj(r, w, HASH_CHUNK_SIZE)
+    os.replace(tmp_file, output_file)
 
 def remove_file(filename):
     try:
@@ -46,6 +107,12 @@ def remove_file(filename):
     except FileNotFoundError:
         pass
 
+def list_files(directory: str) -> Dict[str, os.DirEntry]:
+    '''List regular files in directory (one directory scan instead of a metadata call per file). 
+    Return dictionary {filename: DirEntry}, DirEntry caches the result of stat().'''
+    with os.scandir(directory) as entries:
+        return { entry.name: entry for entry in entries if entry.is_file() }
+
 def try_read_json(filename):
     with open(filename) as f:
         try:
@@ -54,6 +121,300 @@ def try_read_json(filename):
             raise Exception(f'File "{filename}" is not a valid JSON file ({e}) \n')
     return result
 
+def file_hash(filename: str) -> str:
+    '''Compute SHA-256 hash of the file content.'''
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as r:
+        for chunk in iter(lambda: r.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def read_manifest(filename: str) -> Dict[str, dict]:
+    '''Read batch manifest (JSON Lines with one record per line), return the last record for each domain.'''
+    records = {}
+    try:
+        with open(filename) as r:
+            for line in r:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # incomplete line, the run was probably killed while writing it
+                records[record['domain']] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+def write_manifest(filename: str, records: Dict[str, dict]) -> None:
+    '''Rewrite batch manifest so that it contains only the given records (atomically).'''
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as w:
+        for domain in sorted(records):
+            w.write(json.dumps(records[domain]) + '\n')
+    os.replace(tmp_file, filename)
+
+def sort_spool(filename: str) -> None:
+    '''Sort a spool file (JSON Lines with records [key, value]) by key. Only keys and line offsets are kept in memory.'''
+    index = []
+    offset = 0
+    with open(filename, 'rb') as r:
+        for line in r:
+            key = json.loads(line)[0]
+            index.append((key, offset, len(line)))
+            offset += len(line)
+    index.sort()
+    tmp_file = filename + '.tmp'
+    with open(filename, 'rb') as r:
+        with open(tmp_file, 'wb') as w:
+            for key, offset, length in index:
+                r.seek(offset)
+                w.write(r.read(length))
+    os.replace(tmp_file, filename)
+
+def iterate_spool(filename: str):
+    '''Iterate over records (key, value) in a spool file.'''
+    with open(filename) as r:
+        for line in r:
+            key, value = json.loads(line, object_pairs_hook=OrderedDict)
+            yield key, value
+
+def merge_spools(spool_files: List[str], output_file: str) -> None:
+    '''Merge sorted spool files into one JSON object {key: value} in output_file, formatted as by json.dump(..., indent=4).
+    Only one record per spool file is kept in memory. Records with duplicate keys are skipped.'''
+    records = heapq.merge(*(iterate_spool(spool_file) for spool_file in spool_files), key=lambda record: record[0])
+    with open(output_file, 'w') as w:
+        w.write('{')
+        last_key = None
+        for key, value in records:
+            if key == last_key:
+                continue
+            w.write(',' if last_key is not None else '')
+            w.write('\n    ' + json.dumps(key) + ': ' + json.dumps(value, indent=4).replace('\n', '\n    '))
+            last_key = key
+        w.write('\n}' if last_key is not None else '}')
+
+def tokenize_cif_line(line: str) -> List[str]:
+    return [ token[1:-1] if token[0] in '\'"' else token for token in CIF_TOKEN_REGEX.findall(line) ]
+
+def read_cif_category(filename: str, category: str) -> List[Dict[str, str]]:
+    '''Read a category (e.g. _pdbx_poly_seq_scheme) from an mmCIF file, return its rows as dictionaries.
+    This is a simple reader, which does not support multi-line (semicolon-delimited) values.'''
+    prefix = category + '.'
+    fields = []
+    values = []
+    in_loop = False
+    in_category = False
+    with open(filename) as r:
+        for line in r:
+            if line.startswith('loop_'):
+                if in_category:
+                    break
+                in_loop = True
+            elif line.startswith('_'):
+                tokens = tokenize_cif_line(line)
+                if len(tokens) > 1:
+                    in_loop = False  # single-value item
+                if tokens[0].startswith(prefix):
+                    in_category = True
+                    fields.append(tokens[0][len(prefix):])
+                    values.extend(tokens[1:])
+                elif in_category:
+                    break
+            elif in_category:
+                if line.startswith('#'):
+                    break
+                values.extend(tokenize_cif_line(line))
+    n_fields = len(fields)
+    return [ dict(zip(fields, values[i:i+n_fields])) for i in range(0, len(values), n_fields) ]
+
+def parse_ranges(ranges: str) -> List[Tuple[Optional[int], Optional[int]]]:
+    '''Parse residue ranges in SecStrAnnotator format (e.g. '28:' or '123:182,255:261'), None means an open end.'''
+    result = []
+    for subrange in ranges.split(','):
+        start, end = subrange.split(':')
+        result.append((int(start) if start != '' else None, int(end) if end != '' else None))
+    return result
+
+def in_ranges(resi: int, ranges: List[Tuple[Optional[int], Optional[int]]]) -> bool:
+    return any( (start is None or start <= resi) and (end is None or resi <= end) for start, end in ranges )
+
+def read_poly_seq_scheme(filename: str) -> Tuple[Dict[str, List[Tuple[int, str, bool]]], Dict[str, Dict[int, Tuple[str, str, str]]]]:
+    '''Read _pdbx_poly_seq_scheme from an mmCIF file.
+    Return mapping chain (label_asym_id) -> list of residues (label_seq_id, residue name, observed),
+    and mapping chain -> label2auth table (label_seq_id -> (auth_asym_id, auth_seq_id, pdbx_PDB_ins_code)).'''
+    chains = {}
+    label2auth = {}
+    for row in read_cif_category(filename, POLY_SEQ_SCHEME):
+        resi = int(row['seq_id'])
+        observed = row['pdb_mon_id'] != '?'
+        chains.setdefault(row['asym_id'], []).append((resi, row['mon_id'], observed))
+        label2auth.setdefault(row['asym_id'], {})[resi] = (row['pdb_strand_id'], row['auth_seq_num'], row['pdb_ins_code'])
+    return chains, label2auth
+
+def count_query_residues(chains: Dict[str, List[Tuple[int, str, bool]]], chain: Optional[str], ranges: Optional[str]) -> Optional[int]:
+    '''Count observed polymer residues of the query (chain None = all chains, ranges None = whole chain) in chains from read_poly_seq_scheme.
+    Return None if the query chain is not found or the ranges are invalid.'''
+    if chain is not None and chain not in chains:
+        return None
+    try:
+        range_list = parse_ranges(ranges) if ranges is not None else [(None, None)]
+    except ValueError:
+        return None
+    selected_chains = [chains[chain]] if chain is not None else chains.values()
+    return sum(1 for residues in selected_chains for resi, name, observed in residues if observed and in_ranges(resi, range_list))
+
+def project_annotation(annotation: dict, source_chain: str, target_chain: str, label2auth: Dict[int, Tuple[str, str, str]], 
+        source_domain: str, source_query: str, target_query: str) -> dict:
+    '''Project annotation of one PDB entry from source_chain to an identical target_chain (same sequence and label_seq_id numbering).
+    label2auth maps label_seq_id of the target chain to (auth_asym_id, auth_seq_id, pdbx_PDB_ins_code).
+    Fields computed from the coordinates of the source chain (rotation matrix, SSE vectors and metric values) are removed,
+    the query in args is replaced by target_query, and the annotation is marked by projected_from.'''
+    result = copy.deepcopy(annotation)
+    for field in CHAIN_SPECIFIC_FIELDS:
+        result.pop(field, None)
+    result['projected_from'] = source_domain
+    if 'args' in result:
+        result['args'] = ' '.join(target_query if arg == source_query else arg for arg in result['args'].split(' '))
+    if 'comment' in result:
+        result['comment'] = result['comment'].split(METRIC_COMMENT_SEPARATOR)[0] + f' Projected from {source_domain}.'
+    project_sses(result.get('secondary_structure_elements', []), source_chain, target_chain, label2auth)
+    return result
+
+def project_sses(sses: List[dict], source_chain: str, target_chain: str, label2auth: Dict[int, Tuple[str, str, str]]) -> None:
+    '''Project SSEs (including nested SSEs) from source_chain to target_chain in place (see project_annotation).'''
+    for sse in sses:
+        if sse.get('chain_id') == source_chain:
+            sse['chain_id'] = target_chain
+            if 'auth_chain_id' in sse:
+                sse['auth_chain_id'] = label2auth[sse['start']][0]
+            for label_field, auth_field, ins_code_field in AUTH_FIELDS:
+                if auth_field in sse:
+                    auth_chain, auth_resi, ins_code = label2auth[sse[label_field]]
+                    sse[auth_field] = int(auth_resi)
+                    if ins_code_field in sse:
+                        sse[ins_code_field] = ins_code if ins_code not in '.?' else ' '
+        for field in CHAIN_SPECIFIC_SSE_FIELDS:
+            sse.pop(field, None)
+        project_sses(sse.get('nested_sses', []), source_chain, target_chain, label2auth)
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    '''Parse shard specification 'i/N' (i-th of N shards, 1 <= i <= N).'''
+    try:
+        i, n = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise Exception(f'Invalid shard specification "{shard}", expected i/N, e.g. 1/4')
+    if not 1 <= i <= n:
+        raise Exception(f'Invalid shard specification "{shard}", must be 1 <= i <= N')
+    return i, n
+
+def shard_prefix(i: int, n: int) -> str:
+    '''Prefix of the output files of the i-th of n shards.'''
+    return f'shard{i}of{n}-'
+
+def partition_jobs(jobs: List[Any], job_cost, n_parts: int) -> List[List[Any]]:
+    '''Split jobs into n_parts parts with balanced total cost (greedy, longest job first). 
+    The result is deterministic, so independent processes compute the same partition.'''
+    parts = [[] for i in range(n_parts)]
+    loads = [(0.0, i) for i in range(n_parts)]
+    for job in sorted(jobs, key=lambda job: (-job_cost(job), job)):
+        load, i = heapq.heappop(loads)
+        parts[i].append(job)
+        heapq.heappush(loads, (load + job_cost(job), i))
+    return parts
+
+def merge_tsv_files(sources: List[str], dest: str, sort_key) -> None:
+    '''Merge TSV files with the same header line into one file, sort the rows by sort_key (applied to the list of fields).'''
+    header = None
+    rows = []
+    for source in sources:
+        with open(source) as r:
+            header = r.readline()
+            rows.extend(line.rstrip('\n').split('\t') for line in r)
+    rows.sort(key=sort_key)
+    with open(dest, 'w') as w:
+        w.write(header or '')
+        for row in rows:
+            w.write('\t'.join(row) + '\n')
+
+def is_stale_lock(lock_file: str, lock_content: str) -> bool:
+    '''Decide if lock_file with content lock_content ("hostname PID") is left from a killed process.
+    A lock from this host is stale if its process is not alive, a lock from another host (or without content) if it is older than SHARD_MERGE_LOCK_STALE_TIME.'''
+    host, _, pid = lock_content.strip().partition(' ')
+    if host == socket.gethostname() and pid.isdigit() and os.name == 'posix':  # os.kill(pid, 0) would signal the process on Windows
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass  # exists but belongs to another user
+        return False
+    try:
+        return time.time() - os.path.getmtime(lock_file) > SHARD_MERGE_LOCK_STALE_TIME
+    except FileNotFoundError:
+        return False
+
+def acquire_lock(lock_file: str) -> int:
+    '''Create lock_file exclusively and write "hostname PID" into it, return its file descriptor.
+    Wait while the lock is held by another process, remove the lock if it is stale (see is_stale_lock).'''
+    while True:
+        try:
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(lock, f'{socket.gethostname()} {os.getpid()}\n'.encode())
+            return lock
+        except FileExistsError:
+            pass
+        try:
+            with open(lock_file) as r:
+                content = r.read()
+        except FileNotFoundError:
+            continue
+        if is_stale_lock(lock_file, content):
+            try:
+                with open(lock_file) as r:
+                    still_same = r.read() == content  # another process may have removed the stale lock and created its own meanwhile
+            except FileNotFoundError:
+                continue
+            if still_same:
+                sys.stderr.write(f'Removing stale lock {lock_file} ({content.strip()})\n')
+                remove_file(lock_file)
+            continue
+        time.sleep(SHARD_MERGE_LOCK_POLL_INTERVAL)
+
+def merge_shards(directory: str, n_shards: int) -> bool:
+    '''Merge outputs of all n_shards shards in directory into the outputs of a single-node run, remove shard outputs.
+    Wait while another process is merging (the last finished shard always gets the lock after all done files exist, so it merges, unless another shard already did).
+    Only the spool files listed in the done files (created by the last run of each shard) are merged.
+    Return False (and do nothing) if some shards have not finished yet or have already been merged.'''
+    lock_file = path.join(directory, SHARD_MERGE_LOCK_FILE)
+    lock = acquire_lock(lock_file)
+    try:
+        prefixes = [ path.join(directory, shard_prefix(i, n_shards)) for i in range(1, n_shards + 1) ]
+        if not all(path.isfile(prefix + SHARD_DONE_FILE) for prefix in prefixes):
+            return False
+        spool_files = []
+        for prefix in prefixes:
+            with open(prefix + SHARD_DONE_FILE) as r:
+                spool_files.extend(path.join(directory, line) for line in r.read().splitlines() if line != '')
+        merge_spools(spool_files, path.join(directory, ALL_ANNOTATIONS_FILE))
+        for filename in [STDOUT_FILE, STDERR_FILE]:
+            clear_file(path.join(directory, filename))
+            for prefix in prefixes:
+                copy_file(prefix + filename, path.join(directory, filename), append=True)
+        merge_tsv_files([prefix + JOB_TIMINGS_FILE for prefix in prefixes], path.join(directory, JOB_TIMINGS_FILE), sort_key=lambda row: row[0])
+        merge_tsv_files([prefix + METRICS_FILE for prefix in prefixes], path.join(directory, METRICS_FILE), sort_key=lambda row: (row[0], int(row[2])))
+        manifest = read_manifest(path.join(directory, MANIFEST_FILE))
+        for prefix in prefixes:
+            manifest.update(read_manifest(prefix + MANIFEST_FILE))
+        write_manifest(path.join(directory, MANIFEST_FILE), manifest)
+        for prefix in prefixes:
+            for filename in [STDOUT_FILE, STDERR_FILE, JOB_TIMINGS_FILE, METRICS_FILE, MANIFEST_FILE, SHARD_DONE_FILE]:
+                remove_file(prefix + filename)
+        for spool_file in spool_files:
+            remove_file(spool_file)
+        return True
+    finally:
+        os.close(lock)
+        remove_file(lock_file)
+
 def check_json_type(json_object, typeex):
     if isinstance(typeex, tuple):
         return any( check_json_type(json_object, typ) for typ in typeex )
@@ -105,21 +466,161 @@ def convert_dict_domains_to_tuple_domains(js: Dict[str, List[dict]]) -> Dict[str
         result[pdb] = simple_domains
     return result
 
-def run_in_threads (do_job, jobs, n_threads, progress_bar=None, initialize_thread_sync=None, finalize_thread_sync=None):
+RunResult = namedtuple('RunResult', ['exit_code', 'stdout', 'stderr', 'cpu_time', 'peak_rss', 'timed_out'])
+
+def kill_process_tree(process: subprocess.Popen) -> None:
+    '''Kill the process and its children (the process must be started with start_new_session=True).'''
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+def limit_memory(process: subprocess.Popen, memory_limit: Optional[int]) -> None:
+    '''Limit address space of a just started process to memory_limit MB (None = no limit).
+    Uses prlimit on the child instead of setrlimit in preexec_fn, which is not safe in a multi-threaded parent.'''
+    if memory_limit is None:
+        return
+    if resource is None or not hasattr(resource, 'prlimit'):
+        kill_process_tree(process)
+        process.wait()
+        raise Exception('Memory limit is not supported on this system')
+    limit = memory_limit * 1024 * 1024
+    try:
+        resource.prlimit(process.pid, resource.RLIMIT_AS, (limit, limit))
+    except ProcessLookupError:
+        pass  # already finished
+
+class KillTimer:
+    '''Kills the process (and its children) if it is still running after timeout seconds (None = never).'''
+    def __init__(self, process: subprocess.Popen, timeout: Optional[float]):
+        self.process = process
+        self.fired = False
+        self.timer = threading.Timer(timeout, self._kill) if timeout is not None else None
+
+    def __enter__(self) -> 'KillTimer':
+        if self.timer is not None:
+            self.timer.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def _kill(self) -> None:
+        self.fired = True
+        kill_process_tree(self.process)
+
+def run_and_measure(arguments: List[str], timeout: Optional[float] = None, memory_limit: Optional[int] = None) -> RunResult:
+    '''Run a subprocess and capture its output, kill it after timeout seconds, limit its address space to memory_limit MB.
+    Measure CPU time (user + system, in seconds) and peak RSS (in kB), these are None on systems without os.wait4.'''
+    process = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    limit_memory(process, memory_limit)
+    # The timer must run until the process is reaped, the process may close its output and keep running
+    with KillTimer(process, timeout) as kill_timer:
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+        stderr_reader.start()
+        stdout = process.stdout.read()
+        stderr_reader.join()
+        process.stdout.close()
+        process.stderr.close()
+        if not hasattr(os, 'wait4'):
+            process.wait()
+            return RunResult(process.returncode, stdout, stderr_chunks[0], None, None, kill_timer.fired)
+        _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return RunResult(process.returncode, stdout, stderr_chunks[0], rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss, kill_timer.fired)
+
+def run_status(result: RunResult) -> str:
+    '''Classify the result of a SecStrAnnotator run as 'ok', 'timeout', 'oom' (out of memory) or 'failed'.'''
+    if result.exit_code == 0:
+        return 'ok'
+    elif result.timed_out:
+        return 'timeout'
+    elif result.exit_code == -signal.SIGKILL or any(marker in result.stderr for marker in OUT_OF_MEMORY_MARKERS):
+        return 'oom'
+    else:
+        return 'failed'
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    '''Nearest-rank percentile of a non-empty sorted list.'''
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+def write_metrics(filename: str, metrics: List[Dict[str, Any]]) -> None:
+    '''Write per-domain metrics into a TSV file.'''
+    with open(filename, 'w') as w:
+        w.write('\t'.join(METRICS_COLUMNS) + '\n')
+        for row in sorted(metrics, key=lambda row: row['domain']):
+            w.write('\t'.join(format_metric(row[column]) for column in METRICS_COLUMNS) + '\n')
+
+def format_metric(value: Any) -> str:
+    if value is None:
+        return 'NA'
+    elif isinstance(value, float):
+        return f'{value:.3f}'
+    else:
+        return str(value)
+
+def print_metrics_summary(metrics: List[Dict[str, Any]], n_slowest: int = METRICS_N_SLOWEST) -> None:
+    '''Print percentiles of wall time, CPU time and peak RSS, and the slowest domains.'''
+    if len(metrics) == 0:
+        return
+    print('Metrics (percentiles ' + ', '.join(f'{p}%' for p in METRICS_PERCENTILES) + '):')
+    for column, unit in [('wall_time', 's'), ('cpu_time', 's'), ('peak_rss_kb', 'kB')]:
+        values = sorted(row[column] for row in metrics if row[column] is not None)
+        if len(values) > 0:
+            print(f'    {column:<12} ' + '  '.join(format_metric(percentile(values, p)) for p in METRICS_PERCENTILES) + f' {unit}')
+    slowest = sorted(metrics, key=lambda row: row['wall_time'], reverse=True)[:n_slowest]
+    print(f'Slowest {len(slowest)} domains:')
+    print(', '.join(f'{row["domain"]} ({row["wall_time"]:.1f} s)' for row in slowest))
+
+def estimate_job_cost(input_files: List[str], get_size=path.getsize) -> float:
+    '''Estimate relative cost of a job which runs SecStrAnnotator once for each of input_files (each run reads the whole file).'''
+    cost = 0.0
+    for input_file in input_files:
+        try:
+            size = get_size(input_file)
+        except OSError:
+            size = 0
+        cost += JOB_COST_OVERHEAD + size
+    return cost
+
+def run_in_threads (do_job, jobs, n_threads, progress_bar=None, initialize_thread_sync=None, finalize_thread_sync=None, job_cost=None, on_error=None) -> Dict[Any, float]:
+    '''Run do_job(job) for each job in n_threads parallel threads, return wall time (in seconds) of each job.
+    If job_cost is given, jobs are dispatched in order of decreasing job_cost(job) (longest-job-first), 
+    so that big jobs do not start at the end of the run while other threads are idle.
+    If do_job raises an exception, on_error(job, exception) is called (default: print the traceback) and the thread continues with the next job.'''
+    if job_cost is not None:
+        jobs = sorted(jobs, key=job_cost, reverse=True)
     q = queue.Queue()
     for job in jobs:
         q.put(job)
+    timings = {}
     def worker():
         all_done = False
         while not all_done:
             try:
                 job = q.get(block=False)
+            except queue.Empty:
+                all_done = True
+                continue
+            try:
+                start_time = time.perf_counter()
                 do_job(job)
+                timings[job] = time.perf_counter() - start_time
+            except Exception as ex:
+                if on_error is not None:
+                    on_error(job, ex)
+                else:
+                    traceback.print_exc()
+            finally:
                 if progress_bar is not None:
                     progress_bar.step()
                 q.task_done()
-            except queue.Empty:
-                all_done = True
     threads = [ threading.Thread(target=worker) for i in range(n_threads) ]
     if progress_bar is not None:
         progress_bar.start()
@@ -134,6 +635,107 @@ def run_in_threads (do_job, jobs, n_threads, progress_bar=None, initialize_threa
             finalize_thread_sync(thread)
     if progress_bar is not None:
         progress_bar.finalize()
+    return timings
+
+class SecStrAnnotatorWorker:
+    '''Long-lived SecStrAnnotator process (started with --worker), which processes queries sent via its stdin.
+    Avoids .NET runtime startup for each domain. The process is restarted automatically if it dies.'''
+    def __init__(self, commands: List[str], memory_limit: Optional[int] = None):
+        self.commands = commands
+        self.memory_limit = memory_limit
+        self.process = None
+        self.version = None
+
+    def start(self) -> bool:
+        '''Start the worker process. Return False if the DLL does not support the worker mode.'''
+        self.stop()
+        self.process = subprocess.Popen(self.commands + [WORKER_OPTION], stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
+                                        stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1, start_new_session=True)
+        limit_memory(self.process, self.memory_limit)
+        handshake = self.process.stdout.readline().rstrip('\n').split(WORKER_SEPARATOR)
+        if handshake[0] != WORKER_READY_MESSAGE:
+            self.stop()
+            return False
+        self.version = handshake[1] if len(handshake) > 1 else None
+        return True
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, arguments: List[str], stdout_file: str, stderr_file: str, timeout: Optional[float] = None) -> Tuple[int, bool]:
+        '''Run SecStrAnnotator with given arguments, append its output to stdout_file and stderr_file. 
+        Kill the worker if the run takes more than timeout seconds. Return exit code and whether the run timed out.'''
+        fields = [stdout_file, stderr_file] + arguments
+        if any(WORKER_SEPARATOR in field or '\n' in field for field in fields):
+            raise ValueError(f'Worker arguments must not contain tabs or newlines: {fields}')
+        if not self.is_running() and not self.start():
+            raise Exception(f'Failed to start SecStrAnnotator worker: {" ".join(self.commands + [WORKER_OPTION])}')
+        with KillTimer(self.process, timeout) as kill_timer:
+            try:
+                self.process.stdin.write(WORKER_SEPARATOR.join(fields) + '\n')
+                self.process.stdin.flush()
+                response = self.process.stdout.readline()
+            except BrokenPipeError:
+                response = ''
+            if response == '':
+                # The worker died during the request (e.g. fatal error in SecStrAnnotator or timeout), it will be restarted with the next request
+                exit_code = self.process.wait()
+        if response == '':
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+            return (exit_code if exit_code != 0 else 1), kill_timer.fired
+        message, exit_code = response.rstrip('\n').split(WORKER_SEPARATOR)
+        assert message == WORKER_EXIT_MESSAGE, f'Unexpected message from SecStrAnnotator worker: {response}'
+        return int(exit_code), False
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=WORKER_STOP_TIMEOUT)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            kill_process_tree(self.process)
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+class LogWriter:
+    '''Collects output of SecStrAnnotator runs from all threads and writes it to stdout and stderr log files in a single writer thread.
+    Each record is written as one block, tagged by the domain name.'''
+    SEPARATOR = b'-' * 70 + b'\n'
+
+    def __init__(self, stdout_file: str, stderr_file: str):
+        self.stdout_file = stdout_file
+        self.stderr_file = stderr_file
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_records, daemon=True)
+
+    def start(self) -> 'LogWriter':
+        self.thread.start()
+        return self
+
+    def write(self, tag: str, stdout: bytes, stderr: bytes) -> None:
+        self.queue.put((tag, stdout, stderr))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write_records(self) -> None:
+        with open(self.stdout_file, 'wb') as w_out:
+            with open(self.stderr_file, 'wb') as w_err:
+                while True:
+                    record = self.queue.get()
+                    if record is None:
+                        break
+                    tag, stdout, stderr = record
+                    w_out.write(b'\n' + self.SEPARATOR + tag.encode() + b'\n' + stdout)
+                    w_err.write(self.SEPARATOR + tag.encode() + b'\n' + stderr)
+                    if self.queue.empty():
+                        w_out.flush()
+                        w_err.flush()
 
 class ProgressBar:
     DONE_SYMBOL = '█'
@@ -179,7 +781,7 @@ class ProgressBar:
 def parse_args() -> Dict[str, Any]:
     '''Parse command line arguments.'''
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('directory', type=str, help='directory with the input and output files (argument DIRECTORY for SecStrAnnotator)')
+    parser.add_argument('directory', type=str, help='directory with the input and output files (argument DIRECTORY for SecStrAnnotator); input structures can be gzipped (<PDB>.cif.gz)')
     parser.add_argument('template', type=str, help='template domain specification (argument TEMPLATE for SecStrAnnotator)')
     parser.add_argument('queries_file', type=str, help='JSON file with the list of domains to be annotated (in format {PDB:[[domain_name,chain,ranges]]}, will be processed to QUERY arguments for SecStrAnnotator. The alternative format is {PDB:[{"domain": domain_name, "chain_id": chain, "ranges": ranges}]})')
     parser.add_argument('--options', type=str, default='', help="Any options that are to be passed to SecStrAnnotator (must be enclosed in quotes and contain spaces, not to be confused with Python arguments, e.g. --options '--ssa dssp --soft' or ' --soft')")
@@ -187,12 +789,29 @@ def parse_args() -> Dict[str, Any]:
     parser.add_argument('--files_by_domain_name', action='store_true', help='Input files will be <domain_name>.cif instead of <PDB>.cif')
     parser.add_argument('--threads', type=int, default=1, help='Number of parallel threads (default: 1)')
     parser.add_argument('--dll', type=str, default=DEFAULT_SECSTRANNOTATOR_DLL, help=f'Path to the SecStrAnnotator DLL (default: {DEFAULT_SECSTRANNOTATOR_DLL})')
+    parser.add_argument('--deduplicate', action='store_true', help='Annotate only one representative of the domains with the same PDB, sequence and residue numbering (according to _pdbx_poly_seq_scheme) and project the annotation to the others (only in annotation mode without --label2auth and --session). Projected domains get only the annotation file (marked by projected_from, without rotation matrix, SSE vectors and metric values), not the aligned structure, alignment and detected SSE files')
+    parser.add_argument('--resume', action='store_true', help=f'Incremental mode: skip PDBs whose domains were successfully annotated by a previous run with the same input files, template, options and DLL (according to {MANIFEST_FILE} in DIRECTORY), re-run only changed or failed ones')
+    parser.add_argument('--timeout', type=float, default=None, help='Time limit for annotation of one domain in seconds (default: no limit)')
+    parser.add_argument('--memory_limit', type=int, default=None, help='Address space limit for one SecStrAnnotator process in MB (default: no limit; note that .NET runtime itself reserves a few GB)')
+    parser.add_argument('--retry_options', type=str, default=DEFAULT_RETRY_OPTIONS, help=f"Options to add to --options when retrying a domain which hit the time or memory limit (default: '{DEFAULT_RETRY_OPTIONS}'; must be enclosed in quotes and contain spaces like --options)")
+    parser.add_argument('--shard', type=str, default=None, help='Process only the i-th of N parts of the queries (format i/N, parts are balanced by estimated cost); outputs are prefixed by shard<i>of<N>- and merged automatically when the last shard finishes (or by running this script with arguments: merge DIRECTORY N)')
+    parser.add_argument('--persistent_workers', action='store_true', help='Keep one long-lived SecStrAnnotator process per thread instead of starting a new process for each domain (falls back to the normal mode if the DLL does not support it)')
     args = parser.parse_args()
     return vars(args)
 
+def parse_merge_args() -> Dict[str, Any]:
+    '''Parse command line arguments for the merge subcommand.'''
+    parser = argparse.ArgumentParser(prog=f'{path.basename(sys.argv[0])} merge', description='Merge outputs of sharded runs (--shard i/N) into the outputs of a single-node run.')
+    parser.add_argument('directory', type=str, help='directory with the shard outputs')
+    parser.add_argument('n_shards', type=int, help='number of shards (N)')
+    args = parser.parse_args(sys.argv[2:])
+    return vars(args)
+
 
 def main(directory: str, template: str, queries_file: str, options: Union[str, List[str]] = '', 
-        by_pdb: bool = False, files_by_domain_name: bool = False, threads: int = 1, dll: str = DEFAULT_SECSTRANNOTATOR_DLL) -> Optional[int]:
+        by_pdb: bool = False, files_by_domain_name: bool = False, threads: int = 1, dll: str = DEFAULT_SECSTRANNOTATOR_DLL, 
+        deduplicate: bool = False, resume: bool = False, timeout: Optional[float] = None, memory_limit: Optional[int] = None, 
+        retry_options: Union[str, List[str]] = DEFAULT_RETRY_OPTIONS, shard: Optional[str] = None, persistent_workers: bool = False) -> Optional[int]:
     '''Run SecStrAnnotator on multiple query protein domains.'''
 
     if by_pdb and files_by_domain_name:
@@ -200,11 +819,21 @@ def main(directory: str, template: str, queries_file: str, options: Union[str, L
 
     if isinstance(options, str):
         options = options.split()
+    if isinstance(retry_options, str):
+        retry_options = retry_options.split()
     onlyssa = '--onlyssa' in options
+    if deduplicate and (onlyssa or by_pdb or files_by_domain_name or '--label2auth' in options or '-L' in options or '--session' in options or '-s' in options):
+        sys.stderr.write('Warning: --deduplicate cannot be used with --onlyssa, --label2auth, --session, --by_pdb or --files_by_domain_name, ignoring it\n')
+        deduplicate = False
 
-    all_annotations_file = path.join(directory, 'all_annotations.sses.json')
-    output = path.join(directory, 'stdout.txt')
-    output_err = path.join(directory, 'stderr.txt')
+    shard_i, n_shards = parse_shard(shard) if shard is not None else (None, None)
+    prefix = shard_prefix(shard_i, n_shards) if shard is not None else ''
+    all_annotations_file = path.join(directory, ALL_ANNOTATIONS_FILE)
+    job_timings_file = path.join(directory, prefix + JOB_TIMINGS_FILE)
+    manifest_file = path.join(directory, prefix + MANIFEST_FILE)
+    metrics_file = path.join(directory, prefix + METRICS_FILE)
+    output = path.join(directory, prefix + STDOUT_FILE)
+    output_err = path.join(directory, prefix + STDERR_FILE)
     out_files_extensions = ['-aligned.cif', '-alignment.json', '-detected.sses.json', '-annotated.sses.json', '-annotated.pse']
 
     # Determine whether can run dotnet SecStrAnnotator.dll and whether the template files exist
@@ -215,6 +844,8 @@ def main(directory: str, template: str, queries_file: str, options: Union[str, L
 
     template_pdb = template.split(',')[0]
     template_struct_file = path.join(directory, template_pdb+'.cif')
+    if not onlyssa and not path.isfile(template_struct_file) and path.isfile(template_struct_file + GZIP_EXT):
+        decompress_file(template_struct_file + GZIP_EXT, template_struct_file)  # kept for the following runs
     template_annot_file = path.join(directory, template_pdb+'-template.sses.json')
     if not onlyssa and not path.isfile(template_struct_file):
         raise FileNotFoundError(f'Template structure file "{template_struct_file}" not found\n')
@@ -227,12 +858,22 @@ def main(directory: str, template: str, queries_file: str, options: Union[str, L
 
     secstrannotator_commands = ['dotnet', dll]
 
+    if persistent_workers:
+        probe_worker = SecStrAnnotatorWorker(secstrannotator_commands, memory_limit=memory_limit)
+        if probe_worker.start():
+            probe_worker.stop()
+        else:
+            sys.stderr.write(f'Warning: SecStrAnnotator DLL "{dll}" does not support persistent workers, running a new process for each domain\n')
+            persistent_workers = False
+    workers = {}  # thread name -> SecStrAnnotatorWorker
+
     # Prepare domain list
     domains = read_domains_json(queries_file)
     pdbs = sorted(domains)
     if not path.isdir(directory):
         raise NotADirectoryError(f'"{directory}" is not a directory\n')
     print(directory)
+    directory_files = list_files(directory)
     n_domains = sum(len(domains[pdb]) for pdb in pdbs)
     if files_by_domain_name:
         found_pdbs = []
@@ -243,7 +884,7 @@ def main(directory: str, template: str, queries_file: str, options: Union[str, L
             pdb_found = False
             for domain in doms:
                 domain_name = domain[0]
-                if path.isfile(path.join(directory, f'{domain_name}.cif')):
+                if f'{domain_name}.cif' in directory_files or f'{domain_name}.cif{GZIP_EXT}' in directory_files:
                     found_domains.append(domain)
                     pdb_found = True
                 else:
@@ -254,8 +895,8 @@ def main(directory: str, template: str, queries_file: str, options: Union[str, L
                 not_found_pdbs.append(pdb)
         n_found_domains = len(found_domains)
     else:
-        found_pdbs = [pdb for pdb in pdbs if path.isfile(path.join(directory, f'{pdb}.cif'))]
-        not_found_pdbs = [pdb for pdb in pdbs if not path.isfile(path.join(directory, f'{pdb}.cif'))]
+        found_pdbs = [pdb for pdb in pdbs if f'{pdb}.cif' in directory_files or f'{pdb}.cif{GZIP_EXT}' in directory_files]
+        not_found_pdbs = [pdb for pdb in pdbs if f'{pdb}.cif' not in directory_files and f'{pdb}.cif{GZIP_EXT}' not in directory_files]
         n_found_domains = sum(len(domains[pdb]) for pdb in found_pdbs)
         not_found_domains = [domain for pdb in not_found_pdbs for domain in domains[pdb] ]
     
@@ -263,90 +904,374 @@ def main(directory: str, template: str, queries_file: str, options: Union[str, L
 
     print(f'Listed {len(pdbs)} PDBs ({n_domains} domains), found {len(found_pdbs)} PDBs ({n_found_domains} domains)')
 
-    all_annotations = OrderedDict()
-    failed = []
+    def pdb_domains(pdb):
+        if by_pdb:
+            return [(pdb, None, None)]
+        else:
+            return [(domain_name, chain, ranges) for domain_name, chain, ranges in domains[pdb] if domain_name not in not_found_domain_set]
 
-    def process_pdb(pdb):
-        remove_file(path.join(directory, f'{pdb}.label2auth.tsv'))
+    def structure_file(namebase):
+        '''Input structure file <namebase>.cif, or <namebase>.cif.gz if only the gzipped file exists or it is newer (SecStrAnnotator gets it decompressed, see make_work_directory).'''
+        filename = f'{namebase}.cif'
+        plain, gzipped = directory_files.get(filename), directory_files.get(filename + GZIP_EXT)
+        if gzipped is not None and (plain is None or gzipped.stat().st_mtime_ns > plain.stat().st_mtime_ns):
+            filename += GZIP_EXT
+        return path.join(directory, filename)
+
+    def input_files(pdb):
         if by_pdb:
-            process_domain(pdb, pdb)
+            return [structure_file(pdb)]
+        elif files_by_domain_name:
+            return [structure_file(domain_name) for domain_name, chain, ranges in domains[pdb] if domain_name not in not_found_domain_set]
         else:
-            for domain_name, chain, ranges in domains[pdb]:
-                process_domain(domain_name, pdb, chain, ranges)
+            return [structure_file(pdb)] * len(domains[pdb])
 
-    def process_domain(domain_name, pdb, chain=None, ranges=None):
-        if domain_name in not_found_domain_set:
-            return
-        namebase = domain_name if files_by_domain_name else pdb
-        query = namebase
+    def listed_file_size(filename):
+        entry = directory_files.get(path.basename(filename))
+        if entry is None:
+            raise FileNotFoundError(filename)
+        return entry.stat().st_size * (GZIP_SIZE_FACTOR if filename.endswith(GZIP_EXT) else 1)
+
+    job_costs = { pdb: estimate_job_cost(input_files(pdb), get_size=listed_file_size) for pdb in found_pdbs }
+
+    if shard is not None:
+        shard_pdbs = set(partition_jobs(found_pdbs, job_costs.get, n_shards)[shard_i - 1])
+        found_pdbs = [pdb for pdb in found_pdbs if pdb in shard_pdbs]
+        n_found_domains = sum(len(pdb_domains(pdb)) for pdb in found_pdbs)
+        print(f'Shard {shard_i}/{n_shards}: {len(found_pdbs)} PDBs ({n_found_domains} domains)')
+        remove_file(path.join(directory, prefix + SHARD_DONE_FILE))
+
+    # Spool files left by a killed run of this shard must not be merged with the outputs of this run
+    for spool_file in glob.glob(glob.escape(path.join(directory, prefix)) + SPOOL_FILE_PATTERN.format('*')):
+        remove_file(spool_file)
+
+    # Manifest records the inputs of each annotated domain, so that unchanged domains can be skipped with --resume
+    old_manifest = read_manifest(path.join(directory, MANIFEST_FILE)) if resume else {}
+    if resume and shard is not None:
+        old_manifest.update(read_manifest(manifest_file))
+    if not resume:
+        clear_file(manifest_file)
+    manifest_lock = threading.Lock()
+    dll_hash = file_hash(dll)
+    template_hash = file_hash(template_struct_file) + file_hash(template_annot_file) if not onlyssa else None
+    input_hashes = {}  # input file -> hash
+
+    def get_input_hash(input_file, domain_name):
+        '''Content hash of input_file, computed only with --resume (without it, the manifest identifies the file by size and mtime and input_hash is None).'''
+        stat = os.stat(input_file)
+        old_record = old_manifest.get(domain_name)
+        if old_record is not None and old_record.get('input_size') == stat.st_size and old_record.get('input_mtime_ns') == stat.st_mtime_ns:
+            return old_record.get('input_hash')  # file unchanged since the previous run (make-like check), no need to read it
+        if not resume:
+            return None
+        if input_file not in input_hashes:
+            input_hashes[input_file] = file_hash(input_file)
+        return input_hashes[input_file]
+
+    def make_query(domain_name, pdb, chain, ranges):
+        query = domain_name if files_by_domain_name else pdb
         if chain is not None:
             query += ',' + chain 
         if ranges is not None:
             query += ',' + ranges
-        thread_out = path.join(directory, f'stdout_thread_{threading.current_thread().name}.txt')
-        thread_err = path.join(directory, f'stderr_thread_{threading.current_thread().name}.txt')
-        with open(thread_out, 'a') as w_out:
-            with open(thread_err, 'a') as w_err:
-                w_out.write('\n' + '-'*70 + '\n' + domain_name + '\n')
-                w_err.write('-'*70 + '\n' + domain_name + '\n')
-                w_out.flush()
-                w_err.flush()
-                regular_arguments = [directory, template, query] if not onlyssa else [directory, query]
-                arguments = secstrannotator_commands + regular_arguments + options
-                exit_code = subprocess.call(arguments, stdout=w_out, stderr=w_err)
-        if exit_code == 0:
-            for ext in out_files_extensions:
-                try_rename_file(path.join(directory, namebase + ext), path.join(directory, domain_name + ext))
+        return query
+
+    def make_manifest_record(domain_name, pdb, chain, ranges):
+        namebase = domain_name if files_by_domain_name else pdb
+        input_file = structure_file(namebase)
+        stat = os.stat(input_file)
+        return { 'domain': domain_name, 'pdb': pdb, 'query': make_query(domain_name, pdb, chain, ranges), 
+                 'input_hash': get_input_hash(input_file, domain_name), 'input_size': stat.st_size, 'input_mtime_ns': stat.st_mtime_ns,
+                 'template_hash': template_hash, 'options': ' '.join(options), 'dll_hash': dll_hash }
+
+    recorded_domains = set()  # domains with a manifest record written in this run
+
+    def write_manifest_record(record):
+        with manifest_lock:
+            recorded_domains.add(record['domain'])
+            with open(manifest_file, 'a') as w:
+                w.write(json.dumps(record) + '\n')
+
+    def is_up_to_date(record):
+        old_record = old_manifest.get(record['domain'])
+        output_file = path.join(directory, record['domain'] + ('-detected.sses.json' if onlyssa else '-annotated.sses.json'))
+        return (old_record is not None and old_record.get('status') == 'ok' 
+                and all(old_record.get(key) == record[key] for key in MANIFEST_KEYS) and path.isfile(output_file))
+
+    # Annotations are streamed into per-thread spool files (partial results during the run), merged at the end
+    annotation_spools = {}  # thread name -> open spool file
+    annotation_spool_files = []
+    failed = []
+    projected = []
+    hit_limits = { 'timeout': [], 'oom': [] }  # domains which hit the time or memory limit (even if the retry succeeded)
+    skipped = []
+    metrics = []
+
+    def process_pdb(pdb):
+        doms = pdb_domains(pdb)
+        records = [ make_manifest_record(domain_name, pdb, chain, ranges) for domain_name, chain, ranges in doms ]
+        if resume and all(is_up_to_date(record) for record in records):
+            # Whole PDB is skipped, because its label2auth table is shared by its domains
+            try:
+                for domain_name, chain, ranges in doms:
+                    collect_annotation(domain_name, pdb, chain, ranges)
+                skipped.extend(domain_name for domain_name, chain, ranges in doms)
+                return
+            except Exception:
+                pass  # invalid output files, annotate again
+        work_directory = make_work_directory(pdb)
+        try:
+            annotate_pdb(pdb, doms, records, work_directory)
+        finally:
+            if work_directory is not None:
+                shutil.rmtree(work_directory, ignore_errors=True)
+
+    def make_work_directory(pdb):
+        '''If some input files of pdb are gzipped, create a private work directory in the scratch directory with the decompressed input files 
+        and links to the template files, return its path (SecStrAnnotator runs there and its outputs are moved to directory, see move_outputs).
+        Return None if all input files are plain (SecStrAnnotator runs directly in directory). Files in directory are never overwritten by decompression.'''
+        gzipped_files = sorted(input_file for input_file in set(input_files(pdb)) if input_file.endswith(GZIP_EXT))
+        if len(gzipped_files) == 0:
+            return None
+        work_directory = tempfile.mkdtemp(prefix=f'{pdb}_', dir=scratch_dir)
+        for input_file in gzipped_files:
+            decompress_file(input_file, path.join(work_directory, path.basename(input_file)[:-len(GZIP_EXT)]))
+        if not onlyssa:
+            for template_file in [template_struct_file, template_annot_file]:
+                link = path.join(work_directory, path.basename(template_file))
+                if not path.exists(link):  # the template may be one of the decompressed inputs
+                    try:
+                        os.symlink(path.abspath(template_file), link)
+                    except OSError:
+                        shutil.copyfile(template_file, link)
+        return work_directory
+
+    def move_outputs(pdb, work_directory):
+        '''Move SecStrAnnotator outputs from work_directory to directory (decompressed inputs and template links stay in work_directory).
+        The work directory in JSON outputs (e.g. "args" of annotations) is replaced by directory.'''
+        inputs = { path.basename(input_file)[:-len(GZIP_EXT)] for input_file in input_files(pdb) if input_file.endswith(GZIP_EXT) }
+        inputs.update(path.basename(template_file) for template_file in [template_struct_file, template_annot_file])
+        for filename in os.listdir(work_directory):
+            if filename in inputs:
+                continue
+            if filename.endswith('.json'):
+                with open(path.join(work_directory, filename)) as r:
+                    content = r.read()
+                with open(path.join(work_directory, filename), 'w') as w:
+                    w.write(content.replace(json.dumps(work_directory)[1:-1], json.dumps(directory)[1:-1]))
+            shutil.move(path.join(work_directory, filename), path.join(directory, filename))
+
+    def annotate_pdb(pdb, doms, records, work_directory):
+        remove_file(path.join(directory, f'{pdb}.label2auth.tsv'))
+        chains, label2auth = read_chains(pdb, work_directory) if not files_by_domain_name else ({}, {})
+        representatives = find_representatives(doms, chains) if deduplicate else {}
+        n_residues = { domain_name: count_query_residues(read_chains(domain_name, work_directory)[0] if files_by_domain_name else chains, chain, ranges) 
+                       for domain_name, chain, ranges in doms }
+        statuses = {}
+        queries = { domain_name: record['query'] for (domain_name, chain, ranges), record in zip(doms, records) }
+        for (domain_name, chain, ranges), record in zip(doms, records):
+            if domain_name not in representatives:
+                statuses[domain_name] = process_domain(domain_name, pdb, chain, ranges, record, n_residues[domain_name], work_directory)
+        for (domain_name, chain, ranges), record in zip(doms, records):
+            if domain_name in representatives:
+                representative, representative_chain = representatives[domain_name]
+                if statuses[representative] == 'ok' and try_project_domain(domain_name, pdb, chain, ranges, queries[domain_name], 
+                                                                            representative, representative_chain, queries[representative], label2auth[chain]):
+                    write_manifest_record(dict(record, status='ok', projected_from=representative))
+                    projected.append(domain_name)
+                else:
+                    process_domain(domain_name, pdb, chain, ranges, record, n_residues[domain_name], work_directory)
+
+    def read_chains(namebase, work_directory):
+        '''Read polymer chains and label2auth tables of structure namebase (see read_poly_seq_scheme), return empty mappings if it cannot be read.'''
+        try:
+            return read_poly_seq_scheme(path.join(work_directory or directory, f'{namebase}.cif'))
+        except Exception:
+            return {}, {}
+
+    def find_representatives(doms, chains):
+        '''Find domains with the same sequence and numbering of the selected residues (including observed/unobserved state), chains as from read_poly_seq_scheme.
+        Return mapping domain_name -> (representative_name, representative_chain) for non-representative domains.
+        If chains are empty (cannot read the sequences), all domains are annotated.'''
+        groups = {}  # selected residues -> representative domain
+        representatives = {}
+        for domain_name, chain, ranges in doms:
+            try:
+                range_list = parse_ranges(ranges)
+            except ValueError:
+                continue
+            selected = tuple(residue for residue in chains.get(chain, []) if in_ranges(residue[0], range_list))
+            if len(selected) == 0:
+                continue
+            if selected in groups:
+                representatives[domain_name] = groups[selected]
+            else:
+                groups[selected] = (domain_name, chain)
+        return representatives
+
+    def try_project_domain(domain_name, pdb, chain, ranges, query, representative, representative_chain, representative_query, label2auth):
+        '''Create annotation of domain_name by projecting annotation of an identical representative domain, return True on success.
+        Only the annotation file is created (no aligned structure, alignment, detected SSEs or PyMOL session).'''
+        try:
+            representative_annotation = try_read_json(path.join(directory, f'{representative}-annotated.sses.json'))[pdb]
+            annotation = project_annotation(representative_annotation, representative_chain, chain, label2auth, representative, representative_query, query)
+            with open(path.join(directory, f'{domain_name}-annotated.sses.json'), 'w') as w:
+                json.dump({pdb: annotation}, w, indent=4)
+            collect_annotation(domain_name, pdb, chain, ranges)
+            return True
+        except Exception:
+            return False
+
+    def collect_annotation(domain_name, pdb, chain, ranges):
+        if not onlyssa:
+            annotation = try_read_json(path.join(directory, f'{domain_name}-annotated.sses.json')).get(pdb, {})
+            annotation['domain'] = { 'name': domain_name, 'pdb': pdb, 'chain': chain, 'ranges': ranges }
+            spool = annotation_spools[threading.current_thread().name]
+            spool.write(json.dumps([domain_name, annotation]) + '\n')
+            spool.flush()
+
+    def process_domain(domain_name, pdb, chain, ranges, manifest_record, n_residues, work_directory=None):
+        namebase = domain_name if files_by_domain_name else pdb
+        query = manifest_record['query']
+        run_directory = work_directory or directory
+        regular_arguments = [run_directory, template, query] if not onlyssa else [run_directory, query]
+        status = run_domain(domain_name, pdb, regular_arguments + options, manifest_record, n_residues, attempt=1)
+        if status in hit_limits:
+            hit_limits[status].append(domain_name)
+            # Retry once with relaxed options
+            status = run_domain(domain_name, pdb, regular_arguments + options + retry_options, manifest_record, n_residues, attempt=2)
+        if work_directory is not None:
+            move_outputs(pdb, work_directory)
+        if status == 'ok':
+            # Renaming cannot be postponed to the end, the next domain of the same PDB would overwrite the outputs
+            if namebase != domain_name:
+                for ext in out_files_extensions:
+                    try_rename_file(path.join(directory, namebase + ext), path.join(directory, domain_name + ext))
             try:
                 copy_file(path.join(directory, f'{namebase}-label2auth.tsv'), path.join(directory, f'{pdb}.label2auth.tsv'), append=True)
                 remove_file(path.join(directory, f'{namebase}-label2auth.tsv'))
             except:
                 pass
-            if not onlyssa:
-                annotation = try_read_json(path.join(directory, f'{domain_name}-annotated.sses.json')).get(pdb, {})
-                annotation['domain'] = { 'name': domain_name, 'pdb': pdb, 'chain': chain, 'ranges': ranges }
-                all_annotations[domain_name] = annotation
+            collect_annotation(domain_name, pdb, chain, ranges)
         else:
             failed.append(domain_name)
+        write_manifest_record(dict(manifest_record, status=status))
+        return status
+
+    def run_domain(domain_name, pdb, arguments, manifest_record, n_residues, attempt):
+        '''Run SecStrAnnotator once, log its output and metrics, return status of the run.'''
+        start_time = time.perf_counter()
+        if persistent_workers:
+            # Worker output goes to per-thread files in the scratch directory, read back after each run
+            thread_name = threading.current_thread().name
+            worker_out = path.join(scratch_dir, f'{thread_name}.stdout')
+            worker_err = path.join(scratch_dir, f'{thread_name}.stderr')
+            exit_code, timed_out = workers[thread_name].run(arguments, worker_out, worker_err, timeout=timeout)
+            # CPU time and RSS are not measurable per domain in a shared process
+            result = RunResult(exit_code, read_and_clear_file(worker_out), read_and_clear_file(worker_err), None, None, timed_out)
+        else:
+            result = run_and_measure(secstrannotator_commands + arguments, timeout=timeout, memory_limit=memory_limit)
+        wall_time = time.perf_counter() - start_time
+        status = run_status(result)
+        log_writer.write(domain_name if attempt == 1 else f'{domain_name} (attempt {attempt})', result.stdout, result.stderr)
+        metrics.append({ 'domain': domain_name, 'pdb': pdb, 'attempt': attempt, 'status': status, 'exit_code': result.exit_code, 
+                         'wall_time': wall_time, 'cpu_time': result.cpu_time, 'peak_rss_kb': result.peak_rss, 
+                         'input_size': manifest_record['input_size'], 'n_residues': n_residues })
+        return status
+
+    def pdb_error(pdb, ex):
+        '''Record all not yet finished domains of pdb as failed when processing of pdb raised an exception (e.g. corrupted input file).'''
+        message = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+        log_writer.write(f'{pdb} (error)', b'', message.encode())
+        sys.stderr.write(f'Error while processing {pdb}: {ex!r}\n')
+        for domain_name, chain, ranges in pdb_domains(pdb):
+            if domain_name not in recorded_domains:
+                failed.append(domain_name)
+                write_manifest_record({ 'domain': domain_name, 'pdb': pdb, 'status': 'error', 'error': repr(ex) })
 
-    def clear_outputs(thread):
-        thread_out = path.join(directory, 'stdout_thread_' + thread.name + '.txt')
-        thread_err = path.join(directory, 'stderr_thread_' + thread.name + '.txt')
-        clear_file(thread_out)
-        clear_file(thread_err)
+    def initialize_thread(thread):
+        spool_file = path.join(directory, prefix + SPOOL_FILE_PATTERN.format(thread.name))
+        annotation_spools[thread.name] = open(spool_file, 'w')
+        annotation_spool_files.append(spool_file)
+        if persistent_workers:
+            clear_file(path.join(scratch_dir, f'{thread.name}.stdout'))
+            clear_file(path.join(scratch_dir, f'{thread.name}.stderr'))
+            workers[thread.name] = SecStrAnnotatorWorker(secstrannotator_commands, memory_limit=memory_limit)
 
-    def merge_outputs(thread):
-        thread_out = path.join(directory, 'stdout_thread_' + thread.name + '.txt')
-        thread_err = path.join(directory, 'stderr_thread_' + thread.name + '.txt')
-        copy_file(thread_out, output, append=True)
-        copy_file(thread_err, output_err, append=True)
-        remove_file(thread_out)
-        remove_file(thread_err)
+    def finalize_thread(thread):
+        annotation_spools.pop(thread.name).close()
+        sort_spool(path.join(directory, prefix + SPOOL_FILE_PATTERN.format(thread.name)))
+        if persistent_workers:
+            workers.pop(thread.name).stop()
 
-    clear_file(output)
-    clear_file(output_err)
+    log_writer = LogWriter(output, output_err).start()
+    scratch_dir = tempfile.mkdtemp(prefix='SecStrAnnotator_batch_', dir=next((d for d in SCRATCH_DIR_CANDIDATES if path.isdir(d) and os.access(d, os.W_OK)), None))
 
     progress_bar = ProgressBar(len(found_pdbs), title=f'Running SecStrAnnotator on {n_found_domains} domains', writer=sys.stderr)
 
     # Run SecStrAnnotator in parallel threads
-    run_in_threads(process_pdb, found_pdbs, threads, progress_bar=progress_bar, initialize_thread_sync=clear_outputs, finalize_thread_sync=merge_outputs)
-    
-    all_annotations = { domain: annot for domain, annot in sorted(all_annotations.items()) }
+    job_timings = run_in_threads(process_pdb, found_pdbs, threads, progress_bar=progress_bar, initialize_thread_sync=initialize_thread, 
+                                 finalize_thread_sync=finalize_thread, job_cost=job_costs.get, on_error=pdb_error)
+
+    with open(job_timings_file, 'w') as w:
+        w.write('pdb\tn_runs\testimated_cost\ttime\n')
+        for pdb in sorted(found_pdbs):
+            if pdb in job_timings:
+                w.write(f'{pdb}\t{len(input_files(pdb))}\t{job_costs[pdb]:.0f}\t{job_timings[pdb]:.3f}\n')
+
+    log_writer.close()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    write_manifest(manifest_file, read_manifest(manifest_file))
+    write_metrics(metrics_file, metrics)
 
     # Output collected data
-    with open(all_annotations_file, 'w') as w:
-        json.dump(all_annotations, w, indent=4)
+    if shard is None:
+        merge_spools(annotation_spool_files, all_annotations_file)
+        for spool_file in annotation_spool_files:
+            remove_file(spool_file)
 
     print('Failed to find ' + str(len(not_found_domains)) + ' domains:')
     print(', '.join(name for name, chain, ranges in not_found_domains))
+    if resume:
+        print(f'Skipped {len(skipped)} up-to-date domains')
+    for status, description in [('timeout', 'time limit'), ('oom', 'memory limit')]:
+        if len(hit_limits[status]) > 0:
+            print(f'Hit {description} (retried with options "{" ".join(retry_options)}") in {len(hit_limits[status])} domains:')
+            print(', '.join(hit_limits[status]))
+    if deduplicate:
+        print(f'Projected annotation to {len(projected)} domains identical to other domains:')
+        print(', '.join(projected))
     print('Failed to annotate ' + str(len(failed)) + ' domains:')
     print(', '.join(failed))
-    print('Annotations in:  ' + all_annotations_file)
-    print('Output in:       ' + output)
-    print('Error output in: ' + output_err)
+    print_metrics_summary(metrics)
 
+    if shard is not None:
+        # Sorted spools are kept as the shard output (listed in the done file), the last finished shard merges all shards
+        with open(path.join(directory, prefix + SHARD_DONE_FILE), 'w') as w:
+            w.write(''.join(path.basename(spool_file) + '\n' for spool_file in sorted(annotation_spool_files)))
+        if merge_shards(directory, n_shards):
+            print(f'Merged outputs of all {n_shards} shards')
+            prefix = ''
+        elif not path.isfile(path.join(directory, prefix + SHARD_DONE_FILE)):
+            print(f'Outputs of all {n_shards} shards have been merged by another shard')
+            prefix = ''
+        else:
+            print(f'Outputs of this shard will be merged when all {n_shards} shards finish (or run: {path.basename(sys.argv[0])} merge {directory} {n_shards})')
+            return
+    print('Annotations in:  ' + all_annotations_file)
+    print('Output in:       ' + path.join(directory, prefix + STDOUT_FILE))
+    print('Error output in: ' + path.join(directory, prefix + STDERR_FILE))
+    print('Job timings in:  ' + path.join(directory, prefix + JOB_TIMINGS_FILE))
+    print('Metrics in:      ' + path.join(directory, prefix + METRICS_FILE))
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        args = parse_merge_args()
+        if not merge_shards(**args):
+            sys.stderr.write('Cannot merge: some shards have not finished yet or have already been merged\n')
+            exit(1)
+        exit(0)
     args = parse_args()
     exit_code = main(**args)
     if exit_code is not None:
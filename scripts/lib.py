@@ -1,14 +1,26 @@
+import os
 import sys
 import json
 import math
-import requests
+import time
 import shutil
-import ftplib
 import tarfile
-from collections import namedtuple
-from typing import List, Dict, Tuple, Union, Iterator, Iterable, Callable, TypeVar, Optional
+import hashlib
+import inspect
+import re
+import glob
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows, tasks cannot be profiled
+import cProfile
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Set, Tuple, Any, Union, Iterator, Iterable, Callable, TypeVar, Optional
 
 from constants import *
+import rest_client
 
 DEFAULT_ENCODING = 'utf-8'
 
@@ -17,6 +29,9 @@ V = TypeVar('V')
 
 DEFAULT_STRUCTURE_QUALITY = 0.0
 
+JSON_CACHE_SIZE = 2  # maximum number of JSON objects kept in memory by read_json/write_json
+_json_cache: Dict[str, Tuple[Tuple[int, int, int], Any]] = OrderedDict()  # absolute path -> (file size, mtime, inode), object
+
 def insert_after(dictionary: Dict[K, V], after_what: K, new_key_value_pairs: Iterable[Tuple[K, V]]) -> None:
     key_value_pairs = list(dictionary.items())
     dictionary.clear()
@@ -43,14 +58,20 @@ def iterate_names_domains(domains: Union[Dict[str, V], List[V]]) -> Iterator[Tup
 def create_domain_id(pdb: str, chain: str) -> str:
     return pdb + chain
 
+QUALITY_API_URL = 'https://www.ebi.ac.uk/pdbe/api/validation/summary_quality_scores/entry/'
+QUALITY = 'overall_quality'
+
 def get_structure_quality(pdb: str) -> float:
-    QUALITY_API_URL = 'https://www.ebi.ac.uk/pdbe/api/validation/summary_quality_scores/entry/{pdb}'
-    QUALITY = 'overall_quality'
-    url = QUALITY_API_URL.format(pdb=pdb)
-    r = json.loads(requests.get(url).text)
+    r = rest_client.get_client().get(QUALITY_API_URL + pdb).json()
     quality = r.get(pdb, {}).get(QUALITY, DEFAULT_STRUCTURE_QUALITY)
     return quality
 
+def get_structure_qualities(pdbs: Iterable[str], progress_bar: Optional['ProgressBar'] = None) -> Dict[str, float]:
+    '''Get structure quality for multiple PDB entries (batched concurrent requests).'''
+    pdbs = list(pdbs)
+    responses = rest_client.get_client().get_many_by_id(QUALITY_API_URL, pdbs, progress_bar=progress_bar)
+    return { pdb: response.json().get(pdb, {}).get(QUALITY, DEFAULT_STRUCTURE_QUALITY) for pdb, response in zip(pdbs, responses) }
+
 def single(iterable: Iterable[V]) -> V:
     '''Return the single element of the iterable, or raise ValueError if len(iterable) is not 1'''
     iterator = iter(iterable)
@@ -65,12 +86,7 @@ def single(iterable: Iterable[V]) -> V:
         raise ValueError('Iterable contains no elements')
 
 def get_from_ftp(address: str, destination_file: str, username: str = 'anonymous') -> None:
-    if address.startswith('ftp://'):
-        address = address[6:]
-    server, filename = address.split('/', maxsplit=1)
-    with ftplib.FTP(server, username) as connection:
-        with open(destination_file, 'wb') as w:
-            connection.retrbinary(f'RETR {filename}', w.write)
+    rest_client.get_client().download_ftp(address, destination_file, username=username)
 
 def extract_from_tar(tar_archive: str, extracted_file: str, destination_file: str) -> None:
     with tarfile.open(tar_archive, 'r') as tar:
@@ -78,6 +94,51 @@ def extract_from_tar(tar_archive: str, extracted_file: str, destination_file: st
             with open(destination_file, 'wb') as w:
                 shutil.copyfileobj(r, w)
 
+def _file_identity(filename: str) -> Tuple[int, int, int]:
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def _cache_json(filename: str, identity: Tuple[int, int, int], obj: Any) -> None:
+    key = os.path.abspath(filename)
+    _json_cache.pop(key, None)
+    _json_cache[key] = (identity, obj)
+    while len(_json_cache) > JSON_CACHE_SIZE:
+        _json_cache.popitem(last=False)
+
+def read_json(filename: str, modify: bool = False) -> Any:
+    '''Load JSON file. Reuse the object read or written earlier by this process (read_json, write_json), if the file has not changed since.
+    If modify is False, the caller must not modify the returned object (it can be shared with other callers).
+    If modify is True, the object is removed from memory cache (so the caller can modify it).'''
+    key = os.path.abspath(filename)
+    identity = _file_identity(filename)
+    cached = _json_cache.get(key)
+    if cached is not None and cached[0] == identity:
+        if modify:
+            del _json_cache[key]
+        else:
+            _json_cache.move_to_end(key)
+        return cached[1]
+    with open(filename, 'r', encoding=DEFAULT_ENCODING) as r:
+        obj = json.load(r)
+    if not modify:
+        _cache_json(filename, identity, obj)
+    return obj
+
+def write_json(obj: Any, output = None, indent: Optional[int] = 4, end: str = '\n') -> None:
+    '''Write obj in JSON format followed by end into output (file name or text file object, default: sys.stdout).
+    If output is a file name, keep the object in memory cache, so that a following read_json of the same file (without modify) in this process does not need to parse it.
+    The caller must not modify the object afterwards.'''
+    if output is None:
+        output = sys.stdout
+    if isinstance(output, str):
+        with open(output, 'w', encoding=DEFAULT_ENCODING) as w:
+            write_json(obj, w, indent=indent, end=end)
+        _cache_json(output, _file_identity(output), obj)
+        return
+    json.dump(obj, output, indent=indent)
+    output.write(end)
+    output.flush()
+
 class LazyDict:
     def __init__(self, initializer: Callable[[K], V]):
         self.initializer = initializer
@@ -178,9 +239,16 @@ class UniProtManager:
                     result_range = (start, end)
         print (pdb, chain, ranges_str, ranges, 'map to', result_id, file=sys.stderr)
         return (result_id, result_name)
+    def prefetch(self, pdbs: Iterable[str], progress_bar: Optional['ProgressBar'] = None) -> None:
+        '''Download UniProt mappings for multiple PDB entries (batched concurrent requests).'''
+        pdbs = [pdb for pdb in pdbs if pdb not in self.pdb2chain2rangeuniidnames]
+        responses = rest_client.get_client().get_many_by_id(self.source_url.rstrip('/') + '/', pdbs, progress_bar=progress_bar)
+        for pdb, response in zip(pdbs, responses):
+            self._add_pdb_response(pdb, response.json())
     def _add_pdb(self, pdb: str) -> None:
-        url = f'{self.source_url}/{pdb}'
-        r = json.loads(requests.get(url).text)
+        url = self.source_url.rstrip('/') + '/' + pdb
+        self._add_pdb_response(pdb, rest_client.get_client().get(url).json())
+    def _add_pdb_response(self, pdb: str, r: dict) -> None:
         unip = r[pdb]['UniProt']
         chain2rangeuniidnames: Dict[str, List[Tuple[int,int,str,str]]] = {}
         for uni_id, uni_annot in unip.items():
@@ -299,62 +367,425 @@ class ProgressBar:
         self.writer.flush()
 
 
-Task = namedtuple('Task', ['name', 'function', 'args', 'kwargs', 'stdin', 'stdout', 'stderr', 'pre_message', 'post_message'])
+Task = namedtuple('Task', ['name', 'function', 'args', 'kwargs', 'stdin', 'stdout', 'stderr', 'pre_message', 'post_message', 'inputs', 'outputs', 'external'])
+
+HASH_CHUNK_SIZE = 1 << 20
+
+def _run_task_function(function: Callable, args, kwargs, stdin: Optional[str], stdout: Optional[str], stderr: Optional[str], 
+        profile: bool = False, cprofile_file: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''Call function(*args, **kwargs) with redirected standard streams (also used to run a task in a worker process).
+    If profile is True, measure resources used by the call and return them as a dictionary.
+    If cprofile_file is given, dump cProfile statistics of the call into this file (independently of profile).'''
+    if not profile:
+        with RedirectIO(stdin=stdin, stdout=stdout, stderr=stderr):
+            _call_with_cprofile(function, args, kwargs, cprofile_file)
+        return None
+    _reset_peak_rss()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_before = _read_process_io()
+    start = time.time()
+    http_requests_before = rest_client.request_count()
+    with RedirectIO(stdin=stdin, stdout=stdout, stderr=stderr):
+        _call_with_cprofile(function, args, kwargs, cprofile_file)
+    wall_time = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = _read_process_io()
+    return {
+        'wall_time': round(wall_time, 3),
+        'cpu_time': round(usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime, 3),
+        'children_cpu_time': round(children_usage.ru_utime + children_usage.ru_stime - children_usage_before.ru_utime - children_usage_before.ru_stime, 3),
+        'peak_rss_kb': _get_peak_rss(usage),
+        'children_peak_rss_kb': children_usage.ru_maxrss if children_usage.ru_maxrss > children_usage_before.ru_maxrss else None,  # None if no subprocess exceeded the previous peak of this process's subprocesses
+        'read_bytes': io['rchar'] - io_before['rchar'] if 'rchar' in io else None,
+        'written_bytes': io['wchar'] - io_before['wchar'] if 'wchar' in io else None,
+        'http_requests': rest_client.request_count() - http_requests_before,
+    }
+
+def _run_task_in_worker(*args, **kwargs) -> Optional[Dict[str, Any]]:
+    '''Run a task in a worker process (see _run_task_function). JSON objects cached by the task are dropped afterwards,
+    so that they are not kept alive in the worker process (the next task in the same process is unlikely to read them).'''
+    try:
+        return _run_task_function(*args, **kwargs)
+    finally:
+        _json_cache.clear()
+
+def _call_with_cprofile(function: Callable, args, kwargs, cprofile_file: Optional[str] = None) -> None:
+    '''Call function(*args, **kwargs), if cprofile_file is given, dump cProfile statistics of the call into this file.'''
+    if cprofile_file is None:
+        function(*args, **kwargs)
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(cprofile_file)
+
+def _reset_peak_rss() -> None:
+    '''Reset the peak resident set size of the current process (Linux only, otherwise the peak is measured since the process start).'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as w:
+            w.write('5')
+    except OSError:
+        pass
+
+def _get_peak_rss(usage) -> int:
+    '''Get the peak resident set size (in kB) of the current process since the last _reset_peak_rss() (if supported).'''
+    try:
+        with open('/proc/self/status') as r:
+            match = re.search(r'^VmHWM:\s*(\d+)', r.read(), re.MULTILINE)
+        if match is not None:
+            return int(match.group(1))
+    except OSError:
+        pass
+    return usage.ru_maxrss
+
+def _read_process_io() -> Dict[str, int]:
+    '''Read I/O counters of the current process (Linux only, otherwise return empty dictionary).'''
+    try:
+        with open('/proc/self/io') as r:
+            return { key.strip(): int(value) for key, value in (line.split(':') for line in r if ':' in line) }
+    except OSError:
+        return {}
+
+def _pattern_base(path: str) -> str:
+    '''Get the directory containing all files matched by a glob pattern (the leading components without wildcards), or path itself if it is not a pattern.'''
+    if not glob.has_magic(path):
+        return path
+    components = os.path.normpath(path).split(os.sep)
+    first_magic = next(i for i, component in enumerate(components) if glob.has_magic(component))
+    return os.sep.join(components[:first_magic]) or os.curdir
+
+def _paths_overlap(path1: str, path2: str) -> bool:
+    '''Decide whether two paths are the same or one of them is a directory containing the other (glob patterns are replaced by their base directory).'''
+    path1 = os.path.normpath(_pattern_base(path1))
+    path2 = os.path.normpath(_pattern_base(path2))
+    return path1 == path2 or path1.startswith(path2 + os.sep) or path2.startswith(path1 + os.sep)
+
+def _list_files_recursive(directory: str) -> List[str]:
+    '''List all files in directory and its subdirectories (sorted paths relative to directory).'''
+    result = []
+    for root, subdirs, files in os.walk(directory):
+        for filename in files:
+            result.append(os.path.relpath(os.path.join(root, filename), directory))
+    return sorted(result)
 
 class Pipeline:
 
-    def __init__(self, checkpoint_file=None):
+    def __init__(self, checkpoint_file=None, n_processes: int = 1, cache_dir: Optional[str] = None, profile_file: Optional[str] = None, cprofile_dir: Optional[str] = None):
+        '''Tasks with declared inputs and outputs will run in up to n_processes parallel processes.
+        If cache_dir is given, outputs of tasks with declared inputs and outputs are stored in a content-addressed cache 
+        and restored (instead of running the task) when the task is run again with the same inputs, arguments and code.
+        If profile_file is given, resources used by each task (wall and CPU time, peak RSS, bytes read and written, HTTP requests) are written into this JSON file.
+        If cprofile_dir is given, cProfile statistics of each task are dumped into this directory.'''
+        if profile_file is not None and resource is None:
+            raise Exception('Measuring resources used by tasks (profile_file) is not supported on this system')
         self.checkpoint_file = checkpoint_file
+        self.n_processes = n_processes
+        self.cache_dir = cache_dir
+        self.profile_file = profile_file
+        self.cprofile_dir = cprofile_dir
         self.tasks = []
+        self.timeline = []  # (task, start time, end time, status, measured resources)
+        self.file_hashes = {}  # (file, size, mtime) -> hash
     
     def add_task(self, name: str, function: Callable, *args,
             stdin: Optional[str] = None, stdout: Optional[str] = None, stderr: Optional[str] = None, 
             pre_message: Optional[str] = None, post_message: Optional[str] = None, 
+            inputs: Optional[Iterable[str]] = None, outputs: Optional[Iterable[str]] = None, external: bool = False,
             kwargs = {}, **kwargs_):
         '''Append new task to the pipeline. 
         The task will be called as function(*args, **kwargs_). 
         If a keyword argument conflicts with a keyword arguments of add_task, use kwargs instead of kwargs_.
-        Task names must be unique and not contain newline characters. 
+        Task names must be unique and not contain newline or tab characters. 
         Task name can be None - such tasks are not logged into checkpoint file and will be repeated after resume.
+        inputs and outputs are files or directories read and written by the task (stdin is added to inputs, stdout and stderr to outputs).
+        They can also be glob patterns (e.g. 'structures/*.cif'), which stand for all matching files when the task is checked or cached.
+        A task with declared inputs or outputs waits only for the previous tasks it conflicts with (by writing its inputs or reading/writing its outputs),
+        and it can run in a worker process in parallel with other tasks (so function and arguments must be picklable).
+        A task with neither inputs nor outputs declared runs in the main process after all previous tasks and before all following tasks.
+        A named task with declared inputs or outputs is repeated after resume only if its inputs, arguments or the source file of its function changed
+        (or its outputs are missing), unless external is True (i.e. the task reads external data, e.g. from web APIs, so its results cannot be reused based on inputs).
         '''
-        if name is not None and '\n' in name:
-            raise ValueError(f'Task name must not contain newline character.')
+        if name is not None and ('\n' in name or '\t' in name):
+            raise ValueError(f'Task name must not contain newline or tab character.')
         if name is not None and any(task.name == name for task in self.tasks):
             raise ValueError(f'Duplicate task name in pipeline: {name}. Use unique task names!')
         if len(kwargs) > 0 and len(kwargs_) > 0:
             raise ValueError('Use either kwargs or **kwargs_, not both!')
         kwargs_.update(kwargs)
-        self.tasks.append(Task(name, function, args, kwargs_, stdin, stdout, stderr, pre_message, post_message))
+        if inputs is not None or outputs is not None:
+            inputs = tuple(inputs or ()) + tuple(file for file in [stdin] if file is not None)
+            outputs = tuple(outputs or ()) + tuple(file for file in [stdout, stderr] if file is not None)
+        self.tasks.append(Task(name, function, args, kwargs_, stdin, stdout, stderr, pre_message, post_message, inputs, outputs, external))
     
     def start(self):
-        '''Perform all tasks in the pipeline.'''
+        '''Perform all tasks in the pipeline (outputs of tasks can be restored from cache).'''
         if self.checkpoint_file is not None:
             with open(self.checkpoint_file, 'w', encoding=DEFAULT_ENCODING) as f:
                 f.write('')
-        for task in self.tasks:
-            self._do_task(task)
+        self._do_tasks(self.tasks, {})
     
     def resume(self):
-        '''Perform all tasks in the pipeline, except for those completed earlier (i.e. listed in the checkpoint file).'''
+        '''Perform all tasks in the pipeline, except for those completed earlier (i.e. listed in the checkpoint file) 
+        and still up to date (i.e. their inputs, arguments and code have not changed).'''
+        completed_tasks = {}  # task name -> signature (None if not recorded)
         if self.checkpoint_file is not None:
             try: 
                 with open(self.checkpoint_file, 'r', encoding=DEFAULT_ENCODING) as f:
-                    completed_tasks = [line.rstrip('\n\r') for line in f]
+                    for line in f:
+                        name, _, signature = line.rstrip('\n\r').partition('\t')
+                        completed_tasks[name] = signature or None
             except OSError:
-                completed_tasks = []
-        else:
-            completed_tasks = []
-        for task in self.tasks:
-            if task.name not in completed_tasks:
-                self._do_task(task)
+                pass
+        self._do_tasks([task for task in self.tasks if task.name not in completed_tasks or self._is_checkable(task)], completed_tasks)
+
+    def _do_tasks(self, tasks: List[Task], completed_tasks: Dict[str, Optional[str]]) -> None:
+        self.start_time = time.time()
+        self.timeline = []
+        try:
+            if self.n_processes > 1:
+                self._do_tasks_parallel(tasks, completed_tasks)
+            else:
+                for task in tasks:
+                    start = time.time()
+                    signature = self._try_reuse(task, completed_tasks, start)
+                    if signature is not False:
+                        self._do_task(task, signature)
+        finally:
+            self._print_timeline()
+            if self.profile_file is not None:
+                self._write_profile()
+
+    def _do_tasks_parallel(self, tasks: List[Task], completed_tasks: Dict[str, Optional[str]]) -> None:
+        dependencies = self._get_dependencies(tasks)
+        waiting = list(range(len(tasks)))
+        done = set()
+        running = {}  # future -> (task index, start time, signature)
+        error = None
+        with ProcessPoolExecutor(max_workers=self.n_processes) as executor:
+            while (len(waiting) > 0 and error is None) or len(running) > 0:
+                scheduled_all = False
+                while error is None and not scheduled_all:
+                    scheduled_all = True
+                    for i in [i for i in waiting if dependencies[i] <= done]:
+                        task = tasks[i]
+                        waiting.remove(i)
+                        if task.inputs is None:
+                            # Barrier task (all previous tasks are done, all following tasks wait for it)
+                            self._do_task(task)
+                            done.add(i)
+                            scheduled_all = False
+                            break
+                        start = time.time()
+                        signature = self._try_reuse(task, completed_tasks, start)
+                        if signature is False:
+                            done.add(i)
+                            scheduled_all = False
+                            break  # following tasks may be ready now
+                        self._task_started(task)
+                        future = executor.submit(_run_task_in_worker, task.function, task.args, task.kwargs, task.stdin, task.stdout, task.stderr, **self._profiling_options(task))
+                        running[future] = (i, start, signature)
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i, start, signature = running.pop(future)
+                    try:
+                        resources = future.result()
+                    except Exception as ex:
+                        if error is None:
+                            error = ex
+                        continue
+                    self._task_finished(tasks[i], start, signature, resources=resources)
+                    done.add(i)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _get_dependencies(tasks: List[Task]) -> List[Set[int]]:
+        '''Get indices of the tasks which must be completed before each task.'''
+        dependencies = []
+        last_barrier = None
+        for i, task in enumerate(tasks):
+            if task.inputs is None:
+                last_barrier = i
+                dependencies.append(set(range(i)))
+            else:
+                first = 0 if last_barrier is None else last_barrier + 1
+                conflicting = { j for j in range(first, i) if Pipeline._tasks_conflict(tasks[j], task) }
+                dependencies.append(conflicting | ({last_barrier} if last_barrier is not None else set()))
+        return dependencies
+
+    @staticmethod
+    def _tasks_conflict(first: Task, second: Task) -> bool:
+        '''Decide whether the second task must wait for the first task (one of them writes what the other reads or writes).'''
+        return (any(_paths_overlap(output, file) for output in first.outputs for file in second.inputs + second.outputs)
+            or any(_paths_overlap(file, output) for file in first.inputs for output in second.outputs))
+
+    @staticmethod
+    def _is_checkable(task: Task) -> bool:
+        '''Decide whether the task can be skipped or restored from cache based on its signature.'''
+        return task.name is not None and task.inputs is not None and not task.external
+
+    def _try_reuse(self, task: Task, completed_tasks: Dict[str, Optional[str]], start: float) -> Union[str, None, bool]:
+        '''Skip the task if it is up to date or restore its outputs from cache, return False in such case. 
+        Otherwise return the signature of the task (None if the task is not checkable).'''
+        if not self._is_checkable(task):
+            return None
+        signature = self._task_signature(task)
+        if completed_tasks.get(task.name) == signature and all(self._output_exists(output) for output in task.outputs):
+            self._task_finished(task, start, signature, status='up to date')
+            return False
+        if self.cache_dir is not None and self._restore_from_cache(task, signature):
+            self._task_finished(task, start, signature, status='from cache')
+            return False
+        return signature
     
-    def _do_task(self, task):
+    def _do_task(self, task, signature: Optional[str] = None):
+        start = time.time()
+        self._task_started(task)
+        resources = _run_task_function(task.function, task.args, task.kwargs, task.stdin, task.stdout, task.stderr, **self._profiling_options(task))
+        self._task_finished(task, start, signature, resources=resources)
+
+    def _profiling_options(self, task: Task) -> Dict[str, Any]:
+        '''Get profiling arguments for _run_task_function.'''
+        if (self.profile_file is None and self.cprofile_dir is None) or task.name is None:
+            return {}
+        if self.cprofile_dir is not None:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+            cprofile_file = os.path.join(self.cprofile_dir, re.sub(r'[^\w.-]+', '_', task.name) + '.prof')
+        else:
+            cprofile_file = None
+        return { 'profile': self.profile_file is not None, 'cprofile_file': cprofile_file }
+
+    def _task_started(self, task: Task) -> None:
         if task.pre_message is not None:
             print(task.pre_message)
-        with RedirectIO(stdin=task.stdin, stdout=task.stdout, stderr=task.stderr):
-            result = task.function(*task.args, **task.kwargs)
+
+    def _task_finished(self, task: Task, start: float, signature: Optional[str], status: str = 'run', resources: Optional[Dict[str, Any]] = None) -> None:
+        if signature is not None and status == 'run' and self.cache_dir is not None:
+            self._store_to_cache(task, signature)
+        self.timeline.append((task, start, time.time(), status, resources))
         if self.checkpoint_file is not None and task.name is not None:
             with open(self.checkpoint_file, 'a', encoding=DEFAULT_ENCODING) as f:
-                f.write(task.name + '\n')
-        if task.post_message is not None:
+                f.write(task.name + ('\t' + signature if signature is not None else '') + '\n')
+        if task.post_message is not None and status == 'run':
             print(task.post_message)
+
+    def _print_timeline(self) -> None:
+        named_timeline = [(task, start, end, status) for task, start, end, status, resources in self.timeline if task.name is not None]
+        if len(named_timeline) == 0:
+            return
+        print('\nTask timeline (seconds since start):')
+        print(f'{"start":>9} {"end":>9} {"time":>9}  {"status":<10}  task')
+        for task, start, end, status in sorted(named_timeline, key=lambda t: t[1]):
+            print(f'{start - self.start_time:9.1f} {end - self.start_time:9.1f} {end - start:9.1f}  {status:<10}  {task.name}')
+
+    def _write_profile(self) -> None:
+        '''Write resources used by the tasks into the profile file and print a summary sorted by wall time.'''
+        records = [ dict(task=task.name, status=status, start=round(start - self.start_time, 3), **(resources or {})) 
+                    for task, start, end, status, resources in self.timeline if task.name is not None ]
+        with open(self.profile_file, 'w', encoding=DEFAULT_ENCODING) as w:
+            json.dump(records, w, indent=4)
+        measured = sorted((record for record in records if 'wall_time' in record), key=lambda record: -record['wall_time'])
+        if len(measured) == 0:
+            return
+        def fmt(value, scale=1):
+            return f'{value / scale:.1f}' if value is not None else '?'
+        print(f'\nTask resources (sorted by wall time, details in {self.profile_file}):')
+        print(f'{"wall[s]":>9} {"cpu[s]":>9} {"child[s]":>9} {"rss[MB]":>9} {"read[MB]":>9} {"write[MB]":>9} {"http":>6}  task')
+        for record in measured:
+            print(f'{fmt(record["wall_time"]):>9} {fmt(record["cpu_time"]):>9} {fmt(record["children_cpu_time"]):>9} {fmt(record["peak_rss_kb"], 1024):>9} '
+                  f'{fmt(record["read_bytes"], 1 << 20):>9} {fmt(record["written_bytes"], 1 << 20):>9} {record["http_requests"]:>6}  {record["task"]}')
+
+    def _file_hash(self, filename: str) -> str:
+        '''Compute SHA-256 hash of the file content (remember the hashes of files which have not been modified since).'''
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if key not in self.file_hashes:
+            hasher = hashlib.sha256()
+            with open(filename, 'rb') as r:
+                for chunk in iter(lambda: r.read(HASH_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+            self.file_hashes[key] = hasher.hexdigest()
+        return self.file_hashes[key]
+
+    @staticmethod
+    def _output_exists(output: str) -> bool:
+        '''Decide whether an output file or directory exists (for a glob pattern, whether any file matches).'''
+        if glob.has_magic(output):
+            return any(os.path.isfile(filename) for filename in glob.glob(output))
+        return os.path.exists(output)
+
+    def _content_hashes(self, file_or_dir: str) -> Union[str, List[Tuple[str, str]], None]:
+        '''Get hash of a file, list of (relative path, hash) for files in a directory or files matching a glob pattern 
+        (relative to its base directory), or None for a non-existing path.'''
+        if glob.has_magic(file_or_dir):
+            base = _pattern_base(file_or_dir)
+            return [(os.path.relpath(filename, base), self._file_hash(filename)) for filename in sorted(glob.glob(file_or_dir)) if os.path.isfile(filename)]
+        elif os.path.isfile(file_or_dir):
+            return self._file_hash(file_or_dir)
+        elif os.path.isdir(file_or_dir):
+            return [(filename, self._file_hash(os.path.join(file_or_dir, filename))) for filename in _list_files_recursive(file_or_dir)]
+        else:
+            return None
+
+    def _task_signature(self, task: Task) -> str:
+        '''Compute hash of everything that determines the results of the task: 
+        function and its source file, arguments, redirections, declared outputs, and the content of declared inputs.'''
+        function_name = f'{getattr(task.function, "__module__", None)}.{getattr(task.function, "__qualname__", repr(task.function))}'
+        try:
+            code_version = self._file_hash(inspect.getsourcefile(task.function))
+        except (TypeError, OSError):
+            code_version = None
+        description = [task.name, function_name, code_version, repr(task.args), repr(sorted(task.kwargs.items())), 
+                       task.stdin, task.stdout, task.stderr, task.outputs, [(file, self._content_hashes(file)) for file in task.inputs]]
+        return hashlib.sha256(json.dumps(description).encode(DEFAULT_ENCODING)).hexdigest()
+
+    def _store_to_cache(self, task: Task, signature: str) -> None:
+        '''Store the outputs of a task into the cache (file contents are stored by their hash, so each content is stored only once).'''
+        objects_dir = os.path.join(self.cache_dir, 'objects')
+        tasks_dir = os.path.join(self.cache_dir, 'tasks')
+        os.makedirs(objects_dir, exist_ok=True)
+        os.makedirs(tasks_dir, exist_ok=True)
+        outputs = { output: self._content_hashes(output) for output in task.outputs }
+        for output, hashes in outputs.items():
+            if isinstance(hashes, str):
+                files = [(output, hashes)]
+            else:
+                files = [(os.path.join(_pattern_base(output), filename), hash) for filename, hash in hashes or []]
+            for filename, hash in files:
+                object_file = os.path.join(objects_dir, hash)
+                if not os.path.isfile(object_file):
+                    shutil.copyfile(filename, object_file + '.tmp')
+                    os.replace(object_file + '.tmp', object_file)
+        with open(os.path.join(tasks_dir, signature + '.json.tmp'), 'w', encoding=DEFAULT_ENCODING) as w:
+            json.dump(outputs, w)
+        os.replace(os.path.join(tasks_dir, signature + '.json.tmp'), os.path.join(tasks_dir, signature + '.json'))
+
+    def _restore_from_cache(self, task: Task, signature: str) -> bool:
+        '''Restore the outputs of a task from the cache, return False if the task is not in the cache.'''
+        objects_dir = os.path.join(self.cache_dir, 'objects')
+        try:
+            with open(os.path.join(self.cache_dir, 'tasks', signature + '.json'), encoding=DEFAULT_ENCODING) as r:
+                outputs = json.load(r)
+        except (OSError, ValueError):
+            return False
+        files = []
+        for output, hashes in outputs.items():
+            if isinstance(hashes, str):
+                files.append((output, hashes))
+            else:
+                os.makedirs(_pattern_base(output), exist_ok=True)
+                files.extend((os.path.join(_pattern_base(output), filename), hash) for filename, hash in hashes or [])
+        if not all(os.path.isfile(os.path.join(objects_dir, hash)) for filename, hash in files):
+            return False
+        for filename, hash in files:
+            if os.path.dirname(filename) != '':
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+            shutil.copyfile(os.path.join(objects_dir, hash), filename)
+        return True
@@ -0,0 +1,449 @@
+'''
+This Python3 module provides a shared client for REST APIs (PDBe API, EBI Proteins API), used by the data preparation scripts:
+pooled HTTP session (connection reuse), bounded concurrency, retry with exponential backoff on 429/5xx responses and connection errors,
+and on-disk response cache keyed by URL with time-to-live.
+Files (e.g. structures) are downloaded by streaming directly to disk (with on-the-fly gzip decompression, atomic rename and conditional revalidation).
+All HTTP and FTP responses can be recorded into an archive (SQLite file) and replayed from it later (offline, deterministically).
+
+The client is configured by environment variables (so that the configuration is inherited by subprocesses), see configure().
+
+Example usage:
+    import rest_client
+    response = rest_client.get_client().get('https://www.ebi.ac.uk/pdbe/api/pdb/entry/molecules/1tqn')
+    responses = rest_client.get_client().get_many(urls)
+    responses = rest_client.get_client().get_many_by_id('https://www.ebi.ac.uk/pdbe/api/pdb/entry/molecules/', pdbs)
+    results = rest_client.get_client().download_many([('https://files.rcsb.org/download/1tqn.cif.gz', '1tqn.cif', None)], gunzip=True)
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import sqlite3
+import zlib
+import email.utils
+import ftplib
+import requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple, Any, Optional, Iterable
+
+#  CONSTANTS  ################################################################################
+
+CACHE_DIR_VARIABLE = 'SECSTRAPI_REST_CACHE_DIR'
+CACHE_TTL_VARIABLE = 'SECSTRAPI_REST_CACHE_TTL'
+CONCURRENCY_VARIABLE = 'SECSTRAPI_REST_CONCURRENCY'
+BATCH_SIZE_VARIABLE = 'SECSTRAPI_REST_BATCH_SIZE'
+ARCHIVE_VARIABLE = 'SECSTRAPI_REST_ARCHIVE'
+ARCHIVE_MODE_VARIABLE = 'SECSTRAPI_REST_ARCHIVE_MODE'
+RECORD = 'record'
+REPLAY = 'replay'
+
+DEFAULT_CACHE_TTL = 24 * 3600  # seconds
+DEFAULT_CONCURRENCY = 8
+DEFAULT_BATCH_SIZE = 100  # maximum number of IDs in one POST request
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0  # seconds, doubled with each retry
+MAX_RETRY_DELAY = 60.0  # seconds
+REQUEST_TIMEOUT = 60  # seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+CACHEABLE_STATUS_CODES = (200, 404)
+CACHE_FILE_EXT = '.response'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+GZIP_LEVEL = 6
+
+#  FUNCTIONS  ################################################################################
+
+class ReplayMissError(Exception):
+    '''Raised in replay mode when the archive does not contain the response for a request.'''
+    pass
+
+class RestResponse(namedtuple('RestResponse', ['url', 'status_code', 'content', 'from_cache'])):
+    '''HTTP response (downloaded or read from cache).'''
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+# Result of RestClient.download(): modified = whether destination_file was (re)written, validators = {'ETag': ..., 'Last-Modified': ...} for later revalidation
+DownloadResult = namedtuple('DownloadResult', ['url', 'destination_file', 'status_code', 'modified', 'validators'])
+
+class ResponseArchive:
+    '''Archive of recorded responses (SQLite file, response contents compressed by zlib), indexed by method, URL and request body.'''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (method TEXT, url TEXT, body TEXT, status_code INTEGER, content BLOB, PRIMARY KEY (method, url, body))')
+
+    def get(self, method: str, url: str, body: str = '') -> Optional[Tuple[int, bytes]]:
+        '''Return recorded (status code, content), or None if not recorded.'''
+        with self.lock:
+            row = self.connection.execute('SELECT status_code, content FROM responses WHERE method=? AND url=? AND body=?', (method, url, body)).fetchone()
+        if row is None:
+            return None
+        status_code, content = row
+        return status_code, zlib.decompress(content)
+
+    def put(self, method: str, url: str, body: str, status_code: int, content: bytes) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (method, url, body, status_code, zlib.compress(content)))
+
+class RestClient:
+    '''HTTP client with pooled session, retries with backoff, bounded concurrency, and on-disk cache.'''
+
+    def __init__(self, cache_dir: Optional[str] = None, cache_ttl: float = DEFAULT_CACHE_TTL, concurrency: int = DEFAULT_CONCURRENCY, batch_size: int = DEFAULT_BATCH_SIZE,
+            archive: Optional[str] = None, archive_mode: Optional[str] = None):
+        '''cache_dir = directory for cached responses (None = no cache), cache_ttl = maximum age of used cached responses (in seconds),
+        concurrency = maximum number of simultaneous requests in get_many(), batch_size = maximum number of IDs in one request in get_many_by_id(),
+        archive = archive file for recording or replaying responses, archive_mode = RECORD (save all responses into archive) or REPLAY (take all responses from archive, no network access).
+        Cache is not used when recording or replaying (so that the archive contains all requests and the replay is deterministic).'''
+        if archive_mode not in (None, RECORD, REPLAY):
+            raise ValueError(f'Invalid archive mode: {archive_mode}')
+        if archive_mode is not None and archive is None:
+            raise ValueError(f'Archive file must be specified for archive mode {archive_mode}')
+        if archive_mode == REPLAY and not os.path.isfile(archive):
+            raise FileNotFoundError(f'Replay archive {archive} does not exist')
+        self.archive = ResponseArchive(archive) if archive_mode is not None else None
+        self.archive_mode = archive_mode
+        self.cache_dir = cache_dir if archive_mode is None else None
+        self.cache_ttl = cache_ttl
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.saved_requests = 0  # number of requests saved by batching
+        self.stats_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.hooks['response'].append(_count_response)
+        self.pool_size = 0
+        self._resize_pool(concurrency)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, url: str, use_cache: bool = True) -> RestResponse:
+        '''Send GET request to url (retry on 429/5xx and connection errors), or return the cached response if it is not older than cache TTL.'''
+        if use_cache:
+            cached = self._read_cache(url)
+            if cached is not None:
+                return cached
+        response = self._request_with_retries('GET', url)
+        if use_cache:
+            self._write_cache(url, response)
+        return response
+
+    def get_many(self, urls: Iterable[str], use_cache: bool = True, progress_bar = None) -> List[RestResponse]:
+        '''Send GET requests to all urls (at most self.concurrency requests at the same time), return the responses in the same order as urls.
+        If progress_bar (lib.ProgressBar) is given, make one step for each completed request.'''
+        urls = list(urls)
+        responses: List[Optional[RestResponse]] = [None] * len(urls)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = { executor.submit(self.get, url, use_cache=use_cache): i for i, url in enumerate(urls) }
+            for future in as_completed(futures):
+                responses[futures[future]] = future.result()
+                if progress_bar is not None:
+                    progress_bar.step()
+        return responses
+
+    def get_many_by_id(self, base_url: str, ids: Iterable[str], use_cache: bool = True, progress_bar = None) -> List[RestResponse]:
+        '''Get responses for GET base_url+id for all ids, in the same order as ids (responses have the form {id: data}, as in PDBe API).
+        Uncached IDs are requested in batches of up to self.batch_size IDs by POST base_url with comma-separated IDs (supported by many PDBe API endpoints).
+        Batch responses are split into per-ID responses (and cached as such). IDs missing in a batch response or belonging to a failed batch are requested one by one.
+        If progress_bar (lib.ProgressBar) is given, make one step for each ID.'''
+        ids = list(ids)
+        responses: Dict[str, RestResponse] = {}
+        if use_cache:
+            for id in ids:
+                cached = self._read_cache(base_url + id)
+                if cached is not None:
+                    responses[id] = cached
+            if progress_bar is not None:
+                progress_bar.step(len(responses))
+        todo = sorted(set(ids) - responses.keys())
+        batches = [todo[i:i+self.batch_size] for i in range(0, len(todo), self.batch_size)] if self.batch_size > 1 else []
+        n_successful_batches = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for batch_responses in executor.map(lambda batch: self._get_batch(base_url, batch, use_cache), batches):
+                responses.update(batch_responses)
+                n_successful_batches += len(batch_responses) > 0
+                if progress_bar is not None:
+                    progress_bar.step(len(batch_responses))
+        remaining = [id for id in todo if id not in responses]
+        for id, response in zip(remaining, self.get_many((base_url + id for id in remaining), use_cache=use_cache, progress_bar=progress_bar)):
+            responses[id] = response
+        n_batched = len(todo) - len(remaining)
+        n_saved = n_batched - n_successful_batches
+        with self.stats_lock:
+            self.saved_requests += n_saved
+        if len(todo) > 0:
+            sys.stderr.write(f'Requested {len(todo)} IDs from {base_url} ({len(ids) - len(todo)} cached): {n_batched} IDs in {len(batches)} batch requests, {len(remaining)} single requests, saved {n_saved} requests\n')
+        return [responses[id] for id in ids]
+
+    def _get_batch(self, base_url: str, ids: List[str], use_cache: bool) -> Dict[str, RestResponse]:
+        '''Request multiple IDs by one POST request, return per-ID responses for IDs found in the response (empty if the request failed).'''
+        try:
+            response = self._request_with_retries('POST', base_url, data=','.join(ids))
+            data = response.json() if response.ok else None
+        except (requests.RequestException, ValueError, ReplayMissError):
+            data = None  # e.g. the batch was recorded with a different batch size, its IDs are replayed one by one
+        if not isinstance(data, dict):
+            sys.stderr.write(f'WARNING: batch request POST {base_url} ({len(ids)} IDs) failed, falling back to single requests\n')
+            return {}
+        result = {}
+        for id in ids:
+            if id in data:
+                single_response = RestResponse(base_url + id, 200, json.dumps({id: data[id]}).encode('utf-8'), False)
+                if use_cache:
+                    self._write_cache(single_response.url, single_response)
+                result[id] = single_response
+        return result
+
+    def download_many(self, downloads: Iterable[Tuple[str, str, Optional[Dict[str, str]]]], gunzip: bool = False, compress: bool = False, 
+            concurrency: Optional[int] = None, progress_bar = None) -> List[DownloadResult]:
+        '''Download files given as (url, destination_file, validators) by download(), using concurrency simultaneous connections (default: self.concurrency).
+        Return the results in the same order as downloads (status_code is None if the download failed due to connection errors).
+        If progress_bar (lib.ProgressBar) is given, make one step for each completed download.'''
+        downloads = list(downloads)
+        concurrency = concurrency or self.concurrency
+        self._resize_pool(concurrency)
+        results: List[Optional[DownloadResult]] = [None] * len(downloads)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = { executor.submit(self.download, url, destination_file, gunzip=gunzip, compress=compress, validators=validators): i 
+                        for i, (url, destination_file, validators) in enumerate(downloads) }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except requests.RequestException as ex:
+                    url, destination_file, _ = downloads[i]
+                    sys.stderr.write(f'WARNING: GET {url} failed ({type(ex).__name__})\n')
+                    results[i] = DownloadResult(url, destination_file, None, False, {})
+                if progress_bar is not None:
+                    progress_bar.step()
+        return results
+
+    def download(self, url: str, destination_file: str, gunzip: bool = False, compress: bool = False, validators: Optional[Dict[str, str]] = None) -> DownloadResult:
+        '''Download url into destination_file by streaming in chunks (the whole file is never held in memory), 
+        decompress gzip on the fly if gunzip, compress into gzip on the fly if compress.
+        The file is written atomically (temporary file + rename), so it is never left incomplete.
+        If destination_file exists, send a conditional request (If-None-Match/If-Modified-Since, based on validators from the previous download or on the file modification time)
+        and keep the file if the server responds 304 Not Modified. Retry on 429/5xx and connection errors.
+        Conditional requests are not used when recording or replaying.'''
+        if self.archive_mode == REPLAY:
+            status_code, content = self._replay('GET', url)
+            if 200 <= status_code < 300:
+                self._stream_to_file([content], destination_file, gunzip, compress)
+            return DownloadResult(url, destination_file, status_code, 200 <= status_code < 300, {})
+        headers = {}
+        if self.archive_mode is None and os.path.isfile(destination_file):
+            validators = validators or {}
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            headers['If-Modified-Since'] = validators.get('Last-Modified') or email.utils.formatdate(os.path.getmtime(destination_file), usegmt=True)
+        recorded_chunks = [] if self.archive_mode == RECORD else None
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                    if response.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                        sys.stderr.write(f'WARNING: GET {url} returned status {response.status_code}, retrying\n')
+                        time.sleep(self._retry_delay(attempt, response.headers.get('Retry-After')))
+                        continue
+                    new_validators = { header: response.headers[header] for header in VALIDATOR_HEADERS if header in response.headers }
+                    if response.status_code == 304:
+                        return DownloadResult(url, destination_file, response.status_code, False, new_validators or validators or {})
+                    chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+                    if recorded_chunks is not None:
+                        recorded_chunks.clear()
+                        chunks = self._tee(chunks, recorded_chunks)
+                    if response.ok:
+                        self._stream_to_file(chunks, destination_file, gunzip, compress)
+                    else:
+                        for chunk in chunks:  # only for recording
+                            pass
+                    status_code = response.status_code
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as ex:
+                if attempt == MAX_RETRIES:
+                    raise
+                sys.stderr.write(f'WARNING: GET {url} failed ({type(ex).__name__}), retrying\n')
+                time.sleep(self._retry_delay(attempt))
+        if recorded_chunks is not None:
+            self.archive.put('GET', url, '', status_code, b''.join(recorded_chunks))
+        return DownloadResult(url, destination_file, status_code, 200 <= status_code < 300, new_validators)
+
+    @staticmethod
+    def _tee(chunks: Iterable[bytes], copy: List[bytes]) -> Iterable[bytes]:
+        for chunk in chunks:
+            copy.append(chunk)
+            yield chunk
+
+    @staticmethod
+    def _stream_to_file(chunks: Iterable[bytes], destination_file: str, gunzip: bool = False, compress: bool = False) -> None:
+        '''Write chunks (decompressed if gunzip, compressed if compress) into a temporary file and then rename it to destination_file.'''
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gunzip else None
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        tmp_file = f'{destination_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as w:
+                for chunk in chunks:
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                    w.write(chunk)
+                if compressor is not None:
+                    w.write(compressor.flush())
+                if decompressor is not None:
+                    w.write(decompressor.flush())
+                    if not decompressor.eof:
+                        raise zlib.error(f'Incomplete gzip stream for {destination_file}')
+            os.replace(tmp_file, destination_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def download_ftp(self, address: str, destination_file: str, username: str = 'anonymous') -> None:
+        '''Download file from FTP address (ftp://server/path) into destination_file.'''
+        if address.startswith('ftp://'):
+            address = address[6:]
+        if self.archive_mode == REPLAY:
+            status_code, content = self._replay('FTP', 'ftp://' + address)
+            with open(destination_file, 'wb') as w:
+                w.write(content)
+            return
+        server, filename = address.split('/', maxsplit=1)
+        with ftplib.FTP(server, username) as connection:
+            with open(destination_file, 'wb') as w:
+                connection.retrbinary(f'RETR {filename}', w.write)
+        if self.archive_mode == RECORD:
+            with open(destination_file, 'rb') as r:
+                self.archive.put('FTP', 'ftp://' + address, '', 200, r.read())
+
+    def _replay(self, method: str, url: str, body: str = '') -> Tuple[int, bytes]:
+        recorded = self.archive.get(method, url, body)
+        if recorded is None:
+            raise ReplayMissError(f'Replay archive {self.archive.filename} does not contain response for {method} {url}' + (f' (body: {body[:100]})' if body else ''))
+        return recorded
+
+    def _request_with_retries(self, method: str, url: str, **kwargs) -> RestResponse:
+        body = kwargs.get('data') or ''
+        if self.archive_mode == REPLAY:
+            status_code, content = self._replay(method, url, body)
+            return RestResponse(url, status_code, content, False)
+        response = self._request_with_retries_online(method, url, **kwargs)
+        if self.archive_mode == RECORD:
+            self.archive.put(method, url, body, response.status_code, response.content)
+        return response
+
+    def _request_with_retries_online(self, method: str, url: str, **kwargs) -> RestResponse:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = self.session.request(method, url, timeout=REQUEST_TIMEOUT, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if attempt == MAX_RETRIES:
+                    raise
+                sys.stderr.write(f'WARNING: {method} {url} failed ({type(ex).__name__}), retrying\n')
+                time.sleep(self._retry_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                sys.stderr.write(f'WARNING: {method} {url} returned status {response.status_code}, retrying\n')
+                time.sleep(self._retry_delay(attempt, response.headers.get('Retry-After')))
+                continue
+            return RestResponse(url, response.status_code, response.content, False)
+
+    def _resize_pool(self, pool_size: int) -> None:
+        '''Make sure the session can keep at least pool_size connections per host.'''
+        if pool_size > self.pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.pool_size = pool_size
+
+    @staticmethod
+    def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+        try:
+            return min(float(retry_after), MAX_RETRY_DELAY)
+        except (TypeError, ValueError):
+            return min(RETRY_BASE_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+
+    def _cache_file(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + CACHE_FILE_EXT)
+
+    def _read_cache(self, url: str) -> Optional[RestResponse]:
+        '''Cache file contains a JSON header line {"url", "status_code"} followed by the response content.'''
+        if self.cache_dir is None:
+            return None
+        cache_file = self._cache_file(url)
+        try:
+            if time.time() - os.path.getmtime(cache_file) > self.cache_ttl:
+                return None
+            with open(cache_file, 'rb') as r:
+                header = json.loads(r.readline())
+                content = r.read()
+        except (OSError, ValueError):
+            return None
+        if header.get('url') != url:
+            return None
+        return RestResponse(url, header['status_code'], content, True)
+
+    def _write_cache(self, url: str, response: RestResponse) -> None:
+        if self.cache_dir is None or response.status_code not in CACHEABLE_STATUS_CODES:
+            return
+        cache_file = self._cache_file(url)
+        tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_file, 'wb') as w:
+            w.write(json.dumps({'url': url, 'status_code': response.status_code}).encode('utf-8') + b'\n')
+            w.write(response.content)
+        os.replace(tmp_file, cache_file)
+
+_client: Optional[RestClient] = None
+_client_config = None
+_client_lock = threading.Lock()
+_request_count = 0
+_request_count_lock = threading.Lock()
+
+def _count_response(response: requests.Response, *args, **kwargs) -> None:
+    '''Response hook of the sessions of RestClient, counts HTTP requests (including redirects and retries).'''
+    global _request_count
+    with _request_count_lock:
+        _request_count += 1
+
+def request_count() -> int:
+    '''Get the number of HTTP requests made by all RestClient instances in this process.'''
+    return _request_count
+
+def configure(cache_dir: Optional[str] = None, cache_ttl: float = DEFAULT_CACHE_TTL, concurrency: int = DEFAULT_CONCURRENCY, batch_size: int = DEFAULT_BATCH_SIZE,
+        archive: Optional[str] = None, archive_mode: Optional[str] = None) -> None:
+    '''Set configuration of the shared client for this process and its subprocesses (via environment variables), see RestClient.'''
+    for variable, value in [(CACHE_DIR_VARIABLE, cache_dir), (ARCHIVE_VARIABLE, archive)]:
+        if value is not None:
+            os.environ[variable] = os.path.abspath(value)
+        else:
+            os.environ.pop(variable, None)
+    if archive_mode is not None:
+        os.environ[ARCHIVE_MODE_VARIABLE] = archive_mode
+    else:
+        os.environ.pop(ARCHIVE_MODE_VARIABLE, None)
+    os.environ[CACHE_TTL_VARIABLE] = str(cache_ttl)
+    os.environ[CONCURRENCY_VARIABLE] = str(concurrency)
+    os.environ[BATCH_SIZE_VARIABLE] = str(batch_size)
+
+def get_client() -> RestClient:
+    '''Get the shared client (created according to the current configuration, see configure()).'''
+    global _client, _client_config
+    config = (os.environ.get(CACHE_DIR_VARIABLE), float(os.environ.get(CACHE_TTL_VARIABLE, DEFAULT_CACHE_TTL)), 
+              int(os.environ.get(CONCURRENCY_VARIABLE, DEFAULT_CONCURRENCY)), int(os.environ.get(BATCH_SIZE_VARIABLE, DEFAULT_BATCH_SIZE)),
+              os.environ.get(ARCHIVE_VARIABLE), os.environ.get(ARCHIVE_MODE_VARIABLE))
+    with _client_lock:
+        # A new client in each process (forked processes must not share the session and archive connection)
+        if _client is None or _client_config != (config, os.getpid()):
+            _client = RestClient(*config)
+            _client_config = (config, os.getpid())
+        return _client
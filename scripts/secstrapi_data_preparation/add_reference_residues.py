@@ -10,7 +10,6 @@ from typing import Dict, Any, Optional, Tuple, List, Union
 import os
 from os import path
 import sys
-import json
 from collections import defaultdict
 
 import lib
@@ -39,8 +38,7 @@ def parse_args() -> Dict[str, Any]:
 def main(all_annotations_file: str, reference_alignments_dir: str, labels: Union[str, List[str], None] = None, label2auth_dir: str = None) -> Optional[int]:
     '''Align SSE sequences to reference alignments and add generic numbering information into the annotation file.'''
 
-    with open(all_annotations_file, 'r', encoding=lib.DEFAULT_ENCODING) as r:
-        all_annotations = json.load(r)
+    all_annotations = lib.read_json(all_annotations_file, modify=True)
 
     do_all_labels = labels is None or labels == 'all'
     if not do_all_labels and isinstance(labels, str):
@@ -72,8 +70,7 @@ def main(all_annotations_file: str, reference_alignments_dir: str, labels: Union
                             message = f'{pdb}: reference residue of {label} ({ref_residue}) is not modelled in the structure)'
                             sys.stderr.write(f'  WARNING: {message}\n')
 
-    json.dump(all_annotations, sys.stdout, indent=4)
-    print()
+    lib.write_json(all_annotations)
 
     n_pdbs = len(all_annotations[ANNOTATIONS])
     n_domains = sum( len(doms) for doms in all_annotations[ANNOTATIONS].values() )
@@ -2,7 +2,7 @@
 This Python3 script reads SSE annotations in SecStrAPI format and performs multiple sequence alignment of SSE sequences (separately for each SSE label).
 
 Example usage:
-    python3  align_sequences.py annotations.json  --labels A,B,C  --alignments_dir aligments/  --trees_dir trees_NR/  --logos_dir logos_NR/
+    python3  align_sequences.py annotations.json  --labels A,B,C  --alignments_dir aligments/  --trees_dir trees_NR/  --logos_dir logos_NR/  --processes 8
 '''
 
 import argparse
@@ -12,7 +12,9 @@ from os import path
 import shutil
 import sys
 import json
+from io import StringIO
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import lib
 import no_gap_align
@@ -20,9 +22,28 @@ from constants import *
 
 #  CONSTANTS  ################################################################################
 
+LOGO_UNITS = 'bits'
 
 #  FUNCTIONS  ################################################################################
 
+def align_label(label: str, names: List[str], sequences: List[str], alignments_dir: Optional[str] = None, trees_dir: Optional[str] = None, 
+        logos_dir: Optional[str] = None, matrices_dir: Optional[str] = None, ref_residue: int = 50) -> str:
+    '''Align sequences of one SSE label and write the output files for this label. Return the row of column statistics for this label.'''
+    aligner = no_gap_align.NoGapAligner()
+    aligner.align(sequences, names=names)
+    if alignments_dir is not None:
+        aligner.output_alignment(path.join(alignments_dir, label + '.fasta'))
+    if trees_dir is not None:
+        aligner.print_tree(output_file=path.join(trees_dir, label + '.txt'))
+    if logos_dir is not None:
+        aligner.output_logo(path.join(logos_dir, label + '.png'), tool='logomaker', pivot_as=ref_residue, units=LOGO_UNITS)
+        aligner.output_logo(path.join(logos_dir, label + '.tif'), tool='logomaker', pivot_as=ref_residue, units=LOGO_UNITS)
+    if matrices_dir is not None:
+        aligner.output_alignment_matrices(path.join(matrices_dir, label + '.json'), pivot_as=ref_residue, units=LOGO_UNITS)
+    statistics = StringIO()
+    aligner.print_column_statistics(label=label, file=statistics)
+    return statistics.getvalue()
+
 
 #  MAIN  #####################################################################################
 
@@ -37,18 +58,18 @@ def parse_args() -> Dict[str, Any]:
     parser.add_argument('--matrices_dir', help='Directory to output alignment matrices', type=str, default=None)
     parser.add_argument('--labels_for_matrices', help='Comma-separated labels of SSEs to create matrix files for (default: =labels)', type=str, default=None)
     parser.add_argument('--ref_residue', help='Number assigned to the reference residue (i.e. the most conserved), default: 50', type=int, default=50)
+    parser.add_argument('--processes', help='Number of processes for aligning labels in parallel (default: 1)', type=int, default=1)
     args = parser.parse_args()
     return vars(args)
 
 
 def main(all_annotations_file: str, labels: Union[str, List[str], None] = None, alignments_dir: Optional[str] = None, 
-        trees_dir: Optional[str] = None, logos_dir: Optional[str] = None, matrices_dir: Optional[str] = None, labels_for_matrices: Union[str, List[str], None] = None, ref_residue: int = 50) -> Optional[int]:
-    '''Read SSE annotations in SecStrAPI format and perform multiple sequence alignment of SSE sequences (separately for each SSE label).'''
+        trees_dir: Optional[str] = None, logos_dir: Optional[str] = None, matrices_dir: Optional[str] = None, labels_for_matrices: Union[str, List[str], None] = None, ref_residue: int = 50, 
+        processes: int = 1) -> Optional[int]:
+    '''Read SSE annotations in SecStrAPI format and perform multiple sequence alignment of SSE sequences (separately for each SSE label).
+    With processes > 1, labels are aligned in parallel (largest labels first), the statistics are printed in the order of labels.'''
 
-    LOGO_UNITS = 'bits'
-
-    with open(all_annotations_file, 'r', encoding=lib.DEFAULT_ENCODING) as r:
-        all_annotations = json.load(r)
+    all_annotations = lib.read_json(all_annotations_file)
 
     pdb2domains = all_annotations[ANNOTATIONS]
     label2seqs = defaultdict(list)
@@ -80,22 +101,19 @@ def main(all_annotations_file: str, labels: Union[str, List[str], None] = None,
         shutil.rmtree(matrices_dir, ignore_errors=True)
         os.makedirs(matrices_dir)
 
-    aligner = no_gap_align.NoGapAligner()
-    aligner.print_column_statistics(only_header=True)
-    for label in labels:
-        # print(label, file=sys.stderr)
-        names, sequences = zip(*label2seqs[label])
-        aligner.align(sequences, names=names)
-        aligner.print_column_statistics(label=label)
-        if alignments_dir is not None:
-            aligner.output_alignment(path.join(alignments_dir, label + '.fasta'))
-        if trees_dir is not None:
-            aligner.print_tree(output_file=path.join(trees_dir, label + '.txt'))
-        if logos_dir is not None:
-            aligner.output_logo(path.join(logos_dir, label + '.png'), tool='logomaker', pivot_as=ref_residue, units=LOGO_UNITS)
-            aligner.output_logo(path.join(logos_dir, label + '.tif'), tool='logomaker', pivot_as=ref_residue, units=LOGO_UNITS)
-        if matrices_dir is not None:
-            aligner.output_alignment_matrices(path.join(matrices_dir, label + '.json'), pivot_as=ref_residue, units=LOGO_UNITS)
+    no_gap_align.NoGapAligner().print_column_statistics(only_header=True)
+    output_dirs = dict(alignments_dir=alignments_dir, trees_dir=trees_dir, logos_dir=logos_dir, matrices_dir=matrices_dir, ref_residue=ref_residue)
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            # Largest labels first, so that they do not end up running alone at the end
+            futures = { label: executor.submit(align_label, label, *zip(*label2seqs[label]), **output_dirs) 
+                        for label in sorted(labels, key=lambda label: len(label2seqs[label]), reverse=True) }
+            for label in labels:
+                sys.stdout.write(futures[label].result())
+                sys.stdout.flush()
+    else:
+        for label in labels:
+            sys.stdout.write(align_label(label, *zip(*label2seqs[label]), **output_dirs))
     if matrices_dir is not None:
         all_matrices = {}
         for label in labels_for_matrices:
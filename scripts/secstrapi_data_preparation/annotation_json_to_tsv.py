@@ -7,7 +7,6 @@ Example usage:
 
 import argparse
 from typing import Dict, Any, Optional
-import json
 import os
 import sys
 import math
@@ -110,8 +109,7 @@ def parse_args() -> Dict[str, Any]:
 def main(all_annotations_file: str, add_missing_sses: bool = False, one_domain_per_pdb: bool = False) -> Optional[int]:
     '''Convert annotations in SecStrAPI format into tab-separated table.'''
 
-    with open(all_annotations_file, 'r', encoding=lib.DEFAULT_ENCODING) as f:
-        annotations = json.load(f)[ANNOTATIONS]
+    annotations = lib.read_json(all_annotations_file)[ANNOTATIONS]
 
     labels = sorted(set(sse[LABEL] for pdb_annot in annotations.values() for dom_annot in pdb_annot.values() for sse in dom_annot[SSES]))
 
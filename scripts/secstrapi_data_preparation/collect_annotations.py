@@ -110,8 +110,7 @@ def main(domain_list_file: str, input_directory: str) -> Optional[int]:
             if COMMENT in annot:
                 domain[COMMENT] = annot[COMMENT]
 
-    json.dump(input_annotations, sys.stdout, indent=4)
-    print()
+    lib.write_json(input_annotations)
 
     n_pdbs = len(input_annotations[ANNOTATIONS])
     n_domains = sum( len(doms) for doms in input_annotations[ANNOTATIONS].values() )
@@ -38,8 +38,7 @@ def parse_args() -> Dict[str, Any]:
 def main(all_annotations_file: str, output_directory: str, min_dir: Optional[str] = None) -> Optional[int]:
     '''Takes SSE annotations from a single file in SecStrAPI format and creates separate file for each PDB entry.'''
 
-    with open(all_annotations_file, 'r', encoding=lib.DEFAULT_ENCODING) as r:
-        all_annotations = json.load(r)
+    all_annotations = lib.read_json(all_annotations_file)
 
     shutil.rmtree(output_directory, ignore_errors=True)
     os.makedirs(output_directory)
@@ -57,6 +57,10 @@ def main(lists: List[str], api_version: str = None, domain_naming: str = 'auth')
             pdb2domains_dicts.append(pdb2domains)
             pdbs_todo.update(pdb2domains.keys())
 
+    progress_bar = lib.ProgressBar(len(pdbs_todo), title=f'Getting UniProt mappings for {len(pdbs_todo)} PDBs', writer=sys.stderr).start()
+    uniprot_manager.prefetch(sorted(pdbs_todo), progress_bar=progress_bar)
+    progress_bar.finalize()
+
     progress_bar = lib.ProgressBar(len(pdbs_todo), title=f'Formatting {len(pdbs_todo)} PDBs and getting UniProt info', writer=sys.stderr).start()
     for source, family, pdb2domains in zip(sources, families, pdb2domains_dicts):
         for pdb, domains in pdb2domains.items():
@@ -6,12 +6,12 @@ Example usage:
 '''
 
 import sys
-import requests
 import json
 import argparse
 from typing import Dict, Any, Optional
 
 from constants import *
+import rest_client
 
 #  CONSTANTS  ################################################################################
 
@@ -121,7 +121,7 @@ def main(accession: str, source: str = DEFAULT_API_URL, join_domains_in_chain: b
     else:
         url = f'{source}/{accession}'
         sys.stderr.write('Downloading ' + url + '\n')
-        response = requests.get(url)
+        response = rest_client.get_client().get(url)
         if response.ok:
             results = json.loads(response.text).get(accession, {}).get('PDB', {})
         else: 
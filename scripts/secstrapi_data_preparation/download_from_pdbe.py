@@ -2,7 +2,13 @@
 This Python3 script downloads macromolecular structures in CIF or PDB format.
 
 Example usage:
-    python3  download_from_pdbe.py  domains.simple.json  my_structures/  --input_format json  --structure_format cif  --no_gzip  --cache cached_structures/
+    python3  download_from_pdbe.py  domains.simple.json  my_structures/  --input_format json  --structure_format cif  --no_gzip  --cache cached_structures/  --cache_size_limit 100  --connections 8
+
+Structures are downloaded concurrently and streamed directly to disk (decompressed on the fly, or stored as <PDB>.cif.gz with --keep_gzip).
+Files already present in the output directory are only revalidated (conditional GET) and kept if not modified on the server.
+The structure cache (--cache) is shared by multiple runs: cached files are hardlinked into the output directory (not copied)
+and downloaded files are added to the cache automatically.
+The script exits with status 1 if any structure failed to download (the other structures are still downloaded and cached), otherwise 0.
 '''
 
 import argparse
@@ -12,12 +18,15 @@ from os import path
 import sys
 import shutil
 import json
-import requests
-import gzip
 import re
+import time
+import hashlib
+import gzip
+import sqlite3
 from collections import OrderedDict
 
 import lib
+import rest_client
 
 #  CONSTANTS  ################################################################################
 
@@ -27,6 +36,12 @@ URL_CIF = 'http://www.ebi.ac.uk/pdbe/entry-files/download/{pdb}_updated.cif'
 URL_CIF_GZ = 'https://files.rcsb.org/download/{pdb}.cif.gz'
 DEFAULT_INPUT_FORMAT = 'json'
 DEFAULT_STRUCTURE_FORMAT = 'cif'
+DEFAULT_CONNECTIONS = 8
+LINK_MODES = ['hardlink', 'symlink', 'copy']
+DEFAULT_LINK_MODE = 'hardlink'
+GZIP_EXT = '.gz'
+GZIP_LEVEL = 6
+VALIDATORS_FILE = '.download_validators.json'  # in output directory, {filename: {'url': url, 'ETag': etag, 'Last-Modified': date}}
 
 #  FUNCTIONS  ################################################################################
 
@@ -114,29 +129,193 @@ def construct_url(pdb, file_format, use_gzip):
 		url = URL_PDB
 	return url.format(pdb=pdb, pdb1=pdb[0], pdb2=pdb[1], pdb3=pdb[2], pdb4=pdb[3])
 
-def download_pdb(pdb, file_format, output_file, use_gzip):
-	url = construct_url(pdb, file_format, use_gzip)
-	response = requests.get(url)
-	if response.ok:
-		if use_gzip:
-			text = gzip.decompress(response.content).decode("utf-8")
-		else:
-			text = response.text
-		with open(output_file, 'w', encoding=lib.DEFAULT_ENCODING) as w:
-			w.write(text)
-		return True
-	else: 
-		return False
-
-def try_copy_pdb(pdb, file_format, output_file, cache_dir):
-	if cache_dir is None:
-		return False
-	input_file = path.join(cache_dir, pdb + '.' + file_format)
-	try:
-		shutil.copyfile(input_file, output_file)
+def read_validators(output_directory):
+	validators_file = path.join(output_directory, VALIDATORS_FILE)
+	if path.isfile(validators_file):
+		try:
+			return lib.read_json(validators_file, modify=True)
+		except ValueError:
+			pass
+	return {}
+
+def write_validators(output_directory, validators):
+	validators_file = path.join(output_directory, VALIDATORS_FILE)
+	tmp_file = validators_file + '.tmp'
+	with open(tmp_file, 'w', encoding=lib.DEFAULT_ENCODING) as w:
+		lib.write_json(validators, output=w)
+	os.replace(tmp_file, validators_file)
+
+def structure_filename(pdb, file_format, keep_gzip):
+	return pdb + '.' + file_format + (GZIP_EXT if keep_gzip else '')
+
+def download_pdbs(pdbs, file_format, output_directory, use_gzip, keep_gzip, connections, progress_bar=None):
+	'''Download structures concurrently (streamed to disk), revalidate already existing files, return lists of failed and not modified PDBs.
+	If keep_gzip, store the files gzipped (gzip downloads as they are, uncompressed downloads are compressed on the fly).'''
+	validators = read_validators(output_directory)
+	downloads = []
+	for pdb in pdbs:
+		filename = structure_filename(pdb, file_format, keep_gzip)
+		url = construct_url(pdb, file_format, use_gzip)
+		old_validators = validators.get(filename)
+		downloads.append((url, path.join(output_directory, filename), old_validators if old_validators is not None and old_validators.get('url') == url else None))
+	results = rest_client.get_client().download_many(downloads, gunzip=use_gzip and not keep_gzip, compress=keep_gzip and not use_gzip, concurrency=connections, progress_bar=progress_bar)
+	failed = []
+	not_modified = []
+	for pdb, result in zip(pdbs, results):
+		filename = structure_filename(pdb, file_format, keep_gzip)
+		if result.status_code == 304:
+			not_modified.append(pdb)
+		elif not result.modified:
+			failed.append(pdb)
+			validators.pop(filename, None)
+			continue
+		validators[filename] = OrderedDict([('url', result.url)] + [(key, value) for key, value in result.validators.items() if key != 'url'])
+	write_validators(output_directory, validators)
+	return failed, not_modified
+
+class StructureCache:
+	'''Structure cache shared by multiple runs.
+	Files are stored in sharded subdirectories (cache_dir/bc/1bcd.cif) and indexed in cache_dir/index.sqlite (size, SHA-256 checksum, mtime, inode, time of last use).
+	Files are placed into output directories as hardlinks (falls back to copy, e.g. across filesystems), symlinks, or copies.
+	The least recently used files are evicted when the total size exceeds size_limit (bytes).
+	Each change of the index is committed immediately (the index is shared by concurrent runs and must survive an interrupted run).
+	Files are verified against the index before being placed, because a hardlinked output file may have been modified:
+	the SHA-256 checksum is computed (at insertion and) only if the size, mtime or inode of the file differs from the index.
+	Files found directly in cache_dir (old flat layout) are also used and are added to the sharded layout.
+	A gzipped file (1bcd.cif.gz) which is not cached is created from the cached uncompressed file (1bcd.cif), if available.'''
+	INDEX_FILE = 'index.sqlite'
+
+	def __init__(self, cache_dir, size_limit=None, link_mode=DEFAULT_LINK_MODE):
+		if link_mode not in LINK_MODES:
+			raise ValueError(f'Invalid link mode: {link_mode}')
+		self.cache_dir = cache_dir
+		self.size_limit = size_limit
+		self.link_mode = link_mode
+		os.makedirs(cache_dir, exist_ok=True)
+		self.index = sqlite3.connect(path.join(cache_dir, self.INDEX_FILE), timeout=60)
+		with self.index:
+			self.index.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, size INTEGER, sha256 TEXT, last_use REAL, mtime_ns INTEGER, inode INTEGER)')
+			columns = [row[1] for row in self.index.execute('PRAGMA table_info(files)')]
+			for column in ['mtime_ns', 'inode']:
+				if column not in columns:  # index created by an older version
+					self.index.execute(f'ALTER TABLE files ADD COLUMN {column} INTEGER')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def close(self):
+		self.index.close()
+
+	def cached_file(self, filename):
+		return path.join(self.cache_dir, filename[1:3].lower(), filename)
+
+	def place(self, filename, destination):
+		'''Place file from cache into destination, return True on success, False if the file is not cached (or does not match the index).'''
+		cached_file = self._lookup(filename)
+		if cached_file is None and filename.endswith(GZIP_EXT):
+			plain_file = self._lookup(filename[:-len(GZIP_EXT)])
+			if plain_file is not None:
+				cached_file = self._add_compressed(plain_file, filename)
+		if cached_file is None:
+			return False
+		link_file(cached_file, destination, self.link_mode)
+		with self.index:
+			self.index.execute('UPDATE files SET last_use = ? WHERE filename = ?', (time.time(), filename))
 		return True
-	except:
-		return False
+
+	def _lookup(self, filename):
+		'''Return the path of the cached file, or None if it is not cached (entries which do not match the file are removed from the index).'''
+		cached_file = self.cached_file(filename)
+		entry = self.index.execute('SELECT size, sha256, mtime_ns, inode FROM files WHERE filename = ?', (filename,)).fetchone()
+		stat = os.stat(cached_file) if entry is not None and path.isfile(cached_file) else None
+		if stat is not None and stat.st_size == entry[0]:
+			if (stat.st_mtime_ns, stat.st_ino) == (entry[2], entry[3]):
+				return cached_file
+			if file_sha256(cached_file) == entry[1]:  # e.g. touched or copied, content unchanged
+				with self.index:
+					self.index.execute('UPDATE files SET mtime_ns = ?, inode = ? WHERE filename = ?', (stat.st_mtime_ns, stat.st_ino, filename))
+				return cached_file
+		if entry is not None:
+			with self.index:
+				self.index.execute('DELETE FROM files WHERE filename = ?', (filename,))
+		legacy_file = path.join(self.cache_dir, filename)
+		if path.isfile(legacy_file):
+			self.add(legacy_file, filename)
+			return cached_file
+		return None
+
+	def _add_compressed(self, source_file, filename):
+		'''Add gzipped copy of source_file into cache as filename, return the path of the cached file.'''
+		cached_file = self.cached_file(filename)
+		os.makedirs(path.dirname(cached_file), exist_ok=True)
+		tmp_file = f'{cached_file}.{os.getpid()}.compressing'  # not .tmp, which is used by link_file
+		try:
+			with open(source_file, 'rb') as r, gzip.open(tmp_file, 'wb', compresslevel=GZIP_LEVEL) as w:
+				shutil.copyfileobj(r, w, 1024 * 1024)
+			self.add(tmp_file, filename)
+		finally:
+			if path.lexists(tmp_file):
+				os.remove(tmp_file)
+		return cached_file
+
+	def add(self, source_file, filename):
+		'''Add file into cache (as a hardlink if possible), replace the cached file with the same name if its content differs.'''
+		checksum = file_sha256(source_file)
+		size = path.getsize(source_file)
+		cached_file = self.cached_file(filename)
+		entry = self.index.execute('SELECT size, sha256 FROM files WHERE filename = ?', (filename,)).fetchone()
+		if entry != (size, checksum) or not path.isfile(cached_file):
+			os.makedirs(path.dirname(cached_file), exist_ok=True)
+			link_file(source_file, cached_file, 'hardlink')
+		stat = os.stat(cached_file)
+		with self.index:
+			self.index.execute('INSERT OR REPLACE INTO files (filename, size, sha256, last_use, mtime_ns, inode) VALUES (?, ?, ?, ?, ?, ?)', 
+				(filename, size, checksum, time.time(), stat.st_mtime_ns, stat.st_ino))
+
+	def evict(self):
+		'''Remove the least recently used files until the total size is within size limit, return the number of removed files.'''
+		if self.size_limit is None:
+			return 0
+		total_size = self.index.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+		n_removed = 0
+		for filename, size in self.index.execute('SELECT filename, size FROM files ORDER BY last_use').fetchall():
+			if total_size <= self.size_limit:
+				break
+			try:
+				os.remove(self.cached_file(filename))
+			except FileNotFoundError:
+				pass
+			with self.index:
+				self.index.execute('DELETE FROM files WHERE filename = ?', (filename,))
+			total_size -= size
+			n_removed += 1
+		return n_removed
+
+def link_file(source, destination, link_mode):
+	'''Create destination as a hardlink/symlink/copy of source (replace existing destination atomically). Hardlink falls back to copy if not possible.'''
+	tmp_file = f'{destination}.{os.getpid()}.tmp'
+	if path.lexists(tmp_file):
+		os.remove(tmp_file)
+	if link_mode == 'hardlink':
+		try:
+			os.link(source, tmp_file)
+		except OSError:
+			shutil.copyfile(source, tmp_file)
+	elif link_mode == 'symlink':
+		os.symlink(path.abspath(source), tmp_file)
+	else:
+		shutil.copyfile(source, tmp_file)
+	os.replace(tmp_file, destination)
+
+def file_sha256(filename):
+	sha = hashlib.sha256()
+	with open(filename, 'rb') as r:
+		for chunk in iter(lambda: r.read(1024 * 1024), b''):
+			sha.update(chunk)
+	return sha.hexdigest()
 
 #  MAIN  #####################################################################################
 
@@ -158,14 +337,21 @@ def parse_args() -> Dict[str, Any]:
         default=DEFAULT_STRUCTURE_FORMAT)
     parser.add_argument('--unique_uniprot', help='Download only the first PDB entry for each UniProtID', action='store_true')
     parser.add_argument('--no_gzip', help='Download uncompressed files instead of default gzip', action='store_true')
-    parser.add_argument('--cache', help='Directory from which the structures will by preferentially copied (if not found, falls back to download)', type=str)
+    parser.add_argument('--keep_gzip', help='Store structures gzipped (<PDB>.cif.gz) instead of decompressing them (with --no_gzip, compress the downloaded files)', action='store_true')
+    parser.add_argument('--cache', help='Directory with structure cache shared by multiple runs (cached structures are used instead of downloading, downloaded structures are added)', type=str)
+    parser.add_argument('--cache_size_limit', help='Maximum total size of the structure cache in GB (least recently used structures are removed, default: unlimited)', type=float)
+    parser.add_argument('--link_mode', help=f'How to place cached structures into the output directory (default: {DEFAULT_LINK_MODE}; hardlink falls back to copy if not possible; symlinks become broken when the structure is removed from cache)', 
+        choices=LINK_MODES, default=DEFAULT_LINK_MODE)
+    parser.add_argument('--connections', help=f'Number of simultaneous download connections (default: {DEFAULT_CONNECTIONS})', type=int, default=DEFAULT_CONNECTIONS)
     args = parser.parse_args()
     return vars(args)
 
 
 def main(input_file: str, output_directory: str, input_format: str = DEFAULT_INPUT_FORMAT, structure_format: str = DEFAULT_STRUCTURE_FORMAT, 
-        unique_uniprot: bool = False, no_gzip: bool = False, cache: Optional[str] = None) -> Optional[int]:
-    '''Download macromolecular structures in CIF or PDB format.'''
+        unique_uniprot: bool = False, no_gzip: bool = False, keep_gzip: bool = False, cache: Optional[str] = None, 
+        cache_size_limit: Optional[float] = None, link_mode: str = DEFAULT_LINK_MODE, connections: int = DEFAULT_CONNECTIONS) -> Optional[int]:
+    '''Download macromolecular structures in CIF or PDB format.
+    Return 1 if any structure failed to download (failed PDBs are listed on stderr), None otherwise.'''
 
     # Check and prepare output directory
     if os.path.isfile(output_directory):
@@ -182,22 +368,36 @@ def main(input_file: str, output_directory: str, input_format: str = DEFAULT_INP
     elif input_format == 'text':
         pdbs = read_pdbs_text(input_file)
 
-    # Download files
-    failed = []
-    bar = lib.ProgressBar(len(pdbs), title = f'Downloading {len(pdbs)} PDB structures', writer=sys.stderr).start()
-    for pdb in pdbs:
-        outfile = os.path.join(output_directory, pdb + '.' + structure_format)
-        ok = try_copy_pdb(pdb, structure_format, outfile, cache)
-        if not ok:
-            ok = download_pdb(pdb, structure_format, outfile, not no_gzip)
-        if not ok:
-            failed.append(pdb)
-        bar.step()
-    bar.finalize()
+    # Place files from cache, download the rest
+    structure_cache = StructureCache(cache, size_limit=int(cache_size_limit * 1e9) if cache_size_limit is not None else None, link_mode=link_mode) if cache is not None else None
+    try:
+        bar = lib.ProgressBar(len(pdbs), title = f'Downloading {len(pdbs)} PDB structures', writer=sys.stderr).start()
+        to_download = []
+        for pdb in pdbs:
+            filename = structure_filename(pdb, structure_format, keep_gzip)
+            if structure_cache is not None and structure_cache.place(filename, os.path.join(output_directory, filename)):
+                bar.step()
+            else:
+                to_download.append(pdb)
+        failed, not_modified = download_pdbs(to_download, structure_format, output_directory, not no_gzip, keep_gzip, connections, progress_bar=bar)
+        bar.finalize()
+
+        # Add downloaded files to cache
+        if structure_cache is not None:
+            failed_set = set(failed)
+            for pdb in to_download:
+                if pdb not in failed_set:
+                    filename = structure_filename(pdb, structure_format, keep_gzip)
+                    structure_cache.add(os.path.join(output_directory, filename), filename)
+            n_evicted = structure_cache.evict()
+            log(f'Used {len(pdbs) - len(to_download)} structures from cache {cache}, added {len(to_download) - len(failed)}, removed {n_evicted} least recently used')
+    finally:
+        if structure_cache is not None:
+            structure_cache.close()
 
     n_failed = len(failed)
     n_ok = len(pdbs) - n_failed
-    log(f'\nDownloaded {n_ok} PDB entries, failed to download {n_failed} PDB entries')
+    log(f'\nDownloaded {n_ok} PDB entries ({len(not_modified)} not modified since the previous download), failed to download {n_failed} PDB entries')
     if n_failed > 0:
         log('Failed to download: ' + ' '.join(failed))
         return 1
@@ -9,7 +9,6 @@ import argparse
 from typing import Dict, Any, Optional
 import os
 import sys
-import json
 from collections import defaultdict
 from os import path
 import shutil
@@ -38,8 +37,7 @@ def parse_args() -> Dict[str, Any]:
 def main(all_annotations_file: str, output_directory: str) -> Optional[int]:
     '''Extract the amino acid sequences of annotated SSEs and print them in FASTA format (one file per SSE label).'''
 
-    with open(all_annotations_file, 'r', encoding=lib.DEFAULT_ENCODING) as r:
-        all_annotations = json.load(r)
+    all_annotations = lib.read_json(all_annotations_file)
 
     shutil.rmtree(output_directory, ignore_errors=True)
     os.makedirs(output_directory)
@@ -10,10 +10,10 @@ from typing import Dict, Any, Optional
 import os
 import sys
 import json
-import requests
 import math
 
 import lib
+import rest_client
 from constants import *
 
 #  CONSTANTS  ################################################################################
@@ -68,18 +68,17 @@ def main(domain_list_file: str) -> Optional[int]:
     uniprots = sorted(set(domain[UNIPROT_ID] for domains in pdb2domains.values() for domain in domains.values()))
 
     progress_bar = lib.ProgressBar(len(uniprots), title=f'Downloading sequences for {len(uniprots)} UniProt IDs', writer=sys.stderr).start()
-    for uniprot in uniprots:
-        url = URL_TEMPLATE.format(uniprot=uniprot)
-        response = requests.get(url).text
-        response = json.loads(response)
+    urls = [URL_TEMPLATE.format(uniprot=uniprot) for uniprot in uniprots]
+    responses = rest_client.get_client().get_many(urls, progress_bar=progress_bar)
+    progress_bar.finalize()
+    for uniprot, url, response in zip(uniprots, urls, responses):
+        response = response.json()
         if 'errorMessage' in response:
             sys.stderr.write(f'Response from {url} contains error: {response["errorMessage"]}\n')
         sequence = response['sequence']['sequence']
         gene = get_gene_name(response)
         species = get_species_name(response)
         print(f'>{uniprot} {species} {gene}\n{wrap_sequence(sequence)}\n')
-        progress_bar.step()
-    progress_bar.finalize()
 
 
 if __name__ == '__main__':
@@ -7,9 +7,9 @@ from typing import Dict, Any
 import os
 import sys
 import json
-import requests
 
 import lib
+import rest_client
 from constants import *
 
 #  CONSTANTS  ################################################################################
@@ -35,8 +35,9 @@ def main(domain_list_file: str) -> None:
         input_annotations = json.load(r)[ANNOTATIONS]
 
     progress_bar = lib.ProgressBar(len(input_annotations), title=f'Getting taxonomy ID for {len(input_annotations)} PDB entries', writer=sys.stderr).start()
-    for pdb, pdb_annot in input_annotations.items():
-        response = json.loads(requests.get(URL + pdb).text)
+    responses = rest_client.get_client().get_many_by_id(URL, input_annotations.keys(), progress_bar=progress_bar)
+    for (pdb, pdb_annot), response in zip(input_annotations.items(), responses):
+        response = response.json()
         for domain, domain_annot in pdb_annot.items():
             chain = domain_annot[CHAIN]
             entities = [ entity for entity in response[pdb] if chain in entity['in_struct_asyms'] ] 
@@ -44,7 +45,6 @@ def main(domain_list_file: str) -> None:
             if len(set(taxids))!=1:
                 sys.stderr.write('WARNING: ' + pdb + ' has non-unique taxon ID: ' + ', '.join([str(t) for t in taxids]) + '\n')
             print(domain, taxids[0], sep='\t')
-        progress_bar.step()
     progress_bar.finalize()
 
 
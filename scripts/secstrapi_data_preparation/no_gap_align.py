@@ -7,10 +7,9 @@ import shutil
 import sys
 import json
 from io import StringIO
-import heapq
-import itertools
 from typing import List, Tuple, Dict
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from PIL import Image
 from Bio import AlignIO, SeqIO
@@ -28,6 +27,8 @@ UNKNOWN_CHAR = '?'
 GAP_PENALTY = 10
 WEBLOGO2 = './weblogo/seqlogo'
 WEBLOGO3 = 'weblogo'
+INVALID_CODE = 255  # letter code for letters out of alphabet (letter codes are uint8)
+PAIR_BLOCK_ELEMENTS = 1 << 22  # maximum number of elements of score matrices computed at once by pairwise_shifts_and_scores
 
 def print_aln(seqs, names=None, tree=None, output_file=None):
     columns = [] 
@@ -77,13 +78,35 @@ def letter2vector(letter, letter2index):
     vec[letter2index[letter]] = 1
     return vec
 
+def sequence2codes(sequence, letter2index):
+    '''Encode sequence as an array of letter indices (uint8), i.e. compact form of sequence2matrix (n bytes instead of n*m floats).'''
+    table = bytearray([INVALID_CODE]) * 256
+    for letter, index in letter2index.items():
+        table[ord(letter)] = index
+    codes = np.frombuffer(sequence.encode('latin-1').translate(table), dtype=np.uint8)
+    invalid = codes == INVALID_CODE
+    if invalid.any():
+        raise KeyError(sequence[int(np.argmax(invalid))])
+    return codes
+
+def codes2matrix(codes, n_letters):
+    '''Convert letter codes (see sequence2codes) to one-hot sequence matrix.'''
+    return np.eye(n_letters)[codes]
+
+def as_matrix(sequence, n_letters):
+    '''Return sequence matrix for sequence given as sequence matrix (2D) or letter codes (1D).'''
+    return codes2matrix(sequence, n_letters) if sequence.ndim == 1 else sequence
+
+def as_codes(sequence):
+    '''Return letter codes for sequence given as letter codes (1D) or one-hot sequence matrix (2D), or None if sequence is not one-hot (e.g. a profile).'''
+    if sequence.ndim == 1:
+        return sequence
+    if ((sequence == 0) | (sequence == 1)).all() and (sequence.sum(axis=1) == 1).all():
+        return np.argmax(sequence, axis=1).astype(np.uint8)
+    return None
+
 def sequence2matrix(sequence, letter2index):
-    n = len(sequence)
-    m = len(letter2index)
-    matrix = np.zeros((n, m))
-    for i, letter in enumerate(sequence):
-        matrix[i, letter2index[letter]] = 1
-    return matrix
+    return codes2matrix(sequence2codes(sequence, letter2index), len(letter2index))
 
 def calculate_score(letter1, letter2, subst_matrix):
     return np.matmul(np.matmul(letter1, subst_matrix), letter2)
@@ -92,42 +115,117 @@ def calculate_score_mat(seq_mat_1, seq_mat_2, subst_matrix):
     scores = np.matmul(seq_mat_1, subst_matrix) * seq_mat_2
     return scores.sum()
 
+def diagonal_sums(matrix):
+    '''Return the sums of all diagonals of n1*n2 matrix, for shift = i-j from -n2+1 to n1-1 (i.e. sum of matrix.diagonal(offset=-shift)).
+    For a stack of matrices (...*n1*n2), return the diagonal sums of each matrix (...*(n1+n2-1)).
+    Rows are added one by one, so integer sums are exact and float sums may differ from matrix.diagonal(offset=-shift).sum() 
+    (pairwise summation) by rounding errors (relative error below n*2**-52 for a diagonal of n elements of the same sign).
+    Zero-padded matrices give the same sums as unpadded ones (adding zeros is exact).'''
+    *stack_shape, n1, n2 = matrix.shape
+    width = n1 + n2 - 1
+    # Row i (columns reversed) followed by n1 zeros, read with row length width, puts element [i, j] into column n2-1+i-j of row i
+    padded = np.zeros((*stack_shape, n1, n2 + n1), dtype=matrix.dtype)
+    padded[..., :n2] = matrix[..., ::-1]
+    skewed = padded.reshape((*stack_shape, n1 * (n2 + n1)))[..., :n1 * width].reshape((*stack_shape, n1, width))
+    return skewed.sum(axis=-2)
+
 def optimal_shift_and_score(seq_mat_1, seq_mat_2, subst_matrix, return_bestness=False):
+    '''Sequences can be given as sequence matrices (2D) or letter codes (1D), letter codes are scored by indexing subst_matrix.'''
     n1 = seq_mat_1.shape[0]
     n2 = seq_mat_2.shape[0]
-    seq_mat_1_M = np.matmul(seq_mat_1, subst_matrix)
-    seq_mat_1_M_2 = np.matmul(seq_mat_1_M, seq_mat_2.transpose())
     MIN_SHIFT = -n2+1  # shift of sequence 2 rightwards wrt. sequence 1
     MAX_SHIFT = n1-1
-    # shifts_scores = []
-    # for shift in range(MIN_SHIFT, MAX_SHIFT+1):
-        # start = max(-shift, 0)  # wrt. sequence 2
-        # stop = min(n1-shift, n2)  # wrt. sequence 2
-        # score = np.sum(seq_mat_1_M[start+shift:stop+shift, :] * seq_mat_2[start:stop, :])
-        # shifts_scores.append((shift, score))
-    shifts_scores = [ (shift, seq_mat_1_M_2.diagonal(offset=-shift).sum()) for shift in range(MIN_SHIFT, MAX_SHIFT+1) ]
-    (best_shift, best_score), second_best = two_max(shifts_scores, key = lambda t: t[1])
-    # print(best_score, second_best_score, bestness)
+    scores = diagonal_sums(position_scores(seq_mat_1, seq_mat_2, subst_matrix))  # scores[k] = score of shift MIN_SHIFT+k
+    best_index = int(np.argmax(scores))  # the first one in case of ties
+    best_shift = MIN_SHIFT + best_index
+    best_score = scores[best_index]
     if return_bestness:
-        if second_best is not None:
-            (second_best_shift, second_best_score) = second_best
+        if len(scores) > 1:
+            second_best_score = max(scores[:best_index].max(initial=-np.inf), scores[best_index+1:].max(initial=-np.inf))
             bestness = (best_score - second_best_score) / best_score
-            # print(bestness, best_shift, best_score, second_best_shift, second_best_score)
         else:
             bestness = 1.0
         return best_shift, best_score, bestness
     else:
         return best_shift, best_score
 
-def two_max(iterable, key=lambda x: x):
-    first_max = None
-    second_max = None
-    for x in iterable:
-        if first_max is None or key(x) > key(first_max):
-            first_max, second_max = x, first_max
-        elif second_max is None or key(x) > key(second_max):
-            second_max = x
-    return first_max, second_max
+def position_scores(seq_mat_1, seq_mat_2, subst_matrix):
+    '''Return n1*n2 matrix of scores of position i of sequence 1 against position j of sequence 2.
+    Sequences can be given as sequence matrices (2D) or letter codes (1D), letter codes are scored by indexing subst_matrix.'''
+    seq_mat_1_M = subst_matrix[seq_mat_1] if seq_mat_1.ndim == 1 else np.matmul(seq_mat_1, subst_matrix)
+    return seq_mat_1_M[:, seq_mat_2] if seq_mat_2.ndim == 1 else np.matmul(seq_mat_1_M, seq_mat_2.transpose())
+
+def optimal_shifts_and_scores(seq_mats_1, seq_mat_2, subst_matrix):
+    '''Return optimal shifts and scores (as optimal_shift_and_score) of seq_mat_2 wrt. each of seq_mats_1.
+    Score matrices are computed one by one, but their diagonals are summed at once.'''
+    if len(seq_mats_1) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    n2 = seq_mat_2.shape[0]
+    lengths_1 = np.array([ mat.shape[0] for mat in seq_mats_1 ])
+    stack = np.zeros((len(seq_mats_1), lengths_1.max(), n2))
+    for k, mat in enumerate(seq_mats_1):
+        stack[k, :lengths_1[k], :] = position_scores(mat, seq_mat_2, subst_matrix)
+    scores = diagonal_sums(stack)
+    shifts = np.arange(-n2+1, lengths_1.max())
+    scores[shifts >= lengths_1[:, None]] = -np.inf  # shifts beyond the unpadded sequences must not be chosen
+    best = np.argmax(scores, axis=1)  # the first one in case of ties
+    return shifts[best], scores[np.arange(len(best)), best]
+
+def pairwise_shifts_and_scores(sequence_matrices, subst_matrix, pairs, processes=1):
+    '''Return optimal shifts and scores (as optimal_shift_and_score) for all pairs (i, j) of sequence_matrices.
+    If all sequences are given as letter codes or one-hot sequence matrices, they are padded into one 2D array of codes
+    and pairs are scored in vectorised blocks by indexing subst_matrix, otherwise pairs are scored one by one by optimal_shift_and_score.
+    Blocks of pairs can be distributed to multiple processes. The results are bitwise equal to optimal_shift_and_score.'''
+    if len(pairs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    n_letters = subst_matrix.shape[0]
+    lengths = np.array([ mat.shape[0] for mat in sequence_matrices ])
+    max_length = lengths.max()
+    codes = [ as_codes(mat) for mat in sequence_matrices ]
+    if all( c is not None for c in codes ):
+        padded = np.full((len(codes), max_length), n_letters, dtype=np.uint8)  # padding code n_letters scores 0 with anything
+        for i, c in enumerate(codes):
+            padded[i, :len(c)] = c
+        integral = np.array_equal(subst_matrix, np.round(subst_matrix)) and np.abs(subst_matrix).max() * max_length < 2**31
+        padded_subst_matrix = np.zeros((n_letters+1, n_letters+1), dtype=np.int32 if integral else float)  # integer scores are summed faster by diagonal_sums
+        padded_subst_matrix[:n_letters, :n_letters] = subst_matrix
+        scoring_data = (padded_subst_matrix, padded, lengths)
+    else:
+        scoring_data = (subst_matrix, sequence_matrices, None)
+    pairs = np.array(pairs)
+    block_size = max(1, PAIR_BLOCK_ELEMENTS // (max_length * (2*max_length - 1)))
+    blocks = [ pairs[start:start+block_size] for start in range(0, len(pairs), block_size) ]
+    if processes > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_set_pair_scoring_data, initargs=scoring_data) as executor:
+            results = list(executor.map(_score_pair_block, blocks))
+    else:
+        _set_pair_scoring_data(*scoring_data)
+        results = [ _score_pair_block(block) for block in blocks ]
+        _set_pair_scoring_data(None, None, None)
+    shifts = np.concatenate([ block_shifts for block_shifts, block_scores in results ])
+    scores = np.concatenate([ block_scores for block_shifts, block_scores in results ])
+    return shifts, scores
+
+_pair_scoring_data = None  # (substitution matrix, sequences, lengths), set for the current process by _set_pair_scoring_data; sequences are padded codes if lengths is not None
+
+def _set_pair_scoring_data(subst_matrix, sequences, lengths):
+    global _pair_scoring_data
+    _pair_scoring_data = (subst_matrix, sequences, lengths) if subst_matrix is not None else None
+
+def _score_pair_block(pairs):
+    subst_matrix, sequences, lengths = _pair_scoring_data
+    if lengths is None:
+        shifts_scores = [ optimal_shift_and_score(sequences[i], sequences[j], subst_matrix) for i, j in pairs ]
+        return np.array([ shift for shift, score in shifts_scores ], dtype=np.int64), np.array([ score for shift, score in shifts_scores ])
+    I = pairs[:, 0]
+    J = pairs[:, 1]
+    max_length = sequences.shape[1]
+    scores = diagonal_sums(subst_matrix[sequences[I][:, :, None], sequences[J][:, None, :]]).astype(float)
+    shifts = np.arange(-max_length+1, max_length)
+    valid = (shifts >= 1 - lengths[J][:, None]) & (shifts <= lengths[I][:, None] - 1)  # shifts outside of the padded sequences must not be chosen
+    scores[~valid] = -np.inf
+    best = np.argmax(scores, axis=1)  # the first one in case of ties
+    return shifts[best], scores[np.arange(len(pairs)), best]
 
 def combine_sequences(seq_mat_1, seq_mat_2, weights=(1, 1), shift=None, subst_matrix=None):
     if shift is None:
@@ -148,35 +246,37 @@ def combine_sequences(seq_mat_1, seq_mat_2, weights=(1, 1), shift=None, subst_ma
     result[:, 0] = 1.0 - result[:, 1:].sum(axis=1)  # calculate probabilities for GAP_CHAR
     return result
 
-def multialign(sequence_matrices, subst_matrix):
+def multialign(sequence_matrices, subst_matrix, processes=1):
+    '''Leaf sequences can be given as sequence matrices (2D) or letter codes (1D), tree nodes are dense probability matrices.'''
     sequence_matrices = sequence_matrices[:]
+    n_letters = subst_matrix.shape[0]
     n = len(sequence_matrices)
     N = 2*n - 1
-    scores = np.zeros((N, N))
     active_nodes = set(range(n))
     weights = [1] * n
     tree = np.full((N, 3), -1, dtype=int)  # (left child, right child, shift of right wrt left) for each node, -1 = leaf/uninitialized
-    i_j_shift_scores = [ (i, j, *optimal_shift_and_score(sequence_matrices[i], sequence_matrices[j], subst_matrix)) 
-        for (i, j) in itertools.combinations(active_nodes, 2) ]
-    queue = PriorityQueue( ((i, j), (-score, shift)) for i, j, shift, score in i_j_shift_scores )
+    pairs = np.stack(np.triu_indices(n, 1), axis=1)
+    shifts, scores = pairwise_shifts_and_scores(sequence_matrices, subst_matrix, pairs, processes=processes)
+    queue = PairQueue(n, shifts, scores)
+    del pairs, shifts, scores  # the queue keeps its own copy
     while len(active_nodes) > 1:
-        best_pair = queue.pop_min_which(lambda ij: ij[0] in active_nodes and ij[1] in active_nodes)
+        best_pair = queue.pop_best()
         if best_pair is None:
             break  # no joinable pairs, algorithm has converged
-        (i, j), (neg_score, shift) = best_pair
+        i, j, shift = best_pair
         new = len(sequence_matrices)
-        new_matrix = combine_sequences(sequence_matrices[i], sequence_matrices[j], weights=(weights[i], weights[j]), shift=shift)
+        new_matrix = combine_sequences(as_matrix(sequence_matrices[i], n_letters), as_matrix(sequence_matrices[j], n_letters), weights=(weights[i], weights[j]), shift=shift)
         new_weight = weights[i] + weights[j]
         sequence_matrices.append(new_matrix)
         weights.append(new_weight)
         active_nodes.remove(i)
         active_nodes.remove(j)
         tree[new, :] = (i, j, shift)
-        for node in active_nodes:
-            shift, score = optimal_shift_and_score(sequence_matrices[node], sequence_matrices[new], subst_matrix)
-            queue.add((node, new), (-score, shift))
+        nodes = list(active_nodes)
+        new_shifts, new_scores = optimal_shifts_and_scores([ sequence_matrices[node] for node in nodes ], sequence_matrices[new], subst_matrix)
+        queue.merge(i, j, new, list(zip(nodes, new_shifts, new_scores)))
         active_nodes.add(new)
-    alignment_matrix = sequence_matrices[-1]
+    alignment_matrix = as_matrix(sequence_matrices[-1], n_letters)
     shifts = shifts_from_tree(tree)
     return alignment_matrix, shifts, tree
 
@@ -190,7 +290,10 @@ def multirealign(reference_sequence_matrix, sequence_matrices, subst_matrix):
         # print(shift)
         # print(seq_mat.shape)
         # print(alignment_matrix[shift:seq_mat.shape[0]+shift, :].shape)
-        alignment_matrix[shift:seq_mat.shape[0]+shift, :] += seq_mat
+        if seq_mat.ndim == 1:
+            alignment_matrix[np.arange(shift, seq_mat.shape[0]+shift), seq_mat] += 1
+        else:
+            alignment_matrix[shift:seq_mat.shape[0]+shift, :] += seq_mat
     alignment_matrix /= len(sequence_matrices)
     # print(*( f'{be:.4f} {sc:.2f} {sh},' for be, sc, sh in sorted(zip(bestnesses, scores, shifts)) ))
     # print(sorted(scores))
@@ -601,36 +704,122 @@ def compress_tiff(filename: str):
     shutil.move(temp_name, filename)
 
 
-class PriorityQueue:
-	def __init__(self, elements_keys):
-		self.heap = list(( (key, i, elem) for (i, (elem, key)) in enumerate(elements_keys) ))
-		heapq.heapify(self.heap)
-		self.seq = len(self.heap)
-	def is_empty(self):
-		return len(self.heap) == 0
-	def add(self, elem, key):
-		heapq.heappush(self.heap, (key, self.seq, elem))
-		self.seq += 1
-	def pop_min(self):
-		if not self.is_empty():
-			key, i, elem = heapq.heappop(self.heap)
-			return elem, key
-		else:
-			return None
-	def pop_min_which(self, predicate):
-		while not self.is_empty():
-			key, i, elem = heapq.heappop(self.heap)
-			if predicate(elem):
-				return elem, key
-		return None
+class PairQueue:
+    '''Queue of pairs of active nodes for agglomerative clustering, the best pair has the highest score (then the lowest shift, then the earliest insertion).
+    Pair keys are kept in dense matrices indexed by slots (one slot per active node, a merged node reuses a slot of its children),
+    so there are no stale entries. Each slot keeps its best partner, so that the best pair is found in O(n).
+    Each pair is stored with the shift of the younger node (higher number) wrt. the older node.
+    Memory is 16 bytes per pair of slots (float64 score, int32 shift and insertion order), i.e. 144 MB for 3000 initial nodes,
+    which is about the size of the pairwise scores and shifts the queue is initialized from.
+    The matrices are compacted whenever half of the slots become inactive, so memory stays proportional to the number of live pairs.'''
+    MIN_COMPACTED_SIZE = 64  # smaller matrices are not compacted
+
+    def __init__(self, n, shifts, scores):
+        '''Initialize with nodes 0..n-1 and pairs (i, j) for i < j in lexicographic order (as itertools.combinations) with given shifts and scores.'''
+        self.scores = np.full((n, n), -np.inf)
+        self.shifts = np.zeros((n, n), dtype=np.int32)
+        self.orders = np.zeros((n, n), dtype=np.int32 if n * n < 2**31 else np.int64)  # there are at most n*(n-1) insertions
+        I, J = np.triu_indices(n, 1)
+        for matrix, values in ((self.scores, scores), (self.shifts, shifts), (self.orders, np.arange(len(I)))):
+            matrix[I, J] = values
+            matrix[J, I] = values
+        self.n_added = len(I)
+        self.active = np.ones(n, dtype=bool)
+        self.slot_nodes = np.arange(n)
+        self.node_slots = { node: node for node in range(n) }
+        self.best_partners = np.array([ self._find_best_partner(slot) for slot in range(n) ], dtype=np.int64)
+
+    def pop_best(self):
+        '''Return the best pair as (older node, younger node, shift), or None if there are no pairs.'''
+        slots = np.flatnonzero(self.active & (self.best_partners >= 0))
+        if len(slots) == 0:
+            return None
+        slot = slots[self._best_index(slots, self.best_partners[slots])]
+        partner = self.best_partners[slot]
+        i, j = sorted((self.slot_nodes[slot], self.slot_nodes[partner]))
+        return int(i), int(j), int(self.shifts[slot, partner])
+
+    def merge(self, i, j, new, new_pairs):
+        '''Remove nodes i, j, add node new with pairs given as (node, shift, score), shift being the shift of new wrt. node.'''
+        slot = self.node_slots.pop(i)
+        removed_slot = self.node_slots.pop(j)
+        self.active[removed_slot] = False
+        self.best_partners[removed_slot] = -1
+        self.node_slots[new] = slot
+        self.slot_nodes[slot] = new
+        self.scores[slot, :] = self.scores[:, slot] = -np.inf
+        if len(new_pairs) > 0:
+            nodes, shifts, scores = zip(*new_pairs)
+            slots = np.array([ self.node_slots[node] for node in nodes ])
+            orders = np.arange(self.n_added, self.n_added + len(slots))
+            self.n_added += len(slots)
+            for matrix, values in ((self.scores, scores), (self.shifts, shifts), (self.orders, orders)):
+                matrix[slots, slot] = values
+                matrix[slot, slots] = values
+            # Slots which lost their best partner must search again, the others only compare it with the new pair
+            lost = np.isin(self.best_partners[slots], (slot, removed_slot))
+            for other in slots[lost]:
+                self.best_partners[other] = self._find_best_partner(other)
+            kept = slots[~lost]
+            if len(kept) > 0:
+                improved = self._is_better(kept, np.full(len(kept), slot), self.best_partners[kept])
+                self.best_partners[kept[improved]] = slot
+        self.best_partners[slot] = self._find_best_partner(slot)
+        n_slots = len(self.active)
+        if n_slots >= self.MIN_COMPACTED_SIZE and 2 * len(self.node_slots) <= n_slots:
+            self._compact()
+
+    def _compact(self):
+        '''Drop inactive slots from the matrices, renumbering the active slots.'''
+        slots = np.flatnonzero(self.active)
+        new_slots = np.full(len(self.active), -1, dtype=np.int64)
+        new_slots[slots] = np.arange(len(slots))
+        rows_columns = np.ix_(slots, slots)
+        self.scores = self.scores[rows_columns]
+        self.shifts = self.shifts[rows_columns]
+        self.orders = self.orders[rows_columns]
+        best_partners = self.best_partners[slots]
+        self.best_partners = np.where(best_partners >= 0, new_slots[best_partners], -1)
+        self.slot_nodes = self.slot_nodes[slots]
+        self.node_slots = { node: int(new_slots[slot]) for node, slot in self.node_slots.items() }
+        self.active = np.ones(len(slots), dtype=bool)
+
+    def _find_best_partner(self, slot):
+        partners = np.flatnonzero(self.active)
+        partners = partners[partners != slot]
+        if len(partners) == 0:
+            return -1
+        return partners[self._best_index(np.full(len(partners), slot), partners)]
+
+    def _best_index(self, slots, partners):
+        '''Return index of the best pair (slots[k], partners[k]).'''
+        candidates = np.arange(len(slots))
+        for values in (-self.scores[slots, partners], self.shifts[slots, partners], self.orders[slots, partners]):
+            values = values[candidates]
+            candidates = candidates[values == values.min()]
+            if len(candidates) == 1:
+                break
+        return candidates[0]
+
+    def _is_better(self, slots, partners, other_partners):
+        '''For each k, decide whether pair (slots[k], partners[k]) is better than pair (slots[k], other_partners[k]).'''
+        result = np.zeros(len(slots), dtype=bool)
+        undecided = np.ones(len(slots), dtype=bool)
+        for matrix, sign in ((self.scores, -1), (self.shifts, 1), (self.orders, 1)):
+            values = sign * matrix[slots, partners]
+            other_values = sign * matrix[slots, other_partners]
+            result |= undecided & (values < other_values)
+            undecided &= values == other_values
+        return result
 
 
 ################################################################################
 
 class NoGapAligner:
-    def __init__(self, subst_matrix_info=MatrixInfo.blosum62, gap_penalty=10, realign=True):
+    def __init__(self, subst_matrix_info=MatrixInfo.blosum62, gap_penalty=10, realign=True, processes=1):
         self.subst_matrix, self.alphabet, self.letter2index = substitution_matrix(subst_matrix_info, gap_penalty=gap_penalty)
         self.realign = realign
+        self.processes = processes
 
     def align(self, sequences, names=None):
         if isinstance(sequences, str):
@@ -644,8 +833,8 @@ class NoGapAligner:
             self.names = list(names)
             if len(self.seqs) != len(self.names):
                 raise Exception('There must be the same number of sequences and names')
-        sequence_matrices = [ sequence2matrix(seq, self.letter2index) for seq in self.seqs ]
-        self.alignment_matrix, self.shifts, self.tree = multialign(sequence_matrices, self.subst_matrix)
+        sequence_matrices = [ sequence2codes(seq, self.letter2index) for seq in self.seqs ]  # leaves are kept as letter codes, dense matrices only for tree nodes
+        self.alignment_matrix, self.shifts, self.tree = multialign(sequence_matrices, self.subst_matrix, processes=self.processes)
         if self.realign:
             last_shifts = None
             while last_shifts is None or any( last != curr for last, curr in zip(last_shifts, self.shifts) ):
@@ -724,12 +913,15 @@ class Realigner:
         self.subst_matrix, self.alphabet, self.letter2index = substitution_matrix(subst_matrix_info, gap_penalty=gap_penalty)
         inp = SeqIO.parse(reference_alignment_file, 'fasta')
         names, seqs = zip(*( (x.id, str(x.seq)) for x in inp ))
-        sequence_matrices = [ sequence2matrix(seq, self.letter2index) for seq in seqs ]
-        self.reference_alignment_matrix = sum(sequence_matrices) / len(sequence_matrices)
+        codes = np.stack([ sequence2codes(seq, self.letter2index) for seq in seqs ])  # aligned sequences have the same length
+        n_seqs, length = codes.shape
+        n_letters = len(self.letter2index)
+        counts = np.bincount((np.arange(length) * n_letters + codes).ravel(), minlength=length*n_letters).reshape((length, n_letters))
+        self.reference_alignment_matrix = counts / n_seqs
         self.pivot_index = get_pivot_column_index(self.reference_alignment_matrix)
         
     def aligning_shift_and_pivot(self, sequence):
-        seq_matrix = sequence2matrix(sequence, self.letter2index)
+        seq_matrix = sequence2codes(sequence, self.letter2index)
         shift, score = optimal_shift_and_score(self.reference_alignment_matrix, seq_matrix, self.subst_matrix)
         pivot = self.pivot_index - shift
         return shift, pivot
@@ -0,0 +1 @@
+../rest_client.py
\ No newline at end of file
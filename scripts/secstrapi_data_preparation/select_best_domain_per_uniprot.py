@@ -41,11 +41,8 @@ def main(domain_list_file: str) -> None:
     pdb2domains = input_json[ANNOTATIONS]
 
     pdbs = pdb2domains.keys()
-    pdb2quality = {}
     progress_bar = lib.ProgressBar(len(pdbs), title=f'Getting structure quality for {len(pdbs)} PDB entries', writer=sys.stderr).start()
-    for pdb in pdbs:
-        pdb2quality[pdb] = lib.get_structure_quality(pdb)
-        progress_bar.step()
+    pdb2quality = lib.get_structure_qualities(pdbs, progress_bar=progress_bar)
     progress_bar.finalize()
 
     DOMAINS_IN_DICT = len(pdb2domains) > 0 and isinstance(next(iter(pdb2domains.values())), dict)
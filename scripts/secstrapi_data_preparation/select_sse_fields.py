@@ -9,7 +9,6 @@ import argparse
 from typing import Dict, Any, Optional, Union, List
 import os
 import sys
-import json
 from os import path
 import shutil
 
@@ -40,8 +39,7 @@ def main(input_annotations_file: str, fields: Union[str, List[str]]=DEFAULT_FIEL
     if isinstance(fields, str):
         fields = fields.split(',')
     
-    with open(input_annotations_file, 'r', encoding=lib.DEFAULT_ENCODING) as r:
-        all_annotations = json.load(r)
+    all_annotations = lib.read_json(input_annotations_file, modify=True)
 
     pdb2domains = all_annotations[ANNOTATIONS]
     for pdb, domains in pdb2domains.items():
@@ -51,8 +49,7 @@ def main(input_annotations_file: str, fields: Union[str, List[str]]=DEFAULT_FIEL
                     if field not in fields:
                         sse.pop(field)
 
-    json.dump(all_annotations, sys.stdout, indent=4)
-    print()
+    lib.write_json(all_annotations)
 
 
 if __name__ == '__main__':
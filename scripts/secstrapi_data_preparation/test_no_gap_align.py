@@ -0,0 +1,294 @@
+'''
+Tests of no_gap_align: the vectorised scoring must give the same results as the original per-diagonal implementation,
+exactly for integer scores (letter codes and one-hot matrices) and up to rounding errors (SCORE_TOLERANCE) for profiles.
+All vectorised variants of the scoring must give bitwise the same results as optimal_shift_and_score, 
+because near-tie scores decide the order of merging in multialign.
+
+Example usage:
+    python3  -m unittest  test_no_gap_align
+'''
+
+import heapq
+import itertools
+import unittest
+import numpy as np
+
+import no_gap_align
+
+#  CONSTANTS  ################################################################################
+
+SEED = 42
+ALPHABETS = ('AB', 'ABC', 'ACDEFGHIKLMNPQRSTVWY')  # small alphabets give many ties
+SCORE_TOLERANCE = 1e-9  # float diagonal sums are added in a different order than by numpy.sum, scores are below 10**4
+
+#  FUNCTIONS  ################################################################################
+
+def random_substitution_matrix(rng, alphabet):
+    scores = { (x, y): int(rng.integers(-4, 5)) for x in alphabet for y in alphabet if x <= y }
+    return no_gap_align.substitution_matrix(scores, gap_penalty=no_gap_align.GAP_PENALTY)
+
+def random_sequence(rng, alphabet, min_length=1, max_length=40):
+    return ''.join(rng.choice(list(alphabet), size=int(rng.integers(min_length, max_length+1))))
+
+def random_profile(rng, n_letters, min_length=1, max_length=40):
+    '''Average of a few one-hot matrices, like the probability matrices of tree nodes in multialign.'''
+    length = int(rng.integers(min_length, max_length+1))
+    n_sequences = int(rng.integers(2, 8))
+    codes = rng.integers(1, n_letters-1, size=(n_sequences, length))  # excludes GAP_CHAR and UNKNOWN_CHAR
+    return np.eye(n_letters)[codes].mean(axis=0)
+
+def reference_shifts_scores(seq_mat_1, seq_mat_2, subst_matrix):
+    '''Scores of all shifts as in the original implementation of optimal_shift_and_score (one numpy sum per diagonal).'''
+    n1 = seq_mat_1.shape[0]
+    n2 = seq_mat_2.shape[0]
+    seq_mat_1_M_2 = np.matmul(np.matmul(seq_mat_1, subst_matrix), seq_mat_2.transpose())
+    return [ (shift, seq_mat_1_M_2.diagonal(offset=-shift).sum()) for shift in range(-n2+1, n1) ]
+
+def reference_optimal_shift_and_score(seq_mat_1, seq_mat_2, subst_matrix):
+    '''Original implementation of optimal_shift_and_score (the first maximum wins).'''
+    shifts_scores = reference_shifts_scores(seq_mat_1, seq_mat_2, subst_matrix)
+    (best_shift, best_score), second_best = reference_two_max(shifts_scores, key=lambda t: t[1])
+    if second_best is not None:
+        bestness = (best_score - second_best[1]) / best_score
+    else:
+        bestness = 1.0
+    return best_shift, best_score, bestness
+
+def reference_two_max(iterable, key=lambda x: x):
+    first_max = None
+    second_max = None
+    for x in iterable:
+        if first_max is None or key(x) > key(first_max):
+            first_max, second_max = x, first_max
+        elif second_max is None or key(x) > key(second_max):
+            second_max = x
+    return first_max, second_max
+
+def optimal_shift_and_score_with_bestness(seq_mat_1, seq_mat_2, subst_matrix):
+    return no_gap_align.optimal_shift_and_score(seq_mat_1, seq_mat_2, subst_matrix, return_bestness=True)
+
+def reference_multialign(sequence_matrices, subst_matrix, score_function=reference_optimal_shift_and_score):
+    '''Original implementation of multialign (heap of pairs keyed by (-score, shift, insertion), pairs of merged nodes are skipped when popped),
+    pairs are scored by score_function (returns shift, score, bestness).'''
+    sequence_matrices = list(sequence_matrices)
+    n = len(sequence_matrices)
+    active_nodes = set(range(n))
+    weights = [1] * n
+    tree = np.full((2*n - 1, 3), -1, dtype=int)
+    queue = ReferencePairQueue()
+    for i, j in itertools.combinations(active_nodes, 2):
+        shift, score, bestness = score_function(sequence_matrices[i], sequence_matrices[j], subst_matrix)
+        queue.add(i, j, shift, score)
+    while len(active_nodes) > 1:
+        best_pair = queue.pop_best(active_nodes)
+        if best_pair is None:
+            break
+        i, j, shift = best_pair
+        new = len(sequence_matrices)
+        sequence_matrices.append(no_gap_align.combine_sequences(sequence_matrices[i], sequence_matrices[j], weights=(weights[i], weights[j]), shift=shift))
+        weights.append(weights[i] + weights[j])
+        active_nodes.remove(i)
+        active_nodes.remove(j)
+        tree[new, :] = (i, j, shift)
+        for node in active_nodes:
+            shift, score, bestness = score_function(sequence_matrices[node], sequence_matrices[new], subst_matrix)
+            queue.add(node, new, shift, score)
+        active_nodes.add(new)
+    return sequence_matrices[-1], no_gap_align.shifts_from_tree(tree), tree
+
+class ReferencePairQueue:
+    '''Original priority queue of multialign (heapq with insertion counter).'''
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def add(self, i, j, shift, score):
+        heapq.heappush(self.heap, ((-score, shift), next(self.counter), (i, j)))
+
+    def pop_best(self, active_nodes):
+        while len(self.heap) > 0:
+            (neg_score, shift), order, (i, j) = heapq.heappop(self.heap)
+            if i in active_nodes and j in active_nodes:
+                return i, j, shift
+        return None
+
+#  TESTS  ################################################################################
+
+class OptimalityTestCase(unittest.TestCase):
+    def assertOptimal(self, shift, score, seq_mat_1, seq_mat_2, subst_matrix, exact=False):
+        '''Check that shift and score are optimal according to the original implementation, 
+        exactly (the first maximum) if exact, otherwise up to SCORE_TOLERANCE (near-tie shifts are accepted).'''
+        shifts_scores = reference_shifts_scores(seq_mat_1, seq_mat_2, subst_matrix)
+        if exact:
+            expected_shift, expected_score, bestness = reference_optimal_shift_and_score(seq_mat_1, seq_mat_2, subst_matrix)
+            self.assertEqual((shift, score), (expected_shift, expected_score))
+        else:
+            best_score = max(s for sh, s in shifts_scores)
+            self.assertAlmostEqual(score, best_score, delta=SCORE_TOLERANCE)
+            self.assertAlmostEqual(dict(shifts_scores)[shift], best_score, delta=SCORE_TOLERANCE)
+
+
+class TestDiagonalSums(unittest.TestCase):
+    SIZES = [(1, 1), (1, 9), (7, 8), (8, 8), (17, 5), (40, 45), (129, 130), (300, 260)]
+
+    def test_integer_equal_to_numpy_sum(self):
+        rng = np.random.default_rng(SEED)
+        for n1, n2 in self.SIZES:
+            matrix = rng.integers(-100, 100, size=(n1, n2))
+            expected = [ matrix.diagonal(offset=-shift).sum() for shift in range(-n2+1, n1) ]
+            self.assertEqual(no_gap_align.diagonal_sums(matrix).tolist(), expected)
+
+    def test_float_close_to_numpy_sum(self):
+        rng = np.random.default_rng(SEED)
+        for n1, n2 in self.SIZES:
+            matrix = rng.random((n1, n2)) * 100
+            expected = [ matrix.diagonal(offset=-shift).sum() for shift in range(-n2+1, n1) ]
+            np.testing.assert_allclose(no_gap_align.diagonal_sums(matrix), expected, rtol=1e-13)
+
+    def test_padded_stack(self):
+        rng = np.random.default_rng(SEED)
+        max_length = 150
+        sizes_1 = rng.integers(1, max_length+1, size=20)
+        sizes_2 = rng.integers(1, max_length+1, size=20)
+        stack = np.zeros((20, max_length, max_length))
+        for k, (n1, n2) in enumerate(zip(sizes_1, sizes_2)):
+            stack[k, :n1, :n2] = rng.random((n1, n2))
+        sums = no_gap_align.diagonal_sums(stack)
+        for k, (n1, n2) in enumerate(zip(sizes_1, sizes_2)):
+            expected = no_gap_align.diagonal_sums(stack[k, :n1, :n2])
+            self.assertEqual(sums[k, max_length-n2:max_length-1+n1].tolist(), expected.tolist())
+
+
+class TestOptimalShiftAndScore(OptimalityTestCase):
+    def test_letter_codes_and_one_hot(self):
+        rng = np.random.default_rng(SEED)
+        for trial in range(300):
+            alphabet = ALPHABETS[trial % len(ALPHABETS)]
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            sequence_1 = random_sequence(rng, alphabet)
+            sequence_2 = random_sequence(rng, alphabet)
+            matrix_1 = no_gap_align.sequence2matrix(sequence_1, letter2index)
+            matrix_2 = no_gap_align.sequence2matrix(sequence_2, letter2index)
+            codes_1 = no_gap_align.sequence2codes(sequence_1, letter2index)
+            codes_2 = no_gap_align.sequence2codes(sequence_2, letter2index)
+            expected = reference_optimal_shift_and_score(matrix_1, matrix_2, subst_matrix)
+            for seq_1, seq_2 in [(matrix_1, matrix_2), (codes_1, codes_2), (codes_1, matrix_2)]:
+                result = no_gap_align.optimal_shift_and_score(seq_1, seq_2, subst_matrix, return_bestness=True)
+                self.assertEqual(result, expected)
+
+    def test_profiles(self):
+        rng = np.random.default_rng(SEED)
+        for trial in range(300):
+            alphabet = ALPHABETS[trial % len(ALPHABETS)]
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            profile_1 = random_profile(rng, len(letters))
+            profile_2 = random_profile(rng, len(letters))
+            shift, score = no_gap_align.optimal_shift_and_score(profile_1, profile_2, subst_matrix)
+            self.assertOptimal(shift, score, profile_1, profile_2, subst_matrix)
+
+    def test_letter_codes_and_profiles(self):
+        rng = np.random.default_rng(SEED)
+        for trial in range(300):
+            alphabet = ALPHABETS[trial % len(ALPHABETS)]
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            codes = no_gap_align.sequence2codes(random_sequence(rng, alphabet), letter2index)
+            profile = random_profile(rng, len(letters))
+            for seq_1, seq_2 in [(codes, profile), (profile, codes)]:
+                shift, score = no_gap_align.optimal_shift_and_score(seq_1, seq_2, subst_matrix)
+                self.assertOptimal(shift, score, no_gap_align.as_matrix(seq_1, len(letters)), no_gap_align.as_matrix(seq_2, len(letters)), subst_matrix)
+                self.assertEqual(no_gap_align.optimal_shift_and_score(no_gap_align.as_matrix(seq_1, len(letters)), no_gap_align.as_matrix(seq_2, len(letters)), subst_matrix), 
+                                 (shift, score))
+
+    def test_many_against_one(self):
+        rng = np.random.default_rng(SEED)
+        for alphabet in ALPHABETS:
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            sequences = [ random_profile(rng, len(letters)) for i in range(20) ]
+            sequences += [ no_gap_align.sequence2codes(random_sequence(rng, alphabet), letter2index) for i in range(20) ]
+            profile = random_profile(rng, len(letters))
+            shifts, scores = no_gap_align.optimal_shifts_and_scores(sequences, profile, subst_matrix)
+            for sequence, shift, score in zip(sequences, shifts, scores):
+                self.assertEqual((shift, score), no_gap_align.optimal_shift_and_score(sequence, profile, subst_matrix))
+                self.assertOptimal(shift, score, no_gap_align.as_matrix(sequence, len(letters)), profile, subst_matrix)
+
+
+class TestPairwiseShiftsAndScores(OptimalityTestCase):
+    def check(self, sequences, subst_matrix, processes=1, exact=False):
+        n_letters = subst_matrix.shape[0]
+        pairs = [ (i, j) for i in range(len(sequences)) for j in range(i+1, len(sequences)) ]
+        shifts, scores = no_gap_align.pairwise_shifts_and_scores(sequences, subst_matrix, pairs, processes=processes)
+        for (i, j), shift, score in zip(pairs, shifts, scores):
+            self.assertEqual((shift, score), no_gap_align.optimal_shift_and_score(sequences[i], sequences[j], subst_matrix))
+            self.assertOptimal(shift, score, no_gap_align.as_matrix(sequences[i], n_letters), no_gap_align.as_matrix(sequences[j], n_letters), subst_matrix, exact=exact)
+
+    def test_letter_codes_and_one_hot(self):
+        rng = np.random.default_rng(SEED)
+        for alphabet in ALPHABETS:
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            sequences = [ random_sequence(rng, alphabet) for i in range(30) ]
+            self.check([ no_gap_align.sequence2codes(seq, letter2index) for seq in sequences ], subst_matrix, exact=True)
+            self.check([ no_gap_align.sequence2matrix(seq, letter2index) for seq in sequences ], subst_matrix, exact=True)
+            self.check([ no_gap_align.sequence2codes(seq, letter2index) for seq in sequences ], subst_matrix / 3)  # non-integer scores
+
+    def test_profiles(self):
+        rng = np.random.default_rng(SEED)
+        for alphabet in ALPHABETS:
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            sequences = [ random_profile(rng, len(letters)) for i in range(15) ]
+            sequences += [ no_gap_align.sequence2codes(random_sequence(rng, alphabet), letter2index) for i in range(15) ]
+            self.check(sequences, subst_matrix)
+
+    def test_processes(self):
+        rng = np.random.default_rng(SEED)
+        subst_matrix, letters, letter2index = random_substitution_matrix(rng, ALPHABETS[1])
+        sequences = [ no_gap_align.sequence2codes(random_sequence(rng, ALPHABETS[1], min_length=40), letter2index) for i in range(60) ]
+        self.check(sequences, subst_matrix, processes=2, exact=True)
+
+
+class TestPairQueue(unittest.TestCase):
+    def test_order_equal_to_heap(self):
+        rng = np.random.default_rng(SEED)
+        for n in (2, 5, 30, 100):  # 100 nodes are enough to compact the matrices
+            pairs = list(itertools.combinations(range(n), 2))
+            shifts = rng.integers(-2, 3, size=len(pairs))
+            scores = rng.integers(0, 4, size=len(pairs)) / 2  # many ties
+            queue = no_gap_align.PairQueue(n, shifts, scores)
+            reference_queue = ReferencePairQueue()
+            for (i, j), shift, score in zip(pairs, shifts, scores):
+                reference_queue.add(i, j, shift, score)
+            active_nodes = set(range(n))
+            new = n
+            while len(active_nodes) > 1:
+                best_pair = queue.pop_best()
+                self.assertEqual(best_pair, reference_queue.pop_best(active_nodes))
+                i, j, shift = best_pair
+                active_nodes -= {i, j}
+                new_pairs = [ (node, int(rng.integers(-2, 3)), rng.integers(0, 4) / 2) for node in active_nodes ]
+                for node, shift, score in new_pairs:
+                    reference_queue.add(node, new, shift, score)
+                queue.merge(i, j, new, new_pairs)
+                active_nodes.add(new)
+                new += 1
+            self.assertIsNone(queue.pop_best())
+
+
+class TestMultialign(unittest.TestCase):
+    def test_equal_to_reference(self):
+        '''Merging order of multialign must be the same as of the original algorithm with the same pair scores.'''
+        rng = np.random.default_rng(SEED)
+        for trial in range(30):
+            alphabet = ALPHABETS[trial % len(ALPHABETS)]
+            subst_matrix, letters, letter2index = random_substitution_matrix(rng, alphabet)
+            sequences = [ random_sequence(rng, alphabet, min_length=5, max_length=30) for i in range(int(rng.integers(2, 41))) ]
+            matrices = [ no_gap_align.sequence2matrix(seq, letter2index) for seq in sequences ]
+            codes = [ no_gap_align.sequence2codes(seq, letter2index) for seq in sequences ]
+            expected_matrix, expected_shifts, expected_tree = reference_multialign(matrices, subst_matrix, score_function=optimal_shift_and_score_with_bestness)
+            for leaves in (matrices, codes):
+                alignment_matrix, shifts, tree = no_gap_align.multialign(leaves, subst_matrix)
+                self.assertEqual(tree.tolist(), expected_tree.tolist())
+                self.assertEqual(list(shifts), list(expected_shifts))
+                self.assertTrue(np.array_equal(alignment_matrix, expected_matrix))
+
+
+if __name__ == '__main__':
+    unittest.main()
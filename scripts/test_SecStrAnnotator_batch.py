@@ -0,0 +1,137 @@
+'''
+Tests of SecStrAnnotator_batch: merging of annotation spool files, partitioning of jobs into shards, merge lock.
+
+Example usage:
+    python3  -m unittest  test_SecStrAnnotator_batch
+'''
+
+import os
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import SecStrAnnotator_batch
+
+#  FUNCTIONS  ################################################################################
+
+def write_spool(filename, records):
+    with open(filename, 'w') as w:
+        for key, value in records:
+            w.write(json.dumps([key, value]) + '\n')
+
+def dead_pid():
+    '''PID of a finished process.'''
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+#  TESTS  ####################################################################################
+
+class TestSpools(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+
+    def test_merge_format(self):
+        '''Merged spools must be formatted exactly as by json.dump(..., indent=4), the first record with a duplicate key wins.'''
+        records_1 = [('1tqnA', {'domain': {'name': '1tqnA', 'ranges': ':'}, 'secondary_structure_elements': [{'label': 'A', 'start': 1}]}),
+                     ('2nnjA', {'secondary_structure_elements': [], 'comment': 'line\nbreak'})]
+        records_2 = [('1bu7A', {'empty': {}}), ('1tqnA', {'duplicate': True}), ('3abcB', [1.5, None, 'ü'])]
+        spool_files = [os.path.join(self.dir, 'spool1.jsonl'), os.path.join(self.dir, 'spool2.jsonl')]
+        write_spool(spool_files[0], reversed(records_1))
+        write_spool(spool_files[1], records_2)
+        for spool_file in spool_files:
+            SecStrAnnotator_batch.sort_spool(spool_file)
+        output_file = os.path.join(self.dir, 'all.json')
+        SecStrAnnotator_batch.merge_spools(spool_files, output_file)
+        expected = {}
+        for key, value in sorted(records_1 + records_2, key=lambda record: record[0]):
+            expected.setdefault(key, value)
+        with open(output_file) as r:
+            self.assertEqual(r.read(), json.dumps(expected, indent=4))
+
+    def test_merge_empty(self):
+        spool_file = os.path.join(self.dir, 'spool.jsonl')
+        write_spool(spool_file, [])
+        output_file = os.path.join(self.dir, 'all.json')
+        SecStrAnnotator_batch.merge_spools([spool_file], output_file)
+        with open(output_file) as r:
+            self.assertEqual(r.read(), json.dumps({}, indent=4))
+
+
+class TestPartitionJobs(unittest.TestCase):
+    def test_partition(self):
+        costs = {'a': 10, 'b': 7, 'c': 5, 'd': 4, 'e': 4, 'f': 1}
+        parts = SecStrAnnotator_batch.partition_jobs(list(costs), costs.get, 3)
+        self.assertEqual(sorted(job for part in parts for job in part), sorted(costs))
+        self.assertEqual(parts, [['a'], ['b', 'e'], ['c', 'd', 'f']])
+
+    def test_deterministic(self):
+        costs = {f'job{i}': i % 5 for i in range(50)}
+        jobs = list(costs)
+        parts = SecStrAnnotator_batch.partition_jobs(jobs, costs.get, 4)
+        self.assertEqual(SecStrAnnotator_batch.partition_jobs(jobs[::-1], costs.get, 4), parts)
+        loads = [sum(costs[job] for job in part) for part in parts]
+        self.assertLessEqual(max(loads) - min(loads), max(costs.values()))
+
+    def test_more_parts_than_jobs(self):
+        parts = SecStrAnnotator_batch.partition_jobs(['a'], lambda job: 1, 3)
+        self.assertEqual(sorted(parts), [[], [], ['a']])
+
+
+class TestLock(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.lock_file = os.path.join(self.tmp.name, 'merge.lock')
+
+    def write_lock(self, content, age=0):
+        with open(self.lock_file, 'w') as w:
+            w.write(content)
+        mtime = time.time() - age
+        os.utime(self.lock_file, (mtime, mtime))
+
+    def test_is_stale_lock(self):
+        host = socket.gethostname()
+        for content, age, stale in [(f'{host} {os.getpid()}\n', 0, False),
+                                    (f'{host} {dead_pid()}\n', 0, True),
+                                    ('other-host 1\n', 0, False),
+                                    ('other-host 1\n', SecStrAnnotator_batch.SHARD_MERGE_LOCK_STALE_TIME + 10, True),
+                                    ('', 0, False)]:
+            with self.subTest(content=content, age=age):
+                self.write_lock(content, age)
+                self.assertEqual(SecStrAnnotator_batch.is_stale_lock(self.lock_file, content), stale)
+
+    def test_acquire_free_and_stale(self):
+        for content in [None, f'{socket.gethostname()} {dead_pid()}\n']:
+            with self.subTest(content=content):
+                if content is not None:
+                    self.write_lock(content)
+                lock = SecStrAnnotator_batch.acquire_lock(self.lock_file)
+                os.close(lock)
+                with open(self.lock_file) as r:
+                    self.assertEqual(r.read(), f'{socket.gethostname()} {os.getpid()}\n')
+                os.remove(self.lock_file)
+
+    def test_wait_for_held_lock(self):
+        self.write_lock(f'{socket.gethostname()} {os.getpid()}\n')  # held by a live process
+        release = threading.Timer(0.3, os.remove, (self.lock_file,))
+        release.start()
+        self.addCleanup(release.cancel)
+        start = time.time()
+        with mock.patch.object(SecStrAnnotator_batch, 'SHARD_MERGE_LOCK_POLL_INTERVAL', 0.05):
+            lock = SecStrAnnotator_batch.acquire_lock(self.lock_file)
+        os.close(lock)
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertTrue(os.path.isfile(self.lock_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
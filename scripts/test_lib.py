@@ -0,0 +1,188 @@
+'''
+Tests of lib: JSON cache, Pipeline (dependencies between tasks, task cache, profiling of tasks).
+
+Example usage:
+    python3  -m unittest  test_lib
+'''
+
+import os
+import pstats
+import tempfile
+import unittest
+
+import lib
+
+#  FUNCTIONS  ################################################################################
+
+def write_text(filename, text):
+    with open(filename, 'w') as w:
+        w.write(text)
+
+def read_text(filename):
+    with open(filename) as r:
+        return r.read()
+
+def append_text(source, dest, text):
+    '''Write content of source followed by text into dest.'''
+    write_text(dest, read_text(source) + text)
+
+def make_task(name, inputs, outputs):
+    return lib.Task(name, write_text, (), {}, None, None, None, None, None, inputs, outputs, False)
+
+#  TESTS  ####################################################################################
+
+class TestJsonCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(lib._json_cache.clear)
+        self.file = os.path.join(self.tmp.name, 'obj.json')
+
+    def test_reuse_written_object(self):
+        obj = {'a': [1, 2]}
+        lib.write_json(obj, self.file)
+        self.assertIs(lib.read_json(self.file), obj)
+        self.assertIs(lib.read_json(self.file, modify=True), obj)  # handed over to the caller, removed from the cache
+        self.assertIsNot(lib.read_json(self.file), obj)
+
+    def test_changed_file(self):
+        lib.write_json({'a': 1}, self.file)
+        with open(self.file, 'w') as w:
+            w.write('{"a": 2, "b": 3}')
+        self.assertEqual(lib.read_json(self.file), {'a': 2, 'b': 3})
+
+    def test_redirected_stdout_not_cached(self):
+        obj = {'a': 1}
+        with lib.RedirectIO(stdout=self.file):
+            lib.write_json(obj)
+        self.assertEqual(len(lib._json_cache), 0)
+        self.assertEqual(lib.read_json(self.file), obj)
+
+    def test_cache_cleared_in_worker(self):
+        lib._run_task_in_worker(lib.write_json, ({'a': 1}, self.file), {}, None, None, None)
+        self.assertEqual(len(lib._json_cache), 0)
+
+
+class TestDependencies(unittest.TestCase):
+    def test_conflicts(self):
+        tasks = [
+            make_task('write a', (), ('a.txt',)),
+            make_task('read a', ('a.txt',), ('b.txt',)),
+            make_task('independent', ('x.txt',), ('c.txt',)),
+            make_task('overwrite x', (), ('x.txt',)),  # must wait until x.txt has been read
+            make_task('write dir', ('b.txt',), ('dir',)),
+            make_task('read pattern in dir', ('dir/*.json',), ('d.txt',)),
+            make_task('read other pattern', ('other/*.json',), ('e.txt',)),
+        ]
+        self.assertEqual(lib.Pipeline._get_dependencies(tasks), [set(), {0}, set(), {2}, {1}, {4}, set()])
+
+    def test_barrier(self):
+        tasks = [
+            make_task('write a', (), ('a.txt',)),
+            make_task('barrier', None, None),
+            make_task('write b', (), ('b.txt',)),
+            make_task('read a', ('a.txt',), ('c.txt',)),
+        ]
+        self.assertEqual(lib.Pipeline._get_dependencies(tasks), [set(), {0}, {1}, {1}])
+
+    def test_parallel_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [ os.path.join(tmp, f'{i}.txt') for i in range(4) ]
+            pipeline = lib.Pipeline(n_processes=2)
+            pipeline.add_task('write 0', write_text, files[0], 'a', inputs=[], outputs=[files[0]])
+            for i in range(1, 4):
+                pipeline.add_task(f'append {i}', append_text, files[i-1], files[i], 'bcd'[i-1], inputs=[files[i-1]], outputs=[files[i]])
+            pipeline.start()
+            self.assertEqual(read_text(files[3]), 'abcd')
+
+
+class TestTaskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.input = os.path.join(self.tmp.name, 'input.txt')
+        self.output_dir = os.path.join(self.tmp.name, 'out')
+        self.output = os.path.join(self.output_dir, 'output.txt')
+        write_text(self.input, 'abc')
+        os.makedirs(self.output_dir)
+
+    def run_pipeline(self, text='!', external=False):
+        pipeline = lib.Pipeline(cache_dir=self.cache_dir)
+        pipeline.add_task('append', append_text, self.input, self.output, text, inputs=[self.input], outputs=[os.path.join(self.output_dir, '*.txt')], external=external)
+        pipeline.start()
+        return pipeline.timeline[0][3]
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.run_pipeline(), 'run')
+        os.remove(self.output)
+        self.assertEqual(self.run_pipeline(), 'from cache')
+        self.assertEqual(read_text(self.output), 'abc!')
+        self.assertEqual(self.run_pipeline(text='?'), 'run')  # changed arguments
+        self.assertEqual(read_text(self.output), 'abc?')
+        write_text(self.input, 'xyz')
+        self.assertEqual(self.run_pipeline(text='?'), 'run')  # changed input
+        self.assertEqual(read_text(self.output), 'xyz?')
+        write_text(self.input, 'abc')
+        self.assertEqual(self.run_pipeline(), 'from cache')
+        self.assertEqual(read_text(self.output), 'abc!')
+
+    def test_external_task_not_cached(self):
+        self.assertEqual(self.run_pipeline(external=True), 'run')
+        self.assertEqual(self.run_pipeline(external=True), 'run')
+
+    def test_missing_object(self):
+        self.assertEqual(self.run_pipeline(), 'run')
+        for object_file in os.listdir(os.path.join(self.cache_dir, 'objects')):
+            os.remove(os.path.join(self.cache_dir, 'objects', object_file))
+        self.assertEqual(self.run_pipeline(), 'run')
+
+    def test_signature(self):
+        pipeline = lib.Pipeline()
+        pipeline.add_task('append', append_text, self.input, self.output, '!', inputs=[self.input], outputs=[self.output])
+        pipeline.add_task('append 2', append_text, self.input, self.output, '!', inputs=[self.input], outputs=[self.output])
+        first, second = pipeline.tasks
+        signature = pipeline._task_signature(first)
+        self.assertEqual(pipeline._task_signature(first), signature)
+        self.assertNotEqual(pipeline._task_signature(second), signature)  # different name
+        write_text(os.path.join(self.tmp.name, 'unrelated.txt'), 'x')
+        self.assertEqual(pipeline._task_signature(first), signature)
+        write_text(self.input, 'abd')
+        self.assertNotEqual(pipeline._task_signature(first), signature)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+
+    def run_pipeline(self, n_processes, **pipeline_options):
+        pipeline = lib.Pipeline(n_processes=n_processes, **pipeline_options)
+        output = os.path.join(self.dir, 'out.txt')
+        pipeline.add_task('write file', write_text, output, 'hello', inputs=[], outputs=[output])
+        pipeline.start()
+        return pipeline
+
+    def test_cprofile_without_profile(self):
+        for n_processes in (1, 2):
+            with self.subTest(n_processes=n_processes):
+                cprofile_dir = os.path.join(self.dir, f'cprofile{n_processes}')
+                pipeline = self.run_pipeline(n_processes, cprofile_dir=cprofile_dir)
+                prof_file = os.path.join(cprofile_dir, 'write_file.prof')
+                self.assertTrue(os.path.isfile(prof_file))
+                self.assertGreater(pstats.Stats(prof_file).total_calls, 0)
+                self.assertIsNone(pipeline.timeline[0][4])  # resources not measured
+
+    def test_profile_and_cprofile(self):
+        profile_file = os.path.join(self.dir, 'profile.json')
+        cprofile_dir = os.path.join(self.dir, 'cprofile')
+        pipeline = self.run_pipeline(1, profile_file=profile_file, cprofile_dir=cprofile_dir)
+        self.assertTrue(os.path.isfile(os.path.join(cprofile_dir, 'write_file.prof')))
+        resources = pipeline.timeline[0][4]
+        self.assertEqual(resources['http_requests'], 0)
+        self.assertGreaterEqual(resources['wall_time'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
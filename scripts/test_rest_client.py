@@ -0,0 +1,71 @@
+'''
+Tests of rest_client: replay of recorded responses (batch requests and fallback to single requests).
+
+Example usage:
+    python3  -m unittest  test_rest_client
+'''
+
+import os
+import json
+import tempfile
+import unittest
+
+import rest_client
+
+#  CONSTANTS  ################################################################################
+
+BASE_URL = 'https://www.ebi.ac.uk/pdbe/api/pdb/entry/molecules/'
+DATA = { '1tqn': [{'entity_id': 1}], '2nnj': [{'entity_id': 1}, {'entity_id': 2}], '3abc': [] }
+
+#  FUNCTIONS  ################################################################################
+
+def no_network(*args, **kwargs):
+    raise AssertionError('No network access is allowed in replay mode')
+
+#  TESTS  ####################################################################################
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.archive_file = os.path.join(self.tmp.name, 'archive.sqlite')
+        self.archive = rest_client.ResponseArchive(self.archive_file)
+
+    def make_client(self, batch_size):
+        client = rest_client.RestClient(archive=self.archive_file, archive_mode=rest_client.REPLAY, batch_size=batch_size, concurrency=2)
+        client.session.request = no_network
+        return client
+
+    def record_single(self, ids):
+        for id in ids:
+            self.archive.put('GET', BASE_URL + id, '', 200, json.dumps({id: DATA[id]}).encode())
+
+    def check_responses(self, responses, ids):
+        self.assertEqual([ response.json() for response in responses ], [ {id: DATA[id]} for id in ids ])
+
+    def test_batch(self):
+        ids = ['2nnj', '1tqn', '3abc']
+        self.archive.put('POST', BASE_URL, '1tqn,2nnj,3abc', 200, json.dumps(DATA).encode())
+        self.check_responses(self.make_client(batch_size=10).get_many_by_id(BASE_URL, ids), ids)
+
+    def test_fallback_to_single_requests(self):
+        '''Batch requests missing in the archive (e.g. recorded with another batch size) are replaced by recorded single requests.'''
+        ids = ['2nnj', '1tqn', '3abc']
+        self.archive.put('POST', BASE_URL, '1tqn,2nnj', 200, json.dumps({id: DATA[id] for id in ['1tqn', '2nnj']}).encode())
+        self.record_single(['3abc'])
+        self.check_responses(self.make_client(batch_size=2).get_many_by_id(BASE_URL, ids), ids)
+        self.record_single(ids)
+        self.check_responses(self.make_client(batch_size=10).get_many_by_id(BASE_URL, ids), ids)
+
+    def test_missing_single_request(self):
+        self.record_single(['1tqn'])
+        client = self.make_client(batch_size=1)
+        self.assertEqual(client.get(BASE_URL + '1tqn').json(), {'1tqn': DATA['1tqn']})
+        with self.assertRaises(rest_client.ReplayMissError):
+            client.get(BASE_URL + '2nnj')
+        with self.assertRaises(rest_client.ReplayMissError):
+            client.get_many_by_id(BASE_URL, ['1tqn', '2nnj'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,10 +9,11 @@ Example usage:
 import sys
 import argparse
 import json
-import requests
 from collections import defaultdict
 from typing import Dict, Any, Optional
 
+import rest_client
+
 #  CONSTANTS  ################################################################################
 
 API_URL = 'https://www.ebi.ac.uk/pdbe/api/mappings/{pdb}'
@@ -53,9 +54,9 @@ def main(input_json: str) -> Optional[int]:
     # Download GO term information from PDBeAPI
     domains_to_terms = defaultdict(list)
     terms_to_description = {}
-    for domain, pdb, chain, uniprot in to_process:
-        response_str = requests.get(API_URL.format(pdb=pdb)).text
-        response = json.loads(response_str)
+    responses = rest_client.get_client().get_many(API_URL.format(pdb=pdb) for domain, pdb, chain, uniprot in to_process)
+    for (domain, pdb, chain, uniprot), response in zip(to_process, responses):
+        response = response.json()
         go_terms = response[pdb]['GO']
         for term, term_data in go_terms.items():
             for mapping in term_data['mappings']: